@@ -18,6 +18,76 @@ EMOJI_MAP = {
     'noclass': '⚙️'
 }
 
+# Сэмплирование логов действий пользователей (доля отправляемых событий, 0.0-1.0).
+# Ставка по действию применяется только к рутинным уровням (info/debug),
+# ошибки и предупреждения по умолчанию отправляются всегда.
+LOG_SAMPLE_RATES_BY_ACTION = json.loads(os.getenv("LOG_SAMPLE_RATES_BY_ACTION", json.dumps({
+    "Просмотр предметов": 0.1,
+    "Выбор недели для отметки": 0.1,
+    "Временная отметка": 0.1,
+})))
+LOG_SAMPLE_RATES_BY_LEVEL = json.loads(os.getenv("LOG_SAMPLE_RATES_BY_LEVEL", json.dumps({
+    "debug": 0.1,
+    "info": 1.0,
+    "warning": 1.0,
+    "error": 1.0,
+    "critical": 1.0,
+})))
+
+# Рассылка напоминаний и лимиты Telegram
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "10"))  # одновременных отправок
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "3"))  # попыток при RetryAfter
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # сообщений в секунду на бота
+TELEGRAM_PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в чат
+TELEGRAM_INTERACTIVE_MAX_WAIT = float(os.getenv("TELEGRAM_INTERACTIVE_MAX_WAIT", "5"))  # макс. ожидание RetryAfter для ответов пользователю
+
+# Предпрогрев кэшей перед пиками нагрузки (время напоминаний и окончания пар, МСК)
+PREWARM_LEAD_MINUTES = int(os.getenv("PREWARM_LEAD_MINUTES", "2"))
+PREWARM_MIN_SUBSCRIBERS = int(os.getenv("PREWARM_MIN_SUBSCRIBERS", "5"))
+CLASS_END_TIMES = [t.strip() for t in os.getenv("CLASS_END_TIMES", "10:00,11:40,13:50,15:30,17:10,18:50").split(",") if t.strip()]
+
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный URL (нужен только для регистрации webhook)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен в webhook-режиме, общий для всех процессов за балансировщиком
+# Регистрировать webhook в Telegram при запуске: включается только у одного процесса (или в шаге деплоя).
+# Снимать webhook не нужно - run_polling делает это сам при возврате в режим polling
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "0").strip().lower() in ("1", "true", "yes")
+
+# Одновременно обрабатываемых обновлений (обновления одного пользователя - строго по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+# Допуск обновлений под нагрузкой: сколько обновлений каждого класса может быть
+# принято (ждут общего слота или обрабатываются); сверх лимита пользователь получает
+# "попробуйте через N секунд".
+# Классы по убыванию приоритета: admin > save > view > settings.
+UPDATE_QUEUE_LIMITS = json.loads(os.getenv("UPDATE_QUEUE_LIMITS", json.dumps({
+    "admin": 20,
+    "save": 200,
+    "view": 100,
+    "settings": 30,
+})))
+# В лимиты классов входит только очередное обновление каждого пользователя;
+# сверх этого числа ждущих обновлений одного пользователя - отказ сразу
+UPDATE_USER_QUEUE_LIMIT = int(os.getenv("UPDATE_USER_QUEUE_LIMIT", "5"))
+
+# Кэш профилей Telegram (username, имя) для черного списка
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", str(7 * 24 * 3600)))  # секунд, после - запрос get_chat
+PROFILE_FETCH_CONCURRENCY = int(os.getenv("PROFILE_FETCH_CONCURRENCY", "8"))  # одновременных get_chat
+
+# Сессии пользователей (user_data / user_states) в SQLite с LRU-слоем в памяти
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "5000"))  # записей в памяти на хранилище
+# Черновики отметок и отмен пар до нажатия "Сохранить"
+DRAFT_TTL = int(os.getenv("DRAFT_TTL", str(24 * 3600)))  # секунд без изменений, после - черновик удаляется
+DRAFT_MAX_ENTRIES = int(os.getenv("DRAFT_MAX_ENTRIES", "10000"))  # черновиков в памяти (остальные - в БД)
+DRAFT_FLUSH_INTERVAL = int(os.getenv("DRAFT_FLUSH_INTERVAL", "5"))  # секунд между записями изменений в БД
+
+# Защита от двойных нажатий
+CALLBACK_DEDUP_WINDOW = float(os.getenv("CALLBACK_DEDUP_WINDOW", "1.0"))  # секунд после выполнения, повтор той же кнопки сохранения игнорируется
+SAVE_DEDUP_WINDOW = float(os.getenv("SAVE_DEDUP_WINDOW", "30"))  # секунд, повторное сохранение тех же отметок не пишется в таблицу
+
 def get_google_credentials():
     """Загружает credentials из переменной окружения"""
     creds_base64 = os.getenv("GOOGLE_CREDENTIALS_JSON")
@@ -6,6 +6,149 @@ header('Content-Type: text/html; charset=UTF-8');
 // Московское время (UTC+3)
 date_default_timezone_set('Europe/Moscow');
 
+// Агрегаты (роллапы) обновляются при записи, чтобы сводка не зависела от размера лога.
+// Каждая минута - отдельный файл: запись блокирует и переписывает только свою
+// маленькую шарду, а сводка читает только минуты из запрошенного окна.
+define('ROLLUPS_DIR', 'bot_rollups');
+define('ROLLUPS_RETENTION_MINUTES', 7 * 24 * 60); // Храним поминутные бакеты за 7 дней
+$LATENCY_BOUNDS = [0.1, 0.25, 0.5, 1, 2, 3, 5, 10];
+
+function latency_bucket($seconds, $bounds) {
+    foreach ($bounds as $i => $bound) {
+        if ($seconds <= $bound) {
+            return (string)$bound;
+        }
+    }
+    return '+Inf';
+}
+
+function parse_performance_record($message) {
+    // "⏱️ show_subjects: 1.234с", "🐌 show_subjects: 2.345с", "❌ show_subjects ошибка после 0.123с: ..."
+    if (preg_match('/([\w\.]+)(?::| ошибка после) ([0-9]+(?:\.[0-9]+)?)с/u', $message, $m)) {
+        return [$m[1], (float)$m[2]];
+    }
+    return null;
+}
+
+function rollup_shard_path($minute) {
+    // "Y-m-d H:i" -> bot_rollups/Y-m-d_H-i.json
+    return ROLLUPS_DIR . '/' . str_replace([' ', ':'], ['_', '-'], $minute) . '.json';
+}
+
+function prune_rollup_shards() {
+    // Вызывается раз в минуту (при создании новой шарды); имена сортируются как время
+    $cutoff = rollup_shard_path(date('Y-m-d H:i', time() - ROLLUPS_RETENTION_MINUTES * 60));
+    foreach (glob(ROLLUPS_DIR . '/*.json') ?: [] as $path) {
+        if ($path >= $cutoff) {
+            break;
+        }
+        @unlink($path);
+    }
+}
+
+function update_rollups($minute, $log_type, $log_level, $message, $bounds, $fields = [], $weight = 1) {
+    if (!is_dir(ROLLUPS_DIR) && !@mkdir(ROLLUPS_DIR, 0775, true) && !is_dir(ROLLUPS_DIR)) {
+        error_log("Rollups: cannot create " . ROLLUPS_DIR);
+        return;
+    }
+    $path = rollup_shard_path($minute);
+    $is_new = !file_exists($path);
+    $fp = fopen($path, 'c+');
+    if (!$fp) {
+        error_log("Rollups: cannot open " . $path);
+        return;
+    }
+    flock($fp, LOCK_EX);
+    $raw = stream_get_contents($fp);
+    $shard = $raw ? json_decode($raw, true) : null;
+    if (!is_array($shard)) {
+        $shard = ['counts' => [], 'latency' => []];
+    }
+
+    // Счетчики по (type, level) за минуту
+    $key = "$log_type|$log_level";
+    // Сэмплированные события учитываются с весом 1/sample_rate
+    $shard['counts'][$key] = ($shard['counts'][$key] ?? 0) + $weight;
+
+    // Гистограммы задержек из performance-записей
+    if (strpos($log_type, 'performance') === 0) {
+        // Структурированные поля (handler, duration) надежнее разбора текста
+        if (isset($fields['handler'], $fields['duration'])) {
+            $parsed = [(string)$fields['handler'], (float)$fields['duration']];
+        } else {
+            $parsed = parse_performance_record($message);
+        }
+        if ($parsed) {
+            list($handler, $seconds) = $parsed;
+            $bucket = latency_bucket($seconds, $bounds);
+            $h = $shard['latency'][$handler] ?? ['count' => 0, 'sum' => 0, 'max' => 0, 'buckets' => []];
+            $h['count'] += 1;
+            $h['sum'] = round($h['sum'] + $seconds, 3);
+            $h['max'] = max($h['max'], $seconds);
+            $h['buckets'][$bucket] = ($h['buckets'][$bucket] ?? 0) + 1;
+            $shard['latency'][$handler] = $h;
+        }
+    }
+
+    ftruncate($fp, 0);
+    rewind($fp);
+    fwrite($fp, json_encode($shard, JSON_UNESCAPED_UNICODE));
+    fflush($fp);
+    flock($fp, LOCK_UN);
+    fclose($fp);
+
+    if ($is_new) {
+        prune_rollup_shards();
+    }
+}
+
+function build_summary($window_minutes) {
+    $counts = [];
+    $per_hour = [];
+    $latency = [];
+    $now = time();
+
+    // Читаем только шарды минут из окна
+    for ($i = $window_minutes - 1; $i >= 0; $i--) {
+        $minute = date('Y-m-d H:i', $now - $i * 60);
+        $path = rollup_shard_path($minute);
+        if (!file_exists($path)) {
+            continue;
+        }
+        $shard = json_decode((string)@file_get_contents($path), true);
+        if (!is_array($shard)) {
+            continue;
+        }
+
+        $hour = substr($minute, 0, 13) . ':00';
+        foreach ($shard['counts'] ?? [] as $key => $count) {
+            $counts[$key] = ($counts[$key] ?? 0) + $count;
+            $per_hour[$hour][$key] = ($per_hour[$hour][$key] ?? 0) + $count;
+        }
+        foreach ($shard['latency'] ?? [] as $handler => $h) {
+            $agg = $latency[$handler] ?? ['count' => 0, 'sum' => 0, 'max' => 0, 'buckets' => []];
+            $agg['count'] += $h['count'];
+            $agg['sum'] = round($agg['sum'] + $h['sum'], 3);
+            $agg['max'] = max($agg['max'], $h['max']);
+            foreach ($h['buckets'] as $bucket => $count) {
+                $agg['buckets'][$bucket] = ($agg['buckets'][$bucket] ?? 0) + $count;
+            }
+            $latency[$handler] = $agg;
+        }
+    }
+    foreach ($latency as $handler => $agg) {
+        $latency[$handler]['avg'] = $agg['count'] ? round($agg['sum'] / $agg['count'], 3) : 0;
+    }
+
+    return [
+        'window_minutes' => $window_minutes,
+        'generated_at' => date('Y-m-d H:i:s'),
+        'counts' => $counts,
+        'per_hour' => $per_hour,
+        'latency' => $latency,
+    ];
+}
+
 // Обработка POST запросов (новые логи)
 if ($_SERVER['REQUEST_METHOD'] === 'POST') {
     $input = file_get_contents('php://input');
@@ -19,12 +162,24 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         
         // Сохраняем в файл
         file_put_contents('bot_logs.txt', $log_entry, FILE_APPEND | LOCK_EX);
+        $fields = is_array($data['fields'] ?? null) ? $data['fields'] : [];
+        $sample_rate = (float)($data['sample_rate'] ?? 1);
+        $weight = $sample_rate > 0 && $sample_rate < 1 ? (int)round(1 / $sample_rate) : 1;
+        update_rollups(date('Y-m-d H:i'), $log_type, $log_level, (string)$data['log'], $LATENCY_BOUNDS, $fields, $weight);
         error_log("Log written: " . trim($log_entry));
         echo "OK";
         exit;
     }
 }
 
+// Сводка по агрегатам (GET ?summary=1&minutes=60) - не читает bot_logs.txt
+if (isset($_GET['summary'])) {
+    $window = isset($_GET['minutes']) ? max(1, min(ROLLUPS_RETENTION_MINUTES, (int)$_GET['minutes'])) : 60;
+    header('Content-Type: application/json; charset=UTF-8');
+    echo json_encode(build_summary($window), JSON_UNESCAPED_UNICODE | JSON_PRETTY_PRINT);
+    exit;
+}
+
 // Отображение логов (GET запросы)
 $logs = [];
 $total_lines = 0;
@@ -120,6 +275,7 @@ $debug_info = [
     
     <div style="margin-top: 20px;">
         <button onclick="location.reload()">Обновить вручную</button>
+        <button onclick="window.location.href='?summary=1&minutes=60'">Сводка за час</button>
         <button onclick="if(confirm('Очистить все логи?')){ window.location.href='?clear=1'; }">Очистить логи</button>
     </div>
 </body>
@@ -130,6 +286,9 @@ $debug_info = [
 if (isset($_GET['clear']) && $_GET['clear'] == 1) {
     if (file_exists('bot_logs.txt')) {
         file_put_contents('bot_logs.txt', '');
+        foreach (glob(ROLLUPS_DIR . '/*.json') ?: [] as $path) {
+            @unlink($path);
+        }
         echo "<script>alert('Логи очищены'); location.href='logger.php';</script>";
     }
 }
@@ -1,20 +1,45 @@
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.ext import (
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+)
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 import gspread
 from datetime import datetime, timezone, timedelta
 import requests
 import json
 from threading import Thread
 import os
+from contextlib import contextmanager
 from functools import wraps
+from types import MappingProxyType
 import time
 import asyncio
-from collections import deque
+import hmac
+import math
+import random
+import re
+import signal
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import MutableMapping
 import psutil
 
 # Импортируем настройки из config.py
-from config import BOT_TOKEN, SPREADSHEET_URL, ADMIN_ID, EMOJI_MAP, get_google_credentials
+from config import (
+    BOT_TOKEN, SPREADSHEET_URL, ADMIN_ID, EMOJI_MAP, get_google_credentials,
+    LOG_SAMPLE_RATES_BY_ACTION, LOG_SAMPLE_RATES_BY_LEVEL,
+    REMINDER_CONCURRENCY, REMINDER_MAX_ATTEMPTS, TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL,
+    TELEGRAM_INTERACTIVE_MAX_WAIT,
+    PREWARM_LEAD_MINUTES, PREWARM_MIN_SUBSCRIBERS, CLASS_END_TIMES,
+    BOT_MODE, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_REGISTER,
+    UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMITS, UPDATE_USER_QUEUE_LIMIT, PROFILE_CACHE_TTL, PROFILE_FETCH_CONCURRENCY,
+    CALLBACK_DEDUP_WINDOW, SAVE_DEDUP_WINDOW, SESSION_CACHE_SIZE,
+    DRAFT_TTL, DRAFT_MAX_ENTRIES, DRAFT_FLUSH_INTERVAL,
+)
 
 # Настройка логирования в файл
 logging.basicConfig(
@@ -28,6 +53,46 @@ logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
+class LogEvent:
+    """Структурированное событие лога: текст собирается только при отправке (str())"""
+    __slots__ = ('template', 'fields')
+
+    def __init__(self, template, **fields):
+        self.template = template
+        self.fields = fields
+
+    def __str__(self):
+        return self.template.format(**self.fields)
+
+class UserActionEvent(LogEvent):
+    """Действие пользователя (user_id, action, details + произвольные поля)
+
+    Если переданы поля, details - шаблон str.format по ним ("день: {day}").
+    """
+    __slots__ = ('extra',)
+
+    def __init__(self, user_id, username, action, details="", **fields):
+        super().__init__(details, user_id=user_id, username=username, action=action, **fields)
+        self.extra = bool(fields)
+
+    def __str__(self):
+        f = self.fields
+        details = self.template.format(**f) if self.extra else self.template
+        message = f"👤 ID:{f['user_id']} (@{f['username']}) | {f['action']}"
+        if details:
+            message += f" | {details}"
+        return message
+
+# Уровни, к которым применяется сэмплирование по действию
+ROUTINE_LOG_LEVELS = ('debug', 'info')
+
+def get_log_sample_rate(action, level):
+    """Доля событий, которые нужно отправить, для пары (действие, уровень)"""
+    rate = LOG_SAMPLE_RATES_BY_LEVEL.get(level, 1.0)
+    if level in ROUTINE_LOG_LEVELS:
+        rate *= LOG_SAMPLE_RATES_BY_ACTION.get(action, 1.0)
+    return max(0.0, min(1.0, rate))
+
 def log_execution_time(func_name, slow_threshold=2.0):
     """Декоратор для логирования времени выполнения с настраиваемым порогом"""
     def decorator(func):
@@ -40,23 +105,37 @@ def log_execution_time(func_name, slow_threshold=2.0):
                 
                 # Логируем только если дольше порога
                 if execution_time > slow_threshold:
-                    logger.warning(f"🐌 {func_name}: {execution_time:.3f}с (медленно)")
-                    send_log_to_server(f"🐌 {func_name}: {execution_time:.3f}с", "performance_slow", "warning")
+                    logger.warning("🐌 %s: %.3fс (медленно)", func_name, execution_time)
+                    send_log_to_server(
+                        LogEvent("🐌 {handler}: {duration:.3f}с", handler=func_name, duration=execution_time),
+                        "performance_slow", "warning"
+                    )
                 elif execution_time > 1.0:
-                    logger.info(f"⏱️ {func_name}: {execution_time:.3f}с")
-                    send_log_to_server(f"⏱️ {func_name}: {execution_time:.3f}с", "performance", "info")
+                    logger.info("⏱️ %s: %.3fс", func_name, execution_time)
+                    send_log_to_server(
+                        LogEvent("⏱️ {handler}: {duration:.3f}с", handler=func_name, duration=execution_time),
+                        "performance", "info"
+                    )
                 
                 return result
             except Exception as e:
                 execution_time = time.time() - start_time
-                logger.error(f"❌ {func_name} ошибка после {execution_time:.3f}с: {e}")
-                send_log_to_server(f"❌ {func_name} ошибка после {execution_time:.3f}с: {e}", "performance_error", "error")
+                logger.error("❌ %s ошибка после %.3fс: %s", func_name, execution_time, e)
+                send_log_to_server(
+                    LogEvent("❌ {handler} ошибка после {duration:.3f}с: {error}",
+                             handler=func_name, duration=execution_time, error=e),
+                    "performance_error", "error"
+                )
                 raise
         return wrapper
     return decorator
 
-def send_log_to_server(log_message, log_type="bot", level="info"):
-    """Отправка логов на наш сервер с московским временем"""
+def send_log_to_server(log_message, log_type="bot", level="info", sample_rate=1.0):
+    """Отправка логов на наш сервер с московским временем
+
+    log_message может быть строкой или LogEvent - тогда текст формируется
+    в фоновом потоке, а поля события уходят на сервер в структурированном виде.
+    """
     def send_async():
         try:
             # Московское время (UTC+3)
@@ -68,6 +147,11 @@ def send_log_to_server(log_message, log_type="bot", level="info"):
                 'level': str(level),
                 'timestamp': datetime.now(moscow_tz).strftime('%Y-%m-%d %H:%M:%S')
             }
+            if isinstance(log_message, LogEvent):
+                log_data['fields'] = {key: value if isinstance(value, (int, float, bool)) else str(value)
+                                      for key, value in log_message.fields.items()}
+            if sample_rate < 1.0:
+                log_data['sample_rate'] = sample_rate
             
             response = requests.post(
                 'http://redleg30607.fvds.ru/logger.php',
@@ -77,9 +161,9 @@ def send_log_to_server(log_message, log_type="bot", level="info"):
             )
             
             if response.status_code == 200:
-                print(f"✅ Лог отправлен: {log_message}")
+                print(f"✅ Лог отправлен: {log_data['log']}")
             else:
-                print(f"❌ Ошибка: {response.status_code} - {log_message}")
+                print(f"❌ Ошибка: {response.status_code} - {log_data['log']}")
                 
         except Exception as e:
             print(f"💥 Ошибка отправки: {e}")
@@ -89,15 +173,21 @@ def send_log_to_server(log_message, log_type="bot", level="info"):
     thread.daemon = True
     thread.start()
 
-def log_user_action(user_id, username, action, details="", level="info"):
-    """Логирование действий пользователя ТОЛЬКО НА СЕРВЕР"""
-    user_info = f"ID:{user_id} (@{username})"
-    log_message = f"👤 {user_info} | {action}"
-    if details:
-        log_message += f" | {details}"
+def log_user_action(user_id, username, action, details="", level="info", **fields):
+    """Логирование действий пользователя ТОЛЬКО НА СЕРВЕР
+
+    Рутинные события сэмплируются (LOG_SAMPLE_RATES_BY_ACTION / _BY_LEVEL);
+    решение принимается до форматирования, поэтому отброшенные события ничего не стоят.
+    Значения передаются полями, а details - шаблоном по ним:
+    log_user_action(user_id, username, "Просмотр предметов", "день: {day}", day=day)
+    """
+    sample_rate = get_log_sample_rate(action, level)
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
     
-    send_log_to_server(log_message, "user_action", level)
-    logger.info(f"📝 {log_message}")  # В консоль для отладки
+    event = UserActionEvent(user_id, username, action, details, **fields)
+    send_log_to_server(event, "user_action", level, sample_rate)
+    logger.info("📝 %s", event)  # В консоль для отладки
 
 def get_week_info(week_offset=0):
     """
@@ -120,18 +210,31 @@ def get_week_info(week_offset=0):
         if week_number < 1 or week_number > 17:
             return None
         
-        week_type = "Знаменатель" if week_number % 2 == 0 else "Числитель"
-        
         return {
             'number': week_number,
-            'type': week_type,
-            'string': f"{week_type} - {week_number} неделя"
+            'type': get_week_type_name(week_number),
+            'string': format_week_string(week_number)
         }
         
     except Exception as e:
         logger.error(f"❌ Ошибка в определении недели: {e}")
         return None
 
+def get_week_type_name(week_number):
+    """Тип недели по ее номеру"""
+    return "Знаменатель" if week_number % 2 == 0 else "Числитель"
+
+def format_week_string(week_number):
+    """Строка недели в формате таблицы, например "Числитель - 8 неделя" """
+    return f"{get_week_type_name(week_number)} - {week_number} неделя"
+
+def parse_week_number(week_string):
+    """Номер недели из строки вида "Числитель - 8 неделя" """
+    match = re.search(r'(\d+)\s*неделя', week_string)
+    if not match:
+        raise ValueError(f"не удалось определить номер недели: '{week_string}'")
+    return int(match.group(1))
+
 def get_current_week_type():
     """Текущая неделя"""
     week_info = get_week_info(0)
@@ -184,27 +287,852 @@ def connect_google_sheets():
         send_log_to_server(error_msg, "error", "critical")
         return None
 
+# ЛОКАЛЬНЫЕ БД
+class SQLiteStore:
+    """Соединение с локальной SQLite-БД (WAL) и его блокировка
+
+    Соединение открывается при первом обращении, схема создается тогда же.
+    У каждого хранилища свое соединение и своя блокировка: долгая транзакция
+    одного (например, запись черновиков в потоке) не задерживает запросы другого.
+    """
+    
+    def __init__(self, path, schema=()):
+        self.path = path
+        self.schema = schema
+        self.conn = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.schema:
+            conn.execute(statement)
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Соединение под блокировкой хранилища"""
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.connect()
+            yield self.conn
+    
+    def query(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+    
+    def execute(self, sql, params=()):
+        with self.connection() as conn:
+            conn.execute(sql, params)
+    
+    def transaction(self, statements):
+        """Выполняет [(sql, params), ...] одной транзакцией"""
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+# ХРАНИЛИЩЕ СЕССИЙ
+# Профили зарегистрированных студентов и состояния диалога переживают перезапуск:
+# после деплоя пользователя узнаем сразу, без /start и без обращения к таблице.
+SESSIONS_DB = 'sessions.db'
+# Черновики пишутся пачками из потока - отдельный файл, чтобы их транзакции
+# не задерживали чтение сессий на event loop
+DRAFTS_DB = 'drafts.db'
+
+sessions_db = SQLiteStore(SESSIONS_DB, (
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    "kind TEXT NOT NULL, user_id INTEGER NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, "
+    "PRIMARY KEY (kind, user_id))",
+))
+drafts_db = SQLiteStore(DRAFTS_DB, (
+    "CREATE TABLE IF NOT EXISTS drafts ("
+    "kind TEXT NOT NULL, user_id INTEGER NOT NULL, draft_key TEXT NOT NULL, items TEXT NOT NULL, "
+    "expires_at REAL NOT NULL, PRIMARY KEY (kind, user_id, draft_key))",
+))
+
+class SessionStore(MutableMapping):
+    """Словарь user_id -> значение (JSON), сохраняемый в SQLite
+
+    Горячие записи (и отсутствующие ключи) держатся в LRU в памяти, поэтому
+    частые проверки `user_id in user_data` не ходят в БД. Записи редкие
+    (вход, регистрация), поэтому пишутся в БД сразу.
+    """
+    MISSING = object()
+    
+    def __init__(self, kind, hot_size=5000):
+        self.kind = kind
+        self.hot = OrderedDict()
+        self.hot_size = hot_size
+        self.hits = 0
+        self.misses = 0
+    
+    def remember(self, user_id, value):
+        self.hot[user_id] = value
+        self.hot.move_to_end(user_id)
+        if len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+    
+    def lookup(self, user_id):
+        value = self.hot.get(user_id)
+        if value is not None:
+            self.hot.move_to_end(user_id)
+            self.hits += 1
+            return value
+        self.misses += 1
+        rows = sessions_db.query("SELECT value FROM sessions WHERE kind = ? AND user_id = ?", (self.kind, user_id))
+        value = json.loads(rows[0][0]) if rows else self.MISSING
+        self.remember(user_id, value)
+        return value
+    
+    def __getitem__(self, user_id):
+        value = self.lookup(user_id)
+        if value is self.MISSING:
+            raise KeyError(user_id)
+        return value
+    
+    def __contains__(self, user_id):
+        return self.lookup(user_id) is not self.MISSING
+    
+    def __setitem__(self, user_id, value):
+        sessions_db.execute(
+            "INSERT OR REPLACE INTO sessions (kind, user_id, value, updated_at) VALUES (?, ?, ?, ?)",
+            (self.kind, user_id, json.dumps(value, ensure_ascii=False), time.time())
+        )
+        self.remember(user_id, value)
+    
+    def __delitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        sessions_db.execute("DELETE FROM sessions WHERE kind = ? AND user_id = ?", (self.kind, user_id))
+        self.remember(user_id, self.MISSING)
+    
+    def __iter__(self):
+        rows = sessions_db.query("SELECT user_id FROM sessions WHERE kind = ?", (self.kind,))
+        return iter([user_id for (user_id,) in rows])
+    
+    def __len__(self):
+        return sessions_db.query("SELECT COUNT(*) FROM sessions WHERE kind = ?", (self.kind,))[0][0]
+    
+    def value_counts(self):
+        """{значение: число записей} одним запросом (для строковых значений, например состояний)"""
+        rows = sessions_db.query("SELECT value, COUNT(*) FROM sessions WHERE kind = ? GROUP BY value", (self.kind,))
+        return {json.loads(value): count for value, count in rows}
+    
+    def format_metrics(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return f"{len(self.hot)} в памяти, попаданий {hit_rate:.0f}%"
+
+class DraftStore:
+    """Черновики до нажатия "Сохранить": отметки студентов и отмены пар админа
+
+    Ключ - (вид, user_id, ключ черновика), значение - {строка таблицы: значение}.
+    Черновик живет ttl секунд с последнего изменения, в памяти - не больше
+    max_entries (самые давние вытесняются в БД). Изменения копятся и пишутся
+    в БД одной транзакцией раз в DRAFT_FLUSH_INTERVAL секунд.
+
+    Пока изменение не записано (в том числе вытесненное из памяти или уже
+    отданное потоку-писателю), get() берет его из памяти, а не из БД, -
+    иначе только что удаленный черновик вернулся бы из старой строки.
+    Отсутствующие ключи тоже запоминаются, чтобы частая проверка "черновика
+    нет" не ходила в БД.
+    """
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # ключ -> (items, expires_at), от давних к недавним
+        self.dirty = set()
+        self.evicted_dirty = {}  # вытесненные из памяти, еще не записанные: ключ -> запись
+        self.in_flight = {}  # отданные на запись, еще не подтвержденные: ключ -> запись или None (удаление)
+        self.absent = OrderedDict()  # ключи, которых точно нет в БД
+        self.expired = 0
+        self.evicted = 0
+    
+    def read_row(self, full_key):
+        rows = drafts_db.query(
+            "SELECT items, expires_at FROM drafts WHERE kind = ? AND user_id = ? AND draft_key = ?", full_key
+        )
+        return (json.loads(rows[0][0]), rows[0][1]) if rows else None
+    
+    def write_rows(self, rows):
+        """Upsert/удаление черновиков и чистка просроченных в БД (одна транзакция)"""
+        statements = []
+        for full_key, entry in rows:
+            if entry is None:
+                statements.append(("DELETE FROM drafts WHERE kind = ? AND user_id = ? AND draft_key = ?", full_key))
+            else:
+                statements.append((
+                    "INSERT OR REPLACE INTO drafts (kind, user_id, draft_key, items, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (*full_key, json.dumps(entry[0], ensure_ascii=False), entry[1])
+                ))
+        statements.append(("DELETE FROM drafts WHERE expires_at < ?", (time.time(),)))
+        drafts_db.transaction(statements)
+    
+    def get(self, kind, user_id, key):
+        """Черновик или None (просроченный считается отсутствующим)"""
+        full_key = (kind, user_id, key)
+        entry = self.entries.get(full_key)
+        if entry is None:
+            if full_key in self.dirty:
+                return None  # удален, удаление еще не записано
+            if full_key in self.evicted_dirty:
+                entry = self.evicted_dirty[full_key]
+            elif full_key in self.in_flight:
+                entry = self.in_flight[full_key]
+            elif full_key in self.absent:
+                self.absent.move_to_end(full_key)
+                return None
+            else:
+                entry = self.read_row(full_key)
+                if entry is None:
+                    self.remember_absent(full_key)
+            if entry is None:
+                return None
+            self.remember(full_key, entry)
+        if entry[1] < time.time():
+            self.expired += 1
+            self.discard(kind, user_id, key)
+            return None
+        self.entries.move_to_end(full_key)
+        return entry[0]
+    
+    def update(self, kind, user_id, key, changes):
+        """Добавляет изменения в черновик и продлевает его срок"""
+        items = dict(self.get(kind, user_id, key) or {})
+        items.update(changes)
+        full_key = (kind, user_id, key)
+        self.evicted_dirty.pop(full_key, None)
+        self.absent.pop(full_key, None)
+        self.remember(full_key, (items, time.time() + self.ttl))
+        self.dirty.add(full_key)
+    
+    def discard(self, kind, user_id, key):
+        full_key = (kind, user_id, key)
+        self.entries.pop(full_key, None)
+        self.evicted_dirty.pop(full_key, None)
+        self.dirty.add(full_key)
+        self.remember_absent(full_key)
+    
+    def remember_absent(self, full_key):
+        self.absent[full_key] = True
+        self.absent.move_to_end(full_key)
+        while len(self.absent) > self.max_entries:
+            self.absent.popitem(last=False)
+    
+    def remember(self, full_key, entry):
+        self.entries[full_key] = entry
+        self.entries.move_to_end(full_key)
+        while len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.evicted += 1
+            # Несохраненный черновик уйдет в БД со следующей пачкой
+            if old_key in self.dirty:
+                self.dirty.discard(old_key)
+                self.evicted_dirty[old_key] = old_entry
+    
+    def take_changes(self):
+        """Измененные черновики для записи (на event loop); после записи - finish_changes()"""
+        changes = dict(self.evicted_dirty)
+        changes.update((full_key, self.entries.get(full_key)) for full_key in self.dirty)
+        self.evicted_dirty.clear()
+        self.dirty.clear()
+        self.in_flight.update(changes)
+        return list(changes.items())
+    
+    def finish_changes(self, rows, written=True):
+        """Подтверждает запись пачки; при ошибке изменения вернутся в следующую пачку"""
+        for full_key, entry in rows:
+            if full_key in self.in_flight and self.in_flight[full_key] is entry:
+                del self.in_flight[full_key]
+                if not written and full_key not in self.dirty:
+                    self.evicted_dirty[full_key] = entry
+    
+    def expire(self):
+        """Удаляет из памяти просроченные черновики"""
+        now = time.time()
+        expired = [full_key for full_key, (items, expires_at) in self.entries.items() if expires_at < now]
+        for full_key in expired:
+            del self.entries[full_key]
+            self.dirty.discard(full_key)
+        self.expired += len(expired)
+        return len(expired)
+    
+    def format_metrics(self):
+        return (f"• Черновики: {len(self.entries)} в памяти, "
+                f"не записано {len(self.dirty) + len(self.evicted_dirty) + len(self.in_flight)}, "
+                f"просрочено {self.expired}, вытеснено {self.evicted}\n")
+
+drafts = DraftStore(DRAFT_TTL, DRAFT_MAX_ENTRIES)
+
 # Глобальные переменные
 db = None
-user_data = {}
-user_states = {}
+user_data = SessionStore('user_data', SESSION_CACHE_SIZE)
+user_states = SessionStore('user_states', SESSION_CACHE_SIZE)
 user_notifications = {}
 
-# Кеш
-cache = {
-    'week_strings': {},
-    'blacklist': [],
-    'admins': [],
-}
-
-# Предзагруженные данные для ускорения
-preloaded_data = {
-    'students': None,
-    'schedule_1': None,
-    'schedule_2': None,
-    'blacklist': None,
-    'last_loaded': 0
-}
+# СНИМОК ДАННЫХ ИЗ ТАБЛИЦЫ
+class DataSnapshot:
+    """Неизменяемый снимок данных из Google Sheets
+
+    Строки расписания - кортежи, записи студентов - только для чтения.
+    Читатели берут ссылку на текущий снимок (current_snapshot()) и работают
+    с ней без блокировок и копирования; загрузка собирает новый снимок и
+    публикует его заменой одной ссылки, поэтому обработчик (и поток из пула)
+    никогда не видит наполовину обновленные данные.
+
+    generations - поколение каждого набора данных ('students', 'schedule_1',
+    'blacklist'...): растет при каждой его публикации или сбросе и лежит в
+    том же снимке, что и сами данные.
+    """
+    __slots__ = ('students', 'schedules', 'blacklist', 'blacklist_ids', 'loaded_at', 'generations', 'version')
+    
+    def __init__(self, students=None, schedules=None, blacklist=(), loaded_at=None, generations=None, version=0):
+        object.__setattr__(self, 'students', students)
+        object.__setattr__(self, 'schedules', MappingProxyType(dict(schedules or {})))
+        object.__setattr__(self, 'blacklist', blacklist)
+        object.__setattr__(self, 'blacklist_ids', frozenset(blacklist))
+        object.__setattr__(self, 'loaded_at', MappingProxyType(dict(loaded_at or {})))
+        object.__setattr__(self, 'generations', MappingProxyType(dict(generations or {})))
+        object.__setattr__(self, 'version', version)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("DataSnapshot неизменяем - используйте publish_snapshot()")
+    
+    def age(self, name):
+        """Секунды с загрузки набора данных (None - не загружен)"""
+        loaded_at = self.loaded_at.get(name)
+        return time.time() - loaded_at if loaded_at is not None else None
+
+def freeze_grid(rows):
+    return tuple(tuple(row) for row in rows)
+
+ScheduleChanges = namedtuple('ScheduleChanges', ['data', 'cells', 'base_generation', 'generation'])
+
+def diff_schedule(old_rows, rows):
+    """Сравнивает новый лист расписания с предыдущим снимком
+
+    Возвращает (строки, ячейки): неизменившиеся строки берутся из старого
+    снимка, ячейки - кортеж (номер строки, колонка, было, стало) по
+    колонкам студентов. ячейки=None - изменилась структура (шапка, число
+    строк, неделя/день/предмет), такие изменения точечно не применяются.
+    """
+    if old_rows is None or len(old_rows) != len(rows):
+        return freeze_grid(rows), None
+    
+    frozen = []
+    cells = []
+    structural = False
+    for row_num, (old, row) in enumerate(zip(old_rows, rows), start=1):
+        row = tuple(row)
+        if row == old:
+            frozen.append(old)
+            continue
+        frozen.append(row)
+        if structural:
+            continue
+        if row_num == 1 or old[:3] != row[:3]:
+            structural = True
+            continue
+        for col in range(3, max(len(old), len(row))):
+            before = old[col] if col < len(old) else ""
+            after = row[col] if col < len(row) else ""
+            if before != after:
+                cells.append((row_num, col, before, after))
+    return tuple(frozen), None if structural else tuple(cells)
+
+schedule_diff_stats = {'reloads': 0, 'unchanged': 0, 'incremental': 0, 'structural': 0, 'cells': 0,
+                       'replayed': 0}
+
+# Локальные правки расписания по поколениям: 'schedule_N' -> [(поколение, {(строка, колонка): значение})].
+# Перечитанный во время сохранения лист дополняется ими, а не выбрасывается
+SCHEDULE_EDIT_LOG_SIZE = 200
+schedule_edit_log = {}
+
+def apply_cell_edits(rows, edits):
+    """Копия сетки с записанными ячейками (None - строка правки вне сетки)"""
+    if any(row_num > len(rows) for row_num, _ in edits):
+        return None
+    grid = list(rows)
+    for (row_num, col), value in edits.items():
+        row = list(grid[row_num - 1])
+        if col >= len(row):
+            row.extend([""] * (col + 1 - len(row)))
+        row[col] = value
+        grid[row_num - 1] = row
+    return grid
+
+def replay_schedule_edits(name, rows, base_generation, generation):
+    """Дополняет лист, прочитанный на поколении base_generation, правками до generation
+
+    Возвращает None, если между ними было не только локальное сохранение
+    (например, другая перезагрузка) или журнал уже не покрывает этот промежуток.
+    """
+    entries = [(gen, edits) for gen, edits in schedule_edit_log.get(name, ()) if base_generation < gen <= generation]
+    if [gen for gen, _ in entries] != list(range(base_generation + 1, generation + 1)):
+        return None
+    for _, edits in entries:
+        rows = apply_cell_edits(rows, edits)
+        if rows is None:
+            return None
+    return rows
+
+def freeze_records(records):
+    return tuple(MappingProxyType(dict(record)) for record in records)
+
+data_snapshot = DataSnapshot()
+# Только для публикующих: читатели снимка блокировок не берут
+snapshot_publish_lock = threading.RLock()
+
+def current_snapshot():
+    return data_snapshot
+
+def publish_snapshot(students=None, schedules=None, blacklist=None, invalidate=(), touch_loaded_at=True,
+                     base_generations=None):
+    """Собирает и атомарно публикует новый снимок
+
+    students / schedules ({подгруппа: строки}) / blacklist - новые данные
+    (None - без изменений), invalidate - имена наборов, которые нужно сбросить
+    ('students', 'schedule_1', 'blacklist'). touch_loaded_at=False - данные
+    изменены локально, а не перечитаны: срок жизни кэша не продлевается.
+    base_generations - поколения снимка, с которого начиналось чтение из
+    таблицы: набор, опубликованный за время чтения (например, сохраненные
+    отметки), не перезаписывается устаревшими данными.
+    """
+    global data_snapshot
+    with snapshot_publish_lock:
+        old = data_snapshot
+        now = time.time()
+        new_students = old.students
+        new_schedules = dict(old.schedules)
+        new_blacklist = old.blacklist
+        loaded_at = dict(old.loaded_at)
+        changed = []
+        cell_changes = {}
+        
+        outdated = [
+            name for name in (['students'] if students is not None else [])
+                + [f'schedule_{subgroup}' for subgroup in (schedules or {})]
+                + (['blacklist'] if blacklist is not None else [])
+            if base_generations is not None and old.generations.get(name, 0) != base_generations.get(name, 0)
+        ]
+        for subgroup, rows in list((schedules or {}).items()):
+            name = f'schedule_{subgroup}'
+            if name in outdated:
+                # Пока читали лист, в него сохранили отметки - дополняем прочитанное этими правками
+                rows = replay_schedule_edits(name, rows, base_generations.get(name, 0), old.generations.get(name, 0))
+                if rows is not None:
+                    schedules[subgroup] = rows
+                    outdated.remove(name)
+                    schedule_diff_stats['replayed'] += 1
+        if outdated:
+            # Пока читали таблицу, набор успел обновиться - прочитанное уже устарело
+            logger.info(f"⏭️ Пропущена публикация устаревших данных: {', '.join(outdated)}")
+            if 'students' in outdated:
+                students = None
+            if 'blacklist' in outdated:
+                blacklist = None
+            schedules = {subgroup: rows for subgroup, rows in (schedules or {}).items()
+                         if f'schedule_{subgroup}' not in outdated}
+        
+        # Неизменившиеся наборы только продлевают loaded_at - поколение остается прежним
+        if students is not None:
+            loaded_at['students'] = now
+            frozen = freeze_records(students)
+            if frozen != old.students:
+                new_students = frozen
+                changed.append('students')
+        for subgroup, rows in (schedules or {}).items():
+            name = f'schedule_{subgroup}'
+            if touch_loaded_at:
+                loaded_at[name] = now
+            rows, cells = diff_schedule(old.schedules.get(str(subgroup)), rows)
+            schedule_diff_stats['reloads'] += 1
+            if cells == ():
+                schedule_diff_stats['unchanged'] += 1
+                continue
+            new_schedules[str(subgroup)] = rows
+            changed.append(name)
+            if cells is None:
+                schedule_diff_stats['structural'] += 1
+            else:
+                schedule_diff_stats['incremental'] += 1
+                schedule_diff_stats['cells'] += len(cells)
+                cell_changes[name] = (rows, cells)
+        if blacklist is not None:
+            loaded_at['blacklist'] = now
+            frozen = tuple(str(user_id).strip() for user_id in blacklist)
+            if frozen != old.blacklist:
+                new_blacklist = frozen
+                changed.append('blacklist')
+        
+        for name in invalidate:
+            loaded_at.pop(name, None)
+            if name == 'students':
+                new_students = None
+            elif name.startswith('schedule_'):
+                new_schedules.pop(name[len('schedule_'):], None)
+            changed.append(name)
+        
+        generations = dict(old.generations)
+        for name in changed:
+            generations[name] = generations.get(name, 0) + 1
+        changes = {
+            name: ScheduleChanges(rows, cells, old.generations.get(name, 0), generations[name])
+            for name, (rows, cells) in cell_changes.items()
+        }
+        
+        snapshot = data_snapshot = DataSnapshot(new_students, new_schedules, new_blacklist, loaded_at, generations, old.version + 1)
+    
+    # Обновляем только то, что построено из изменившихся наборов
+    # (по набору изменений ячеек - точечно, иначе сбрасываем)
+    for derived_cache in derived_caches:
+        derived_cache.invalidate(changed, changes)
+    return snapshot
+
+def data_generations(names):
+    """Поколения наборов данных в текущем снимке"""
+    generations = current_snapshot().generations
+    return tuple(generations.get(name, 0) for name in names)
+
+def refresh_stale_inputs(names):
+    """Перезагружает входные наборы с истекшим сроком жизни (расписание - 10 минут)
+
+    Без этого производная запись жила бы, пока не сменится поколение, и
+    правки в таблице не доходили бы до индексов; неизменившийся лист после
+    перезагрузки поколение не повышает, так что кэш остается в силе.
+    """
+    for name in names:
+        if name.startswith('schedule_'):
+            get_schedule_data_optimized(name[len('schedule_'):])
+
+# ПРОИЗВОДНЫЕ ДАННЫЕ
+derived_caches = []
+
+class DerivedCache:
+    """LRU-кэш производных данных (индексы, агрегаты, готовые виды) с объявленными входами
+
+    Запись помнит, из каких наборов данных она построена и их поколения.
+    publish_snapshot() удаляет только записи, зависящие от изменившихся
+    наборов; при чтении поколения сверяются еще раз, а результат, во время
+    расчета которого входы успели смениться, не сохраняется - так устаревшие
+    данные не возвращаются даже при публикации из другого потока.
+
+    Для вида можно зарегистрировать updater(args, value, changes): он
+    получает набор изменений ячеек (ScheduleChanges) и возвращает
+    обновленное значение или DerivedCache.DROP - тогда запись сбрасывается.
+    """
+    DROP = object()
+    
+    def __init__(self, title, max_size=512):
+        self.title = title
+        self.entries = OrderedDict()  # ключ -> (входы, поколения, значение)
+        self.dependents = {}  # набор данных -> ключи зависящих записей
+        self.updaters = {}  # вид -> updater(args, value, changes)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.updated = 0
+        derived_caches.append(self)
+    
+    def register_updater(self, view, updater):
+        self.updaters[view] = updater
+    
+    def get_or_compute(self, key, inputs, compute):
+        refresh_stale_inputs(inputs)
+        generations = data_generations(inputs)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == generations:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        
+        value = compute()
+        # Расчет мог сам перезагрузить данные - такой результат не кэшируем
+        if data_generations(inputs) != generations:
+            return value
+        
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = (inputs, generations, value)
+            for name in inputs:
+                self.dependents.setdefault(name, set()).add(key)
+            if len(self.entries) > self.max_size:
+                self.drop(next(iter(self.entries)))
+        return value
+    
+    def drop(self, key):
+        """Удаляет запись вместе с обратными ссылками (под self.lock)"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        for name in entry[0]:
+            keys = self.dependents.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[name]
+        return True
+    
+    def invalidate(self, names, changes=None):
+        """Сбрасывает записи, зависящие от names; changes - {набор: ScheduleChanges} для точечного обновления"""
+        changes = changes or {}
+        with self.lock:
+            for name in names:
+                change = changes.get(name)
+                for key in list(self.dependents.get(name, ())):
+                    if change is not None and self.apply_change(key, name, change):
+                        self.updated += 1
+                    elif self.drop(key):
+                        self.invalidated += 1
+    
+    def apply_change(self, key, name, change):
+        """Применяет изменения ячеек к записи (под self.lock); False - запись нужно сбросить"""
+        updater = self.updaters.get(key[0])
+        inputs, generations, value = self.entries[key]
+        position = inputs.index(name)
+        # Изменения применимы только к записи, построенной ровно из предыдущей версии
+        if updater is None or generations[position] != change.base_generation:
+            return False
+        try:
+            value = updater(key[1], value, change)
+        except Exception as e:
+            logger.error(f"❌ Ошибка точечного обновления {key[0]}: {e}")
+            return False
+        if value is DerivedCache.DROP:
+            return False
+        generations = generations[:position] + (change.generation,) + generations[position + 1:]
+        self.entries[key] = (inputs, generations, value)
+        return True
+    
+    def format_metrics(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return (f"• {self.title}: {len(self.entries)} записей, "
+                f"попаданий {self.hits} / промахов {self.misses} ({hit_rate:.0f}%), "
+                f"обновлено по изменениям {self.updated}, сброшено {self.invalidated}\n")
+
+class RenderCache(DerivedCache):
+    """Кэш готовых сообщений и клавиатур по (вид, входные данные)"""
+    
+    def get_or_render(self, view, inputs, dependencies, render):
+        return self.get_or_compute((view, inputs), tuple(dependencies), render)
+
+render_cache = RenderCache("Кэш отрисовки")
+derived_data = DerivedCache("Индексы и агрегаты", max_size=2048)
+
+def derived_view(inputs, update=None):
+    """Объявляет функцию производным видом: inputs(*args) - имена наборов данных, из которых он строится,
+    update(args, value, changes) - точечное обновление по изменениям ячеек"""
+    def decorator(func):
+        if update is not None:
+            derived_data.register_updater(func.__name__, update)
+        @wraps(func)
+        def wrapper(*args):
+            return derived_data.get_or_compute((func.__name__, args), inputs(*args), lambda: func(*args))
+        return wrapper
+    return decorator
+
+def normalize_week(week_string):
+    return ' '.join(str(week_string).split())
+
+ScheduleIndex = namedtuple('ScheduleIndex', ['data', 'columns', 'day_rows'])
+
+def update_schedule_index(args, index, changes):
+    # Отметки не меняют колонки и строки - подменяем только сами данные
+    return index._replace(data=changes.data)
+
+@derived_view(lambda subgroup: (f'schedule_{subgroup}',), update=update_schedule_index)
+def schedule_index(subgroup):
+    """Индекс расписания подгруппы: колонка по номеру студента, строки по (неделя, день)"""
+    data = get_schedule_data_optimized(subgroup)
+    columns = {}
+    day_rows = {}
+    if data:
+        for idx, cell in enumerate(data[0]):
+            columns.setdefault(str(cell).strip(), idx)
+        for row_num, row in enumerate(data[1:], start=2):
+            if len(row) > 2:
+                day_rows.setdefault((normalize_week(row[0]), row[1]), []).append(row_num)
+    return ScheduleIndex(data, columns, {key: tuple(rows) for key, rows in day_rows.items()})
+
+def update_student_week_summary(args, summary, changes):
+    _, student_number, week_string = args
+    if summary is None:
+        return summary
+    
+    student_number = str(student_number).strip()
+    header = changes.data[0]
+    student_col = next((idx for idx, cell in enumerate(header) if str(cell).strip() == student_number), None)
+    week_string = normalize_week(week_string)
+    marks = set(EMOJI_MAP.values())
+    
+    updated = None
+    for row_num, col, before, after in changes.cells:
+        if col != student_col:
+            continue
+        row = changes.data[row_num - 1]
+        if normalize_week(row[0]) != week_string:
+            continue
+        delta = (after.strip() in marks) - (before.strip() in marks)
+        if delta:
+            updated = updated or dict(summary)
+            total, marked = updated[row[1]]
+            updated[row[1]] = (total, marked + delta)
+    return updated or summary
+
+@derived_view(lambda subgroup, student_number, week_string: (f'schedule_{subgroup}',),
+              update=update_student_week_summary)
+def student_week_summary(subgroup, student_number, week_string):
+    """{день: (всего пар, отмечено)} для студента за неделю (None - студента нет в таблице)"""
+    index = schedule_index(subgroup)
+    student_col = index.columns.get(str(student_number).strip())
+    if student_col is None:
+        return None
+    
+    week_string = normalize_week(week_string)
+    marks = set(EMOJI_MAP.values())
+    summary = {}
+    for (week, day), row_nums in index.day_rows.items():
+        if week != week_string:
+            continue
+        marked = 0
+        for row_num in row_nums:
+            row = index.data[row_num - 1]
+            if len(row) > student_col and row[student_col].strip() in marks:
+                marked += 1
+        summary[day] = (len(row_nums), marked)
+    return summary
+
+@derived_view(lambda: ('students',))
+def students_by_telegram_id():
+    """Индекс студентов по Telegram ID"""
+    students = {}
+    for student in get_students_data_optimized():
+        existing_id = str(student.get('Telegram ID', '')).strip()
+        if existing_id and existing_id.isdigit():
+            students.setdefault(int(existing_id), student)
+    return students
+
+def student_session_data(student):
+    """Данные сессии (user_data) по строке листа «Студенты»"""
+    return {
+        'fio': student['ФИО'],
+        'number': student['№'],
+        'subgroup': student['Подгруппа']
+    }
+
+def build_main_menu_markup(user_id):
+    """Клавиатура главного меню"""
+    is_admin = user_id == ADMIN_ID
+    
+    def render():
+        keyboard = [
+            [InlineKeyboardButton("📝 Отметиться", callback_data="mark_attendance")],
+            [InlineKeyboardButton("⚙️ Настройки", callback_data="settings_menu")]
+        ]
+        if is_admin:
+            keyboard.append([InlineKeyboardButton("🛠️ Админ-панель", callback_data="admin_panel")])
+        return InlineKeyboardMarkup(keyboard)
+    
+    return render_cache.get_or_render('main_menu', (is_admin,), (), render)
+
+def build_admin_panel_markup():
+    """Клавиатура админ-панели"""
+    def render():
+        keyboard = [
+            [InlineKeyboardButton("👥 Список студентов", callback_data="admin_students")],
+            [InlineKeyboardButton("🖥️ Статус сервера", callback_data="admin_status")],
+            [InlineKeyboardButton("📊 Наличие пар", callback_data="admin_class_presence")],
+            [InlineKeyboardButton("⚫ Черный список", callback_data="admin_blacklist")],
+            [InlineKeyboardButton("🔄 Обновить кэш", callback_data="admin_refresh_cache")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    return render_cache.get_or_render('admin_panel', (), (), render)
+
+# Отпечатки последних отправленных сообщений: (чат, сообщение) -> (текст, parse_mode, клавиатура)
+message_fingerprints = OrderedDict()
+MESSAGE_FINGERPRINTS_LIMIT = 5000
+edit_stats = {'sent': 0, 'markup_only': 0, 'skipped': 0}
+
+def fingerprint_is_current(shown, message):
+    """Актуальна ли запись кэша правок для сообщения из query.message
+
+    shown - (время правки, текст, клавиатура) сообщения, которое вернул
+    Telegram после нашей правки. Запись устарела, если после нее сообщение
+    правил кто-то еще (другой процесс в webhook-режиме).
+    """
+    if message is None:
+        return True  # inline-сообщение - сверить не с чем
+    if shown is None:
+        return False
+    edited_at, shown_text, shown_markup = shown
+    seen_at = message.edit_date or message.date
+    if seen_at < edited_at:
+        return True  # query.message старше нашей правки (несколько правок за одно нажатие)
+    return seen_at == edited_at and message.text == shown_text and message.reply_markup == shown_markup
+
+async def edit_message(query, text, reply_markup=None, parse_mode=None, **kwargs):
+    """Редактирует сообщение кнопки, пропуская запросы, которые ничего не меняют
+
+    Если совпадают текст и клавиатура - запрос к Telegram не делается,
+    если изменилась только клавиатура - используется editMessageReplyMarkup.
+    Сверка идет с query.message; кэш правок используется, только пока он с
+    ним согласуется (и для inline-сообщений).
+    """
+    message = query.message
+    key = (message.chat_id, message.message_id) if message else query.inline_message_id
+    fingerprint = (text, parse_mode, reply_markup)
+    previous = None
+    cached = message_fingerprints.get(key)
+    if cached is not None:
+        if fingerprint_is_current(cached[1], message):
+            previous = cached[0]
+        else:
+            del message_fingerprints[key]
+    
+    # Нет актуальной записи - сверяемся с тем, что сейчас видит пользователь (только без разметки:
+    # с parse_mode в message.text уже отрендеренный текст)
+    if previous is None and message and parse_mode is None and message.text == text:
+        previous = (text, None, message.reply_markup)
+    
+    if previous == fingerprint:
+        edit_stats['skipped'] += 1
+        return
+    
+    try:
+        if previous is not None and previous[:2] == fingerprint[:2]:
+            edit_stats['markup_only'] += 1
+            result = await query.edit_message_reply_markup(reply_markup=reply_markup)
+        else:
+            edit_stats['sent'] += 1
+            result = await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        # "not modified" - время правки неизвестно, в следующий раз сверимся с query.message
+        message_fingerprints.pop(key, None)
+        if "Message is not modified" not in str(e):
+            raise
+        return
+    
+    shown = ((result.edit_date, result.text, result.reply_markup)
+             if isinstance(result, Message) and result.edit_date else None)
+    message_fingerprints[key] = (fingerprint, shown)
+    message_fingerprints.move_to_end(key)
+    if len(message_fingerprints) > MESSAGE_FINGERPRINTS_LIMIT:
+        message_fingerprints.popitem(last=False)
 
 def is_user_blacklisted(user_id):
     """Проверка, находится ли пользователь в черном списке"""
@@ -214,51 +1142,43 @@ def is_user_blacklisted(user_id):
             return False
             
         # Используем кэшированные данные
-        blacklist = cache['blacklist']
-        if not blacklist:
-            return False
-            
-        # Проверяем ID в черном списке
-        user_id_str = str(user_id).strip()
-        for blacklisted_id in blacklist:
-            if str(blacklisted_id).strip() == user_id_str:
-                return True
-                
-        return False
+        return str(user_id).strip() in current_snapshot().blacklist_ids
         
     except Exception as e:
         logger.error(f"❌ Ошибка проверки черного списка: {e}")
         # В случае ошибки разрешаем доступ (безопаснее)
         return False
 
+def fetch_blacklist():
+    """Читает черный список из таблицы (без кэша)"""
+    blacklist_sheet = db.worksheet("Черный список")
+    data = blacklist_sheet.col_values(1)  # Получаем только первую колонку
+    
+    # Пропускаем заголовок (A1) и берем данные с A2, фильтруем пустые значения
+    blacklist_ids = []
+    if len(data) > 1:
+        blacklist_ids = [id_str.strip() for id_str in data[1:] if id_str.strip()]
+    return blacklist_ids
+
 @retry_google_operation(max_attempts=3, delay=2)
 def get_blacklist_data(force_refresh=False):
     """Получение данных черного списка с кэшированием"""
+    snapshot = current_snapshot()
     # Если force_refresh=True, игнорируем кэш
-    if not force_refresh and (preloaded_data.get('blacklist') is not None and 
-        time.time() - preloaded_data['last_loaded'] < 300):
-        return preloaded_data['blacklist']
+    age = snapshot.age('blacklist')
+    if not force_refresh and age is not None and age < 300:
+        return snapshot.blacklist
     
     try:
         logger.info("📋 Загрузка черного списка из Google Sheets")
-        blacklist_sheet = db.worksheet("Черный список")
-        data = blacklist_sheet.col_values(1)  # Получаем только первую колонку
-        
-        # Пропускаем заголовок (A1) и берем данные с A2, фильтруем пустые значения
-        blacklist_ids = []
-        if len(data) > 1:
-            blacklist_ids = [id_str.strip() for id_str in data[1:] if id_str.strip()]
-            
-        preloaded_data['blacklist'] = blacklist_ids
-        preloaded_data['last_loaded'] = time.time()
-        
-        logger.info(f"✅ Загружено {len(blacklist_ids)} ID в черном списке")
-        return blacklist_ids
+        blacklist = publish_snapshot(blacklist=fetch_blacklist(), base_generations=snapshot.generations).blacklist
+        logger.info(f"✅ Загружено {len(blacklist)} ID в черном списке")
+        return blacklist
         
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки черного списка: {e}")
         # Возвращаем старые данные или пустой список
-        return preloaded_data.get('blacklist', [])
+        return current_snapshot().blacklist
 
 def check_blacklist(func):
     """Декоратор для проверки черного списка перед выполнением функции"""
@@ -282,23 +1202,15 @@ def preload_frequent_data():
         logger.info("🔄 Предзагрузка частых данных...")
         send_log_to_server("🔄 Предзагрузка частых данных...", "preload", "info")
         
-        preloaded_data['students'] = get_students_data_optimized()
-        preloaded_data['schedule_1'] = get_schedule_data_optimized(1)
-        preloaded_data['schedule_2'] = get_schedule_data_optimized(2)
-        preloaded_data['blacklist'] = get_blacklist_data()
-        preloaded_data['last_loaded'] = time.time()
-        
-        # ОБНОВЛЯЕМ ЕДИНЫЙ КЕШ
-        cache['blacklist'] = preloaded_data['blacklist']
+        students_count = len(get_students_data_optimized() or ())
+        schedule1_count = len(get_schedule_data_optimized(1) or ())
+        schedule2_count = len(get_schedule_data_optimized(2) or ())
+        blacklist_count = len(get_blacklist_data() or ())
         
         logger.info("✅ Предзагрузка завершена")
         send_log_to_server("✅ Предзагрузка завершена", "preload", "info")
         
         # Логируем размер загруженных данных
-        students_count = len(preloaded_data['students']) if preloaded_data['students'] else 0
-        schedule1_count = len(preloaded_data['schedule_1']) if preloaded_data['schedule_1'] else 0
-        schedule2_count = len(preloaded_data['schedule_2']) if preloaded_data['schedule_2'] else 0
-        blacklist_count = len(preloaded_data['blacklist']) if preloaded_data['blacklist'] else 0
         
         logger.info(f"📊 Загружено: {students_count} студентов, "
                    f"{schedule1_count} строк расписания 1, "
@@ -314,30 +1226,69 @@ def preload_frequent_data():
 @retry_google_operation(max_attempts=2, delay=1)
 def get_students_data_optimized():
     """Оптимизированное получение данных студентов"""
-    if preloaded_data['students'] is not None:
-        return preloaded_data['students']
+    snapshot = current_snapshot()
+    if snapshot.students is not None:
+        return snapshot.students
     else:
         logger.info("📚 Загрузка данных студентов из Google Sheets")
-        students_sheet = db.worksheet("Студенты")
-        data = students_sheet.get_all_records()
-        preloaded_data['students'] = data
-        return data
+        data = fetch_students()
+        students = publish_snapshot(students=data, base_generations=snapshot.generations).students
+        return students if students is not None else freeze_records(data)
+
+def fetch_students():
+    return db.worksheet("Студенты").get_all_records()
+
+def fetch_schedule(subgroup):
+    return db.worksheet(f"{subgroup} подгруппа").get_all_values()
 
 @retry_google_operation(max_attempts=2, delay=1) 
 def get_schedule_data_optimized(subgroup):
-    cache_key = f'schedule_{subgroup}'
+    snapshot = current_snapshot()
+    rows = snapshot.schedules.get(str(subgroup))
     
     # Проверяем актуальность кэша (10 минут)
-    if (preloaded_data.get(cache_key) is not None and 
-        time.time() - preloaded_data['last_loaded'] < 600):
-        return preloaded_data[cache_key]
+    if rows is not None and snapshot.age(f'schedule_{subgroup}') < 600:
+        return rows
     else:
         logger.info(f"📅 Загрузка расписания подгруппы {subgroup} из Google Sheets")
-        schedule_sheet = db.worksheet(f"{subgroup} подгруппа")
-        data = schedule_sheet.get_all_values()
-        preloaded_data[cache_key] = data
-        preloaded_data['last_loaded'] = time.time()
-        return data
+        return set_schedule_data(subgroup, fetch_schedule(subgroup), base_generations=snapshot.generations)
+
+def set_schedule_data(subgroup, data, touch_loaded_at=True, base_generations=None):
+    """Публикует новое расписание подгруппы (версия повышается в publish_snapshot)"""
+    snapshot = publish_snapshot(schedules={subgroup: data}, touch_loaded_at=touch_loaded_at,
+                                base_generations=base_generations)
+    rows = snapshot.schedules.get(str(subgroup))
+    return rows if rows is not None else freeze_grid(data)
+
+@retry_google_operation(max_attempts=2, delay=1)
+def reload_schedule_data(subgroup):
+    """Перечитывает лист подгруппы, не дожидаясь истечения кэша (блокирующий вызов)"""
+    snapshot = current_snapshot()
+    return set_schedule_data(subgroup, fetch_schedule(subgroup), base_generations=snapshot.generations)
+
+def apply_schedule_edits(subgroup, edits):
+    """Переносит в кэш уже записанные в таблицу ячейки {(номер строки, колонка): значение}
+
+    Лист не перечитывается: новое расписание публикуется через diff, и
+    производные данные обновляются точечно. Если локальной копии нет или
+    строка вне ее, кэш подгруппы просто сбрасывается. Правки попадают в
+    schedule_edit_log, чтобы идущая в это время перезагрузка листа их учла.
+    """
+    name = f'schedule_{subgroup}'
+    with snapshot_publish_lock:
+        before = current_snapshot()
+        rows = before.schedules.get(str(subgroup))
+        grid = apply_cell_edits(rows, edits) if rows is not None else None
+        if grid is None:
+            snapshot = publish_snapshot(invalidate=(name,))
+        else:
+            # Лист не перечитывался - остальные ячейки обновятся по обычному сроку жизни кэша
+            snapshot = publish_snapshot(schedules={subgroup: grid}, touch_loaded_at=False)
+        
+        # В журнал - только если поколение повысила именно эта правка
+        generation = snapshot.generations.get(name, 0)
+        if generation != before.generations.get(name, 0):
+            schedule_edit_log.setdefault(name, deque(maxlen=SCHEDULE_EDIT_LOG_SIZE)).append((generation, dict(edits)))
 
 def get_week_status(user_id, week_string):
     """Получить статус недели для пользователя"""
@@ -345,32 +1296,15 @@ def get_week_status(user_id, week_string):
         return '❓'
     
     student_data = user_data[user_id]
-    subgroup = student_data['subgroup']
-    student_number = student_data['number']
     
     try:
-        schedule_data = get_schedule_data_optimized(subgroup)
-        header = schedule_data[0]
-        
-        # Находим колонку студента
-        student_col = None
-        for idx, cell in enumerate(header):
-            if str(cell).strip() == str(student_number):
-                student_col = idx
-                break
-        
-        if student_col is None:
+        # Сводка по дням строится один раз на версию расписания
+        summary = student_week_summary(student_data['subgroup'], student_data['number'], week_string)
+        if summary is None:
             return '❓'
         
-        total_classes = 0
-        marked_classes = 0
-        
-        # Быстрый подсчет пар
-        for row in schedule_data[1:]:
-            if len(row) > 2 and row[0] == week_string:
-                total_classes += 1
-                if len(row) > student_col and row[student_col].strip() in EMOJI_MAP.values():
-                    marked_classes += 1
+        total_classes = sum(total for total, _ in summary.values())
+        marked_classes = sum(marked for _, marked in summary.values())
         
         if total_classes == 0:
             return '⚫'
@@ -390,35 +1324,24 @@ def update_cache():
     try:
         logger.info("🔄 Начало полного обновления кеша...")
         
-        # 1. ПОЛНОСТЬЮ сбрасываем предзагруженные данные
-        preloaded_data['students'] = None
-        preloaded_data['schedule_1'] = None  
-        preloaded_data['schedule_2'] = None
-        preloaded_data['blacklist'] = None
-        preloaded_data['last_loaded'] = 0
-        
-        # 2. Обновляем черный список
-        old_blacklist_count = len(cache['blacklist'])
-        new_blacklist = get_blacklist_data(force_refresh=True)
-        cache['blacklist'] = new_blacklist
-        new_blacklist_count = len(new_blacklist)
-        
-        # 3. Очищаем кеш недель
-        old_week_strings_count = len(cache['week_strings'])
-        cache['week_strings'] = {}
+        base_snapshot = current_snapshot()
+        old_blacklist_count = len(base_snapshot.blacklist)
         
-        # 4. ПРИНУДИТЕЛЬНО загружаем свежие данные расписания
+        # 1. ПРИНУДИТЕЛЬНО загружаем свежие данные (старый снимок пока обслуживает читателей)
         logger.info("🔄 Принудительная перезагрузка расписания...")
-        students_data = get_students_data_optimized()
-        schedule_1_data = get_schedule_data_optimized(1)
-        schedule_2_data = get_schedule_data_optimized(2)
-        
-        # 5. Обновляем preloaded_data с новым временем
-        preloaded_data['students'] = students_data
-        preloaded_data['schedule_1'] = schedule_1_data
-        preloaded_data['schedule_2'] = schedule_2_data  
-        preloaded_data['blacklist'] = new_blacklist
-        preloaded_data['last_loaded'] = time.time()
+        new_blacklist = fetch_blacklist()
+        students_data = fetch_students()
+        schedule_1_data = fetch_schedule(1)
+        schedule_2_data = fetch_schedule(2)
+        
+        # 2. Публикуем все сразу одним снимком
+        publish_snapshot(
+            students=students_data,
+            schedules={1: schedule_1_data, 2: schedule_2_data},
+            blacklist=new_blacklist,
+            base_generations=base_snapshot.generations
+        )
+        new_blacklist_count = len(new_blacklist)
         
         students_count = len(students_data) if students_data else 0
         schedule1_count = len(schedule_1_data) if schedule_1_data else 0
@@ -439,111 +1362,539 @@ def update_cache():
             "info"
         )
         
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка полного обновления кеша: {e}")
-        send_log_to_server(f"❌ Ошибка полного обновления кеша: {e}", "cache_error", "error")
-        return False
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка полного обновления кеша: {e}")
+        send_log_to_server(f"❌ Ошибка полного обновления кеша: {e}", "cache_error", "error")
+        return False
+
+# RATE LIMITER 
+class SmartRateLimiter:
+    """Умный ограничитель для активных пользователей бота (GCRA)
+
+    На пользователя хранится теоретическое время следующего запроса (TAT)
+    и время последнего разрешенного. Сразу можно сделать max_requests
+    запросов, дальше - один раз в period / max_requests секунд. Еще
+    burst_allowance запросов сверх лимита разрешаются, если между ними
+    не меньше 0.5 секунды. Проверка не ждет на await, поэтому атомарна без
+    блокировок; записи восстановившихся пользователей удаляются лениво.
+    """
+    
+    def __init__(self, max_requests=50, period=60, burst_allowance=10):
+        self.requests = {}  # user_id -> (TAT, время последнего разрешенного запроса)
+        self.max_requests = max_requests
+        self.period = period
+        self.burst_allowance = burst_allowance
+        self.interval = period / max_requests
+        self.tolerance = (max_requests - 1) * self.interval
+        self.burst_tolerance = self.tolerance + burst_allowance * self.interval
+    
+    def expire_idle(self, now, limit=2):
+        """Удаляет несколько самых давних записей, если лимит уже восстановился"""
+        for _ in range(limit):
+            oldest = next(iter(self.requests), None)
+            if oldest is None or self.requests[oldest][0] > now:
+                return
+            del self.requests[oldest]
+    
+    async def is_allowed(self, user_id):
+        now = time.time()
+        tat, last = self.requests.pop(user_id, (now, 0.0))
+        tat = max(tat, now)
+        backlog = tat - now
+        
+        allowed = backlog <= self.tolerance or (backlog <= self.burst_tolerance and now - last >= 0.5)
+        if allowed:
+            tat += self.interval
+            last = now
+        
+        # Переставляем в конец: в начале словаря остаются самые давние пользователи
+        self.requests[user_id] = (tat, last)
+        self.expire_idle(now)
+        return allowed
+    
+    async def get_wait_time(self, user_id):
+        """Время до освобождения слота"""
+        if user_id not in self.requests:
+            return 0
+        tat, last = self.requests[user_id]
+        return max(0, tat - self.tolerance - time.time())
+
+# Инициализация rate limiters
+button_limiter = SmartRateLimiter(
+    max_requests=60,      # 60 запросов в минуту
+    period=60,            # период 60 секунд  
+    burst_allowance=15    # разрешить 15 быстрых запросов подряд
+)
+
+message_limiter = SmartRateLimiter(
+    max_requests=20,      # 20 сообщений в минуту
+    period=60,
+    burst_allowance=5     # 5 быстрых сообщений подряд
+)
+
+# FLOOD CONTROL TELEGRAM
+class TelegramFloodControl:
+    """Темп исходящих отправок под лимиты Telegram: глобальный и на один чат
+
+    Интерактивные запросы (ответы на нажатия) идут вне очереди: фоновые
+    ждут, пока есть ожидающие интерактивные, и дополнительно соблюдают
+    интервал на чат.
+    """
+    
+    def __init__(self, global_rate=25, per_chat_interval=1.0):
+        self.global_interval = 1.0 / global_rate
+        self.per_chat_interval = per_chat_interval
+        self.next_global_slot = 0.0
+        self.next_chat_slot = {}
+        self.paused_until = 0.0
+        self.interactive_waiting = 0
+    
+    async def acquire(self, chat_id, background=True):
+        """Ждет, пока можно отправить сообщение в chat_id, и резервирует слот"""
+        if not background:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                slot = max(self.next_global_slot, self.paused_until)
+                if background:
+                    slot = max(slot, self.next_chat_slot.get(chat_id, 0.0))
+                    # Уступаем слот ответам пользователям
+                    if self.interactive_waiting and slot <= now:
+                        slot = now + self.global_interval
+                if slot <= now:
+                    self.next_global_slot = now + self.global_interval
+                    self.next_chat_slot[chat_id] = now + self.per_chat_interval
+                    if len(self.next_chat_slot) > 10000:
+                        self.next_chat_slot = {cid: t for cid, t in self.next_chat_slot.items() if t > now}
+                    return
+                await asyncio.sleep(slot - now)
+        finally:
+            if not background:
+                self.interactive_waiting -= 1
+    
+    async def wait_pause(self):
+        """Ждет окончания паузы после RetryAfter (для запросов без лимита сообщений)"""
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    def pause(self, seconds):
+        """Останавливает все отправки на seconds (после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def get_retry_after_seconds(error):
+    """Секунды ожидания из RetryAfter (int в PTB 21, timedelta в новых версиях)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class TelegramOutbox(BaseRateLimiter):
+    """Единая точка выхода всех запросов к Bot API
+
+    Подключается через Application.builder().rate_limiter(), поэтому через
+    нее проходят все вызовы бота (кроме getUpdates). Отправки и правки
+    сообщений идут в темпе TelegramFloodControl, после RetryAfter все
+    запросы ждут и повторяются. Фоновые вызовы помечаются
+    rate_limit_args={'priority': 'background'}; если передан еще и
+    'counters' (словарь), в него добавляются повторы именно этих вызовов.
+    """
+    
+    # Методы, на которые действуют лимиты сообщений Telegram
+    MESSAGE_ENDPOINTS = frozenset({
+        'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument',
+        'sendPhoto', 'forwardMessage', 'copyMessage', 'deleteMessage',
+    })
+    
+    def __init__(self, flood_control, background_max_attempts=3, interactive_max_wait=5.0):
+        self.flood_control = flood_control
+        self.background_max_attempts = background_max_attempts
+        self.interactive_max_wait = interactive_max_wait
+        self.requests = {'interactive': 0, 'background': 0}
+        self.retries = 0
+        self.rate_limited = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        background = rate_limit_args.get('priority') == 'background'
+        counters = rate_limit_args.get('counters')
+        self.requests['background' if background else 'interactive'] += 1
+        max_attempts = self.background_max_attempts if background else 2
+        chat_id = data.get('chat_id')
+        
+        for attempt in range(1, max_attempts + 1):
+            if endpoint in self.MESSAGE_ENDPOINTS and chat_id is not None:
+                await self.flood_control.acquire(chat_id, background=background)
+            else:
+                await self.flood_control.wait_pause()
+            
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = get_retry_after_seconds(e)
+                # 429 действует на весь бот - притормаживаем все отправки
+                self.flood_control.pause(delay)
+                self.rate_limited += 1
+                logger.warning(f"⏳ RetryAfter {delay:.0f}с на {endpoint}, попытка {attempt}/{max_attempts}")
+                # Пользователь не будет ждать долго - отдаем ошибку обработчику
+                if attempt == max_attempts or (not background and delay > self.interactive_max_wait):
+                    raise
+                self.retries += 1
+                if counters is not None:
+                    counters['retries'] = counters.get('retries', 0) + 1
+    
+    def format_metrics(self):
+        return (f"• Исходящие запросы: {self.requests['interactive']} интерактивных, "
+                f"{self.requests['background']} фоновых, 429: {self.rate_limited}, повторов {self.retries}\n")
+
+telegram_flood_control = TelegramFloodControl(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    per_chat_interval=TELEGRAM_PER_CHAT_INTERVAL
+)
+
+telegram_outbox = TelegramOutbox(
+    telegram_flood_control,
+    background_max_attempts=REMINDER_MAX_ATTEMPTS,
+    interactive_max_wait=TELEGRAM_INTERACTIVE_MAX_WAIT
+)
+
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ
+class AdmissionController:
+    """Допуск обновлений к обработке по приоритету
+
+    Свободный слот получает самый приоритетный ожидающий (внутри класса -
+    по очереди). Очередь каждого класса ограничена: сверх лимита обновление
+    не принимается, а пользователь получает оценку, когда повторить.
+    """
+    PRIORITIES = ('admin', 'save', 'view', 'settings')
+    
+    def __init__(self, slots, queue_limits):
+        self.slots = slots
+        self.busy = 0
+        self.queue_limits = queue_limits
+        self.waiters = {priority: deque() for priority in self.PRIORITIES}
+        self.pending = {priority: 0 for priority in self.PRIORITIES}
+        self.shed = {priority: 0 for priority in self.PRIORITIES}
+        self.avg_service_time = 0.5  # скользящее среднее времени обработки, сек
+    
+    def admit(self, priority):
+        """Принимает обновление в очередь; False - очередь класса переполнена"""
+        if self.pending[priority] >= self.queue_limits.get(priority, 100):
+            self.shed[priority] += 1
+            return False
+        self.pending[priority] += 1
+        return True
+    
+    def leave(self, priority):
+        self.pending[priority] -= 1
+    
+    async def acquire(self, priority):
+        """Ждет слот обработки"""
+        rank = self.PRIORITIES.index(priority)
+        ahead = any(self.waiters[p] for p in self.PRIORITIES[:rank + 1])
+        if self.busy < self.slots and not ahead:
+            self.busy += 1
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам - отдаем следующему
+                self.release(None)
+            else:
+                self.waiters[priority].remove(waiter)
+            raise
+    
+    def release(self, service_time):
+        """Освобождает слот и передает его самому приоритетному ожидающему"""
+        if service_time is not None:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * service_time
+        for priority in self.PRIORITIES:
+            waiters = self.waiters[priority]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.busy -= 1
+    
+    def retry_after(self, priority):
+        """Оценка в секундах, когда очередь класса освободится"""
+        rank = self.PRIORITIES.index(priority)
+        ahead = sum(self.pending[p] for p in self.PRIORITIES[:rank + 1])
+        return max(1, math.ceil(ahead * self.avg_service_time / self.slots))
+    
+    def format_metrics(self):
+        queues = ", ".join(f"{p} {self.pending[p]}/{self.queue_limits.get(p, 100)}" for p in self.PRIORITIES)
+        shed = sum(self.shed.values())
+        return (f"• Очереди: {queues}\n"
+                f"• Отклонено при перегрузке: {shed}, ср. обработка {self.avg_service_time:.2f}с\n")
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей
+
+    Обновления одного пользователя выполняются строго по очереди (двойное
+    нажатие не гоняется за черновиком отметок), разные
+    пользователи - параллельно, не больше max_concurrent_updates одновременно.
+    Слоты раздает AdmissionController: admin > save > view > settings.
+    Обновление сначала ждет своей очереди у пользователя и только потом
+    занимает общий слот, поэтому частые нажатия одного пользователя не
+    держат слоты, нужные остальным. В очереди классов попадает только
+    очередное обновление пользователя, а его собственная очередь ограничена
+    user_queue_limit - серия нажатий одного пользователя не вытесняет других.
+    """
+    
+    def __init__(self, max_concurrent_updates, queue_limits, user_queue_limit):
+        super().__init__(max_concurrent_updates)
+        self.admission = AdmissionController(max_concurrent_updates, queue_limits)
+        self.user_queue_limit = user_queue_limit
+        self.user_shed = 0
+        self.user_locks = {}
+        self.user_pending = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.processed = 0
+    
+    @staticmethod
+    def get_update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    @staticmethod
+    def get_update_priority(update):
+        if not isinstance(update, Update):
+            return 'view'
+        if update.effective_user and update.effective_user.id == ADMIN_ID:
+            return 'admin'
+        if update.callback_query and update.callback_query.data:
+            return callback_router.priority_of(update.callback_query.data)
+        return 'view'
+    
+    async def reject_update(self, update, coroutine, priority, retry_after=None, reason=None):
+        """Отвечает пользователю, что бот перегружен, не выполняя обработчик"""
+        coroutine.close()
+        if retry_after is None:
+            retry_after = self.admission.retry_after(priority)
+        text = f"⏳ Бот сейчас перегружен. Попробуйте через {retry_after} сек."
+        reason = reason or f"очередь класса {priority}"
+        logger.warning(f"🚦 Перегрузка: отклонено обновление ({reason}), повтор через {retry_after}с")
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сообщить о перегрузке: {e}")
+    
+    async def run_admitted(self, update, coroutine, priority):
+        """Допуск в очередь класса, ожидание слота и обработка"""
+        if not self.admission.admit(priority):
+            await self.reject_update(update, coroutine, priority)
+            return
+        try:
+            await self.admission.acquire(priority)
+            self.in_flight += 1
+            start_time = time.monotonic()
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+                self.admission.release(time.monotonic() - start_time)
+        finally:
+            self.admission.leave(priority)
+    
+    async def process_update(self, update, coroutine):
+        # Семафор базового класса берется до do_process_update - тогда ожидание
+        # очереди пользователя занимало бы общий слот. Слот берет run_admitted.
+        await self.do_process_update(update, coroutine)
+    
+    async def do_process_update(self, update, coroutine):
+        # Каждое обновление бесплатно освежает кэш профилей
+        if isinstance(update, Update) and update.effective_user:
+            remember_user_profile(update.effective_user)
+        
+        priority = self.get_update_priority(update)
+        key = self.get_update_key(update)
+        if key is None:
+            await self.run_admitted(update, coroutine, priority)
+            return
+        
+        # Лимит очереди одного пользователя - до допуска в очереди классов
+        pending = self.user_pending.get(key, 0)
+        if pending >= self.user_queue_limit:
+            self.user_shed += 1
+            retry_after = max(1, math.ceil(pending * self.admission.avg_service_time))
+            await self.reject_update(update, coroutine, priority, retry_after, f"очередь пользователя {key}")
+            return
+        
+        lock = self.user_locks.get(key)
+        if lock is None:
+            lock = self.user_locks[key] = asyncio.Lock()
+        self.user_pending[key] = pending + 1
+        
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            async with lock:
+                self.waiting -= 1
+                # В лимит класса засчитывается только очередное обновление пользователя
+                await self.run_admitted(update, coroutine, priority)
+        finally:
+            # Лок без ожидающих больше не нужен
+            self.user_pending[key] -= 1
+            if not self.user_pending[key]:
+                del self.user_pending[key]
+                del self.user_locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def format_metrics(self, application=None):
+        text = (f"• Параллельно: {self.in_flight}/{self.admission.slots}\n"
+                f"• Ждут своей очереди: {self.waiting} (макс. {self.max_waiting}), "
+                f"отклонено по лимиту пользователя: {self.user_shed}\n"
+                f"• Обработано: {self.processed}\n")
+        text += self.admission.format_metrics()
+        if application is not None:
+            text += f"• Очередь обновлений: {application.update_queue.qsize()}\n"
+        return text
 
-# RATE LIMITER 
-class SmartRateLimiter:
-    """Умный ограничитель для активных пользователей бота"""
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMITS, UPDATE_USER_QUEUE_LIMIT)
+
+# ПЛАНИРОВЩИК ФОНОВЫХ ЗАДАЧ
+class ScheduledJob:
+    """Периодическая задача планировщика и ее метрики"""
     
-    def __init__(self, max_requests=50, period=60, burst_allowance=10):
-        self.requests = {}
-        self.max_requests = max_requests
-        self.period = period
-        self.burst_allowance = burst_allowance
-        self.lock = asyncio.Lock()
+    def __init__(self, name, func, interval, catch_up=False, max_catch_up=5, jitter=0.0):
+        self.name = name
+        self.func = func              # async func(tick_time) - tick_time: плановое время (epoch)
+        self.interval = interval      # секунды; тики выровнены по границам настенного времени
+        self.catch_up = catch_up      # выполнять ли пропущенные тики
+        self.max_catch_up = max_catch_up
+        self.jitter = jitter          # случайная задержка запуска (для задач обновления)
+        self.runs = 0
+        self.failures = 0
+        self.caught_up = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_run_at = None
+
+class BackgroundScheduler:
+    """Планировщик фоновых задач без дрейфа: тики по границам минут/часов"""
     
-    async def is_allowed(self, user_id):
-        async with self.lock:
-            now = time.time()
-            
-            if user_id not in self.requests:
-                self.requests[user_id] = deque(maxlen=self.max_requests + self.burst_allowance)
+    def __init__(self):
+        self.jobs = {}
+        self.tasks = []
+    
+    def add_job(self, name, func, interval, **kwargs):
+        self.jobs[name] = ScheduledJob(name, func, interval, **kwargs)
+        return self.jobs[name]
+    
+    def start(self):
+        for job in self.jobs.values():
+            self.tasks.append(asyncio.create_task(self.run_job(job), name=f"job:{job.name}"))
+        logger.info(f"⏰ Планировщик запущен: {', '.join(self.jobs)}")
+    
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        logger.info("⏰ Планировщик остановлен")
+    
+    async def run_job(self, job):
+        next_tick = (time.time() // job.interval + 1) * job.interval
+        jitter = random.uniform(0, job.jitter) if job.jitter else 0.0
+        while True:
+            delay = next_tick + jitter - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # sleep может проснуться чуть раньше - перепроверяем
             
-            user_requests = self.requests[user_id]
+            # Все наступившие тики (больше одного - если цикл был заблокирован)
+            now = time.time()
+            due = []
+            while next_tick <= now:
+                due.append(next_tick)
+                next_tick += job.interval
+            jitter = random.uniform(0, job.jitter) if job.jitter else 0.0
             
-            # Удаляем старые запросы (старше периода)
-            while user_requests and now - user_requests[0] > self.period:
-                user_requests.popleft()
+            limit = job.max_catch_up if job.catch_up else 1
+            if len(due) > limit:
+                job.skipped += len(due) - limit
+                due = due[-limit:]
+            job.caught_up += len(due) - 1
             
-            # Проверяем лимит
-            if len(user_requests) < self.max_requests:
-                user_requests.append(now)
-                return True
-            elif len(user_requests) < self.max_requests + self.burst_allowance:
-                if user_requests and now - user_requests[-1] < 0.5:
-                    return False
-                else:
-                    user_requests.append(now)
-                    return True
-            else:
-                return False
+            for tick_time in due:
+                await self.execute(job, tick_time)
     
-    async def get_wait_time(self, user_id):
-        """Время до освобождения слота"""
-        async with self.lock:
-            if user_id in self.requests and self.requests[user_id]:
-                oldest_request = self.requests[user_id][0]
-                return max(0, self.period - (time.time() - oldest_request))
-            return 0
+    async def execute(self, job, tick_time):
+        job.last_lag = max(0.0, time.time() - tick_time)
+        job.max_lag = max(job.max_lag, job.last_lag)
+        start_time = time.monotonic()
+        try:
+            await job.func(tick_time)
+        except Exception as e:
+            job.failures += 1
+            logger.error(f"❌ Ошибка фоновой задачи {job.name}: {e}")
+            send_log_to_server(f"❌ Ошибка фоновой задачи {job.name}: {e}", "scheduler_error", "error")
+        finally:
+            job.runs += 1
+            job.last_duration = time.monotonic() - start_time
+            job.max_duration = max(job.max_duration, job.last_duration)
+            job.last_run_at = time.time()
     
-    async def cleanup_old_users(self, max_age=3600):
-        """Очистка неактивных пользователей (раз в час)"""
-        async with self.lock:
-            now = time.time()
-            to_remove = []
-            for user_id, requests in self.requests.items():
-                if not requests or now - requests[-1] > max_age:
-                    to_remove.append(user_id)
-            
-            for user_id in to_remove:
-                del self.requests[user_id]
-
-# Инициализация rate limiters
-button_limiter = SmartRateLimiter(
-    max_requests=60,      # 60 запросов в минуту
-    period=60,            # период 60 секунд  
-    burst_allowance=15    # разрешить 15 быстрых запросов подряд
-)
+    def format_metrics(self):
+        lines = []
+        for job in self.jobs.values():
+            lines.append(
+                f"• {job.name}: {job.runs} запусков, {job.failures} ошибок, "
+                f"время {job.last_duration:.2f}/{job.max_duration:.2f}с, "
+                f"лаг {job.last_lag:.2f}/{job.max_lag:.2f}с, "
+                f"догнано {job.caught_up}, пропущено {job.skipped}\n"
+            )
+        return "".join(lines)
 
-message_limiter = SmartRateLimiter(
-    max_requests=20,      # 20 сообщений в минуту
-    period=60,
-    burst_allowance=5     # 5 быстрых сообщений подряд
-)
+background_scheduler = BackgroundScheduler()
 
 # Функции  
-async def background_cleanup():     
-    """Фоновая очистка старых записей rate limiter"""
-    while True:
-        await asyncio.sleep(3600)  # Каждый час
-        await button_limiter.cleanup_old_users()
-        await message_limiter.cleanup_old_users()
-        logger.info("🧹 Очистка старых записей rate limiter")
-        send_log_to_server("🧹 Очистка старых записей rate limiter", "cleanup", "info")
-
-async def background_blacklist_update():
-    """Фоновая задача для периодического обновления черного списка"""
-    while True:
-        await asyncio.sleep(300)  # Обновляем каждые 5 минут
-        try:
-            old_count = len(cache['blacklist'])
+async def background_blacklist_update(tick_time=None):
+    """Фоновая задача для периодического обновления черного списка (каждые 5 минут)"""
+    try:
+        old_count = len(current_snapshot().blacklist)
 
-            new_blacklist = get_blacklist_data()
-            
-            cache['blacklist'] = new_blacklist
-            preloaded_data['blacklist'] = new_blacklist
-            new_count = len(new_blacklist)
+        new_blacklist = get_blacklist_data()
+        new_count = len(new_blacklist)
+        
+        if old_count != new_count:
+            logger.info(f"🔄 Черный список обновлен: было {old_count}, стало {new_count} записей")
+            send_log_to_server(f"🔄 Черный список обновлен: {old_count} → {new_count} записей", "blacklist_update", "info")
             
-            if old_count != new_count:
-                logger.info(f"🔄 Черный список обновлен: было {old_count}, стало {new_count} записей")
-                send_log_to_server(f"🔄 Черный список обновлен: {old_count} → {new_count} записей", "blacklist_update", "info")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка обновления черного списка: {e}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления черного списка: {e}")
 
 @check_blacklist
 @log_execution_time("start")
@@ -554,36 +1905,41 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     send_log_to_server(f"🟢 /start от {user_id} (@{username})", "command")
     
     try:
-        students_data = get_students_data_optimized()
+        stored = user_data.get(user_id) if user_states.get(user_id) == "registered" else None
+        try:
+            # Индекс студентов кэширован - сверка сессии с таблицей бесплатна
+            student = students_by_telegram_id().get(user_id)
+        except Exception as e:
+            if stored is None:
+                raise
+            # Таблица недоступна - узнаем пользователя по сохраненной сессии
+            logger.warning(f"⚠️ /start {user_id}: список студентов недоступен ({e}), вход по сессии")
+            log_user_action(user_id, username, "Автоматический вход", "ФИО: {fio} (сессия)", fio=stored['fio'])
+            await update.message.reply_text(
+                f"✅ С возвращением, {stored['fio']}!\nПодгруппа: {stored['subgroup']}",
+                reply_markup=build_main_menu_markup(user_id)
+            )
+            return
 
-        user_found = False
+        user_found = student is not None
         student_data = None
         
-        for student in students_data:
-            existing_id = str(student.get('Telegram ID', '')).strip()
-            if existing_id and existing_id.isdigit() and int(existing_id) == user_id:
-                user_found = True
-                student_data = {
-                    'fio': student['ФИО'],
-                    'number': student['№'],
-                    'subgroup': student['Подгруппа']
-                }
-                break
+        if user_found:
+            student_data = student_session_data(student)
+        elif user_id in user_data:
+            # Telegram ID убран из таблицы или передан другому - сессия больше не действительна
+            del user_data[user_id]
+            log_user_action(user_id, username, "Сессия сброшена", "нет в списке студентов", "warning")
         
         if user_found:
-            user_data[user_id] = student_data
-            user_states[user_id] = "registered"
-            log_user_action(user_id, username, "Автоматический вход", f"ФИО: {student_data['fio']}")
+            # Пишем в БД сессий только если данные в таблице изменились (ФИО, номер, подгруппа)
+            if student_data != stored:
+                user_data[user_id] = student_data
+                user_states[user_id] = "registered"
+            log_user_action(user_id, username, "Автоматический вход", "ФИО: {fio}", fio=student_data['fio'])
             
             # ОБНОВЛЕННОЕ ГЛАВНОЕ МЕНЮ
-            keyboard = [
-                [InlineKeyboardButton("📝 Отметиться", callback_data="mark_attendance")],
-                [InlineKeyboardButton("⚙️ Настройки", callback_data="settings_menu")]  # ДОБАВЛЕНА КНОПКА НАСТРОЕК
-            ]
-            if user_id == ADMIN_ID:
-                keyboard.append([InlineKeyboardButton("🛠️ Админ-панель", callback_data="admin_panel")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = build_main_menu_markup(user_id)
             await update.message.reply_text(
                 f"✅ С возвращением, {student_data['fio']}!\nПодгруппа: {student_data['subgroup']}",
                 reply_markup=reply_markup
@@ -604,6 +1960,17 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
     username = update.effective_user.username or "Без username"
     text = update.message.text
     
+    # Проверка RATE LIMIT
+    if user_id != ADMIN_ID and not await message_limiter.is_allowed(user_id):
+        wait_time = await message_limiter.get_wait_time(user_id)
+        log_user_action(user_id, username, "ПРЕВЫШЕНИЕ ЛИМИТА СООБЩЕНИЙ",
+                        "ожидание: {wait:.0f}сек", "warning", wait=wait_time)
+        await update.message.reply_text(
+            f"⏳ Слишком много сообщений.\n"
+            f"Подождите {math.ceil(wait_time)} секунд перед следующим сообщением."
+        )
+        return
+    
     if user_states.get(user_id) == "waiting_for_fio":
         await handle_fio(update, context)
     else:
@@ -621,7 +1988,7 @@ async def handle_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or "Без username"
     
-    log_user_action(user_id, username, "Поиск ФИО", f"'{fio}'")
+    log_user_action(user_id, username, "Поиск ФИО", "'{fio}'", fio=fio)
     
     try:
         students_data = get_students_data_optimized()
@@ -634,7 +2001,7 @@ async def handle_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if student['ФИО'].lower() == fio.lower():
                 existing_id = str(student.get('Telegram ID', '')).strip()
                 if existing_id and existing_id.isdigit() and int(existing_id) != user_id:
-                    log_user_action(user_id, username, "Попытка повторной регистрации", f"ФИО: '{fio}'")
+                    log_user_action(user_id, username, "Попытка повторной регистрации", "ФИО: '{fio}'", fio=fio)
                     await update.message.reply_text("❌ Этот аккаунт уже зарегистрирован на другого пользователя!")
                     return
                 else:
@@ -644,7 +2011,7 @@ async def handle_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     break
         
         if not user_found:
-            log_user_action(user_id, username, "ФИО не найдено", f"'{fio}'")
+            log_user_action(user_id, username, "ФИО не найдено", "'{fio}'", fio=fio)
             await update.message.reply_text("❌ ФИО не найдено в базе! Обратитесь к администратору.")
             return
         
@@ -652,6 +2019,8 @@ async def handle_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         students_sheet = db.worksheet("Студенты")
         cell = students_sheet.find(str(student_number))
         students_sheet.update_cell(cell.row, 4, str(user_id))
+        # Список студентов изменился - индекс по Telegram ID перестроится при следующем обращении
+        publish_snapshot(invalidate=('students',))
         
         user_data[user_id] = {
             'fio': fio,
@@ -660,17 +2029,10 @@ async def handle_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
         user_states[user_id] = "registered"
         
-        log_user_action(user_id, username, "Регистрация успешна", f"№{student_number}, подгруппа {subgroup}")
+        log_user_action(user_id, username, "Регистрация успешна", "№{student_number}, подгруппа {subgroup}",
+                        student_number=student_number, subgroup=subgroup)
         send_log_to_server(f"✅ Регистрация: {user_id} -> {fio}", "registration")
-        keyboard = [
-            [InlineKeyboardButton("📝 Отметиться", callback_data="mark_attendance")],
-            [InlineKeyboardButton("⚙️ Настройки", callback_data="settings_menu")]
-        ]
-        
-        if user_id == ADMIN_ID:
-            keyboard.append([InlineKeyboardButton("🛠️ Админ-панель", callback_data="admin_panel")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = build_main_menu_markup(user_id)
         await update.message.reply_text(
             f"✅ Регистрация успешна!\nФИО: {fio}\nПодгруппа: {subgroup}",
             reply_markup=reply_markup
@@ -695,16 +2057,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     log_user_action(user_id, username, "Открытие админ-панели")
     
-    keyboard = [
-        [InlineKeyboardButton("👥 Список студентов", callback_data="admin_students")],
-        [InlineKeyboardButton("🖥️ Статус сервера", callback_data="admin_status")],
-        [InlineKeyboardButton("📊 Наличие пар", callback_data="admin_class_presence")],
-        [InlineKeyboardButton("⚫ Черный список", callback_data="admin_blacklist")],
-        [InlineKeyboardButton("🔄 Обновить кэш", callback_data="admin_refresh_cache")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = build_admin_panel_markup()
     await update.message.reply_text("🛠️ Админ-панель:", reply_markup=reply_markup)
 
 async def admin_show_students(query):
@@ -726,25 +2079,25 @@ async def admin_show_students(query):
         keyboard = [[InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="admin_panel")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await edit_message(query, text, reply_markup=reply_markup)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при получении списка студентов: {e}")
-        await query.edit_message_text(f"❌ Ошибка: {e}")
+        await edit_message(query, f"❌ Ошибка: {e}")
 
-async def admin_show_status(query):
+async def admin_show_status(query, context=None):
     """Статус сервера с системной информацией"""
     user_id = query.from_user.id
     username = query.from_user.username or "Без username"
     
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     log_user_action(user_id, username, "Запрос статуса сервера")
     
     try:
-        await query.edit_message_text("📊 Сбор данных о системе...")
+        await edit_message(query, "📊 Сбор данных о системе...")
         
         # 1. СТАТУС ПОДКЛЮЧЕНИЙ
         connections_status = "**🔗 СТАТУС ПОДКЛЮЧЕНИЙ**\n"
@@ -766,32 +2119,41 @@ async def admin_show_status(query):
         
         # 2. СТАТИСТИКА БОТА
         bot_stats = "\n**🤖 СТАТИСТИКА БОТА**\n"
-        bot_stats += f"• Пользователей: {len(user_data)}\n"
-        bot_stats += f"• Активных сессий: {len(user_states)}\n"
+        # COUNT по таблице сессий - в пуле потоков
+        loop = asyncio.get_running_loop()
+        users_count = await loop.run_in_executor(None, len, user_data)
+        sessions_count = await loop.run_in_executor(None, len, user_states)
+        bot_stats += f"• Пользователей: {users_count} ({user_data.format_metrics()})\n"
+        bot_stats += f"• Активных сессий: {sessions_count}\n"
         
-        # Статистика по состояниям
-        state_counts = {}
-        for state in user_states.values():
-            state_counts[state] = state_counts.get(state, 0) + 1
+        # Статистика по состояниям - GROUP BY в пуле потоков
+        state_counts = await loop.run_in_executor(None, user_states.value_counts)
         
         for state, count in state_counts.items():
             bot_stats += f"• {state}: {count}\n"
         
         # 3. КЭШ И ПРОИЗВОДИТЕЛЬНОСТЬ
         cache_info = "\n**💾 КЭШ ДАННЫХ**\n"
-        if preloaded_data['last_loaded'] > 0:
-            cache_age = time.time() - preloaded_data['last_loaded']
+        snapshot = current_snapshot()
+        if snapshot.loaded_at:
+            # Возраст самого старого из загруженных наборов
+            cache_age = time.time() - min(snapshot.loaded_at.values())
             cache_minutes = int(cache_age // 60)
             cache_seconds = int(cache_age % 60)
-            cache_info += f"• Возраст: {cache_minutes}м {cache_seconds}с\n"
+            cache_info += f"• Возраст: {cache_minutes}м {cache_seconds}с (снимок v{snapshot.version})\n"
             
-            students_cached = len(preloaded_data.get('students', []))
-            schedule1_cached = len(preloaded_data.get('schedule_1', []))
-            schedule2_cached = len(preloaded_data.get('schedule_2', []))
+            students_cached = len(snapshot.students or ())
+            schedule1_cached = len(snapshot.schedules.get('1', ()))
+            schedule2_cached = len(snapshot.schedules.get('2', ()))
             
             cache_info += f"• Студентов: {students_cached}\n"
             cache_info += f"• Расписание 1: {schedule1_cached} строк\n"
             cache_info += f"• Расписание 2: {schedule2_cached} строк\n"
+            cache_info += (f"• Перезагрузки листов: {schedule_diff_stats['reloads']} "
+                           f"(без изменений {schedule_diff_stats['unchanged']}, "
+                           f"точечно {schedule_diff_stats['incremental']} / {schedule_diff_stats['cells']} ячеек, "
+                           f"полностью {schedule_diff_stats['structural']}, "
+                           f"дополнено правками {schedule_diff_stats['replayed']})\n")
             
             if cache_age > 600:
                 cache_info += "⚠️ **Кэш устарел** (>10 минут)\n"
@@ -803,11 +2165,31 @@ async def admin_show_status(query):
         # 4. RATE LIMITER
         rate_info = "\n**🚦 RATE LIMITING**\n"
         try:
-            rate_info += f"• Отслеживается: {len(button_limiter.requests)} пользователей\n"
+            rate_info += f"• Отслеживается: {len(button_limiter.requests)} пользователей (кнопки), "
+            rate_info += f"{len(message_limiter.requests)} (сообщения)\n"
         except:
             rate_info += "• Статистика недоступна\n"
         
-        # 5. СИСТЕМНАЯ ИНФОРМАЦИЯ (ТЕКУЩИЕ ЗНАЧЕНИЯ)
+        # 5. ОБРАБОТКА ОБНОВЛЕНИЙ
+        updates_info = "\n**⚡ ОБРАБОТКА ОБНОВЛЕНИЙ**\n"
+        updates_info += update_processor.format_metrics(context.application if context else None)
+        
+        updates_info += callback_router.format_metrics()
+        updates_info += callback_deduplicator.format_metrics()
+        updates_info += drafts.format_metrics()
+        updates_info += render_cache.format_metrics()
+        updates_info += derived_data.format_metrics()
+        updates_info += telegram_outbox.format_metrics()
+        updates_info += (f"• Профили: {len(user_profiles)} в кэше, попаданий {profile_stats['cache_hits']}, "
+                         f"запросов get_chat {profile_stats['fetched']}, ошибок {profile_stats['failed']}\n")
+        updates_info += (f"• Редактирования: отправлено {edit_stats['sent']}, "
+                         f"только клавиатура {edit_stats['markup_only']}, пропущено {edit_stats['skipped']}\n")
+        
+        # 6. ФОНОВЫЕ ЗАДАЧИ (время выполнения и лаг: последнее/максимум)
+        jobs_info = "\n**⏰ ФОНОВЫЕ ЗАДАЧИ**\n"
+        jobs_info += background_scheduler.format_metrics() or "• Не запущены\n"
+        
+        # 7. СИСТЕМНАЯ ИНФОРМАЦИЯ (ТЕКУЩИЕ ЗНАЧЕНИЯ)
         system_info = "\n**💻 СИСТЕМНАЯ ИНФОРМАЦИЯ**\n"
         try:
             # Процессор
@@ -830,20 +2212,22 @@ async def admin_show_status(query):
         except Exception as e:
             system_info += f"• Ошибка: {str(e)[:50]}\n"
         
-        # 6. ОБЩИЙ СТАТУС
+        # 8. ОБЩИЙ СТАТУС
         status_text = (
             "**🖥️ СТАТУС СИСТЕМЫ**\n\n"
             f"{connections_status}"
             f"{bot_stats}" 
             f"{cache_info}"
             f"{rate_info}"
+            f"{updates_info}"
+            f"{jobs_info}"
             f"{system_info}"
         )
         
         keyboard = [[InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="admin_panel")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(status_text, parse_mode='Markdown', reply_markup=reply_markup)
+        await edit_message(query, status_text, parse_mode='Markdown', reply_markup=reply_markup)
         
     except Exception as e:
         error_text = f"❌ Ошибка при получении статуса: {str(e)}"
@@ -852,13 +2236,13 @@ async def admin_show_status(query):
         keyboard = [[InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="admin_panel")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(error_text, reply_markup=reply_markup)
+        await edit_message(query, error_text, reply_markup=reply_markup)
 
 async def admin_class_presence(query):
     """Меню управления наличием пар"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     keyboard = [
@@ -866,13 +2250,13 @@ async def admin_class_presence(query):
         [InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="admin_panel")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("📊 Управление наличием пар:", reply_markup=reply_markup)
+    await edit_message(query, "📊 Управление наличием пар:", reply_markup=reply_markup)
 
 async def admin_show_presence_week_selection(query):
     """Показ выбора недели для управления наличием пар"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     try:
@@ -883,7 +2267,7 @@ async def admin_show_presence_week_selection(query):
         keyboard = []
         
         if current_week_info:
-            week_encoded = encode_week_string(current_week_info['string'])
+            week_encoded = WEEK_CODEC.encode(week_string=current_week_info['string'])
             keyboard.append([
                 InlineKeyboardButton(
                     f"📅 {current_week_info['string']}", 
@@ -892,7 +2276,7 @@ async def admin_show_presence_week_selection(query):
             ])
         
         if previous_week_info:
-            week_encoded = encode_week_string(previous_week_info['string'])
+            week_encoded = WEEK_CODEC.encode(week_string=previous_week_info['string'])
             keyboard.append([
                 InlineKeyboardButton(
                     f"↩️ {previous_week_info['string']}", 
@@ -903,20 +2287,20 @@ async def admin_show_presence_week_selection(query):
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_class_presence")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await edit_message(query,
             "Выберите неделю для управления наличием пар:",
             reply_markup=reply_markup
         )
         
     except Exception as e:
         logger.error(f"❌ Ошибка в admin_show_presence_week_selection: {e}")
-        await query.edit_message_text("❌ Ошибка при загрузке недель")
+        await edit_message(query, "❌ Ошибка при загрузке недель")
 
 async def admin_show_presence_days(query, week_string):
     """Показ дней недели со статусом отмененных пар"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     try:
@@ -964,7 +2348,7 @@ async def admin_show_presence_days(query, week_string):
                         day_status[day]['cancelled'] += 1
         
         if not found_any_classes:
-            await query.edit_message_text(f"❌ На неделе '{week_string}' нет занятий")
+            await edit_message(query, f"❌ На неделе '{week_string}' нет занятий")
             return
         
         keyboard = []
@@ -984,8 +2368,7 @@ async def admin_show_presence_days(query, week_string):
             else:
                 status_text = " ⚫"
             
-            week_encoded = encode_week_string(week_string)
-            callback_data = f"apd_{week_encoded}_{day}"
+            callback_data = f"apd_{WEEK_DAY_CODEC.encode(week_string=week_string, day=day)}"
             keyboard.append([InlineKeyboardButton(f"{day}{status_text}", callback_data=callback_data)])
         
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_class_presence")])
@@ -998,135 +2381,156 @@ async def admin_show_presence_days(query, week_string):
             "⚫ - нет пар в этот день"
         )
         
-        await query.edit_message_text(
+        await edit_message(query,
             f"📅 Выберите день недели ({week_string}):\n\n{status_explanation}",
             reply_markup=reply_markup
         )
         
     except Exception as e:
         logger.error(f"❌ Ошибка в admin_show_presence_days: {e}")
-        await query.edit_message_text(f"❌ Ошибка при загрузке расписания: {str(e)}")
+        await edit_message(query, f"❌ Ошибка при загрузке расписания: {str(e)}")
 
 async def admin_show_presence_subgroups(query, week_string, day):
     """Показ выбора подгруппы для управления наличием пар"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     keyboard = [
         [
-            InlineKeyboardButton("1 подгруппа", callback_data=f"apsg_{encode_week_string(week_string)}_{day}_1"),
-            InlineKeyboardButton("2 подгруппа", callback_data=f"apsg_{encode_week_string(week_string)}_{day}_2")
+            InlineKeyboardButton("1 подгруппа", callback_data=f"apsg_{SUBGROUP_CODEC.encode(week_string=week_string, day=day, subgroup=1)}"),
+            InlineKeyboardButton("2 подгруппа", callback_data=f"apsg_{SUBGROUP_CODEC.encode(week_string=week_string, day=day, subgroup=2)}")
         ],
-        [InlineKeyboardButton("🔙 Назад", callback_data=f"apw_{encode_week_string(week_string)}")]
+        [InlineKeyboardButton("🔙 Назад", callback_data=f"apw_{WEEK_CODEC.encode(week_string=week_string)}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(
+    await edit_message(query,
         f"📅 {week_string}\n"
         f"📅 {day}\n\n"
         "Выберите подгруппу:",
         reply_markup=reply_markup
     )
 
-async def admin_show_presence_subjects(query, week_string, day, subgroup, context=None):
-    """Показ предметов для управления отменой для конкретной подгруппы"""
+def render_presence_subjects(week_string, day, subgroup, temp_cancellations):
+    """Текст и клавиатура управления отменой пар (reply_markup=None - пар нет)"""
+    data = get_schedule_data_optimized(subgroup)
+    subjects_with_status = []
+    
+    # Обрабатываем выбранную подгруппу
+    for row_num, row in enumerate(data[1:], start=2):
+        table_week = ' '.join(str(row[0]).split()) if len(row) > 0 else ""
+        if len(row) > 2 and table_week == week_string and row[1] == day:
+            subject = row[2]
+            
+            # Проверяем статус - сначала временный, потом из таблицы
+            temp_status = temp_cancellations.get(str(row_num), None)
+            if temp_status is not None:
+                is_cancelled = (temp_status == "cancel")
+            else:
+                is_cancelled = any('⚙️' in str(cell) for cell in row[3:])
+            
+            # Эмодзи шестеренки ПЕРЕД названием пары
+            button_text = f"⚙️ {subject}" if is_cancelled else f"{subject}"
+            subjects_with_status.append((subject, button_text, row_num, is_cancelled))
+    
+    if not subjects_with_status:
+        return f"❌ На {day} ({week_string}) в {subgroup} подгруппе нет занятий", None
+        
+    keyboard = []
+    for subject, button_text, row_num, is_cancelled in subjects_with_status:
+        action = "uncancel" if is_cancelled else "cancel"
+        
+        # Создаем callback_data
+        callback_data = "apst_" + CANCELLATION_CODEC.encode(
+            week_string=week_string, day=day, subgroup=subgroup, row_num=row_num, action=action
+        )
+        
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+    
+    # Показываем количество временных изменений
+    temp_count = len(temp_cancellations)
+    save_button_text = f"💾 Сохранить ({temp_count})" if temp_count > 0 else "💾 Сохранить"
+    
+    keyboard.append([InlineKeyboardButton("———", callback_data="separator")])
+    keyboard.append([
+        InlineKeyboardButton("🔙 Назад", callback_data=f"apd_{WEEK_DAY_CODEC.encode(week_string=week_string, day=day)}"),
+        InlineKeyboardButton(save_button_text, callback_data=f"apss_{SUBGROUP_CODEC.encode(week_string=week_string, day=day, subgroup=subgroup)}")
+    ])
+    
+    status_text = "⚙️ - пара отменена (временное изменение)" if temp_count > 0 else "⚙️ - пара отменена"
+    text = (
+        f"📚 {day} - {week_string}:\n"
+        f"Подгруппа - {subgroup}\n\n"
+        f"Нажмите на предмет чтобы отменить/восстановить пару\n"
+        f"{status_text}"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+def update_presence_subjects(inputs, result, changes):
+    # Вид зависит только от строк своего дня - изменения в других днях его не трогают
+    week_string, day = normalize_week(inputs[0]), inputs[1]
+    for row_num, _, _, _ in changes.cells:
+        row = changes.data[row_num - 1]
+        if normalize_week(row[0]) == week_string and row[1] == day:
+            return DerivedCache.DROP
+    return result
+
+render_cache.register_updater('presence_subjects', update_presence_subjects)
+
+async def admin_show_presence_subjects(query, week_string, day, subgroup, context=None, fresh=False):
+    """Показ предметов для управления отменой для конкретной подгруппы
+
+    fresh=True - перед показом лист подгруппы перечитывается, чтобы админ
+    видел отметки, сделанные другими после последней загрузки кэша.
+    """
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     logger.info(f"🔍 АДМИН: Загрузка предметов для {day} недели '{week_string}', подгруппа {subgroup}")
 
     try:
-        # Получаем данные только для выбранной подгруппы
-        sheet = db.worksheet(f"{subgroup} подгруппа")
-        data = sheet.get_all_values()
-        
-        subjects_with_status = []
+        if fresh:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, reload_schedule_data, subgroup)
+            except Exception as e:
+                # Таблица недоступна - показываем то, что есть в кэше
+                logger.warning(f"⚠️ Не удалось перечитать лист {subgroup} подгруппы: {e}")
         
         # Проверяем временные изменения
-        temp_cancellations = {}
         week_key = f"{week_string}_{day}_{subgroup}"
-        if context and 'temp_cancellations' in context.user_data and week_key in context.user_data['temp_cancellations']:
-            temp_cancellations = context.user_data['temp_cancellations'][week_key]
-        
-        # Обрабатываем выбранную подгруппу
-        for row_num, row in enumerate(data[1:], start=2):
-            table_week = ' '.join(str(row[0]).split()) if len(row) > 0 else ""
-            if len(row) > 2 and table_week == week_string and row[1] == day:
-                subject = row[2]
-                
-                # Проверяем статус - сначала временный, потом из таблицы
-                temp_status = temp_cancellations.get(str(row_num), None)
-                if temp_status is not None:
-                    is_cancelled = (temp_status == "cancel")
-                else:
-                    is_cancelled = any('⚙️' in str(cell) for cell in row[3:])
-                
-                # Эмодзи шестеренки ПЕРЕД названием пары
-                button_text = f"⚙️ {subject}" if is_cancelled else f"{subject}"
-                subjects_with_status.append((subject, button_text, row_num, subgroup, is_cancelled))
-        
-        if not subjects_with_status:
-            await query.edit_message_text(f"❌ На {day} ({week_string}) в {subgroup} подгруппе нет занятий")
-            return
-            
-        keyboard = []
-        for subject, button_text, row_num, subgroup, is_cancelled in subjects_with_status:
-            action = "uncancel" if is_cancelled else "cancel"
-            week_encoded = encode_week_string(week_string)
-            
-            # Создаем callback_data
-            callback_data = f"apst_{week_encoded}_{day}_{subgroup}_{row_num}_{action}"
-            
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
-        
-        # Показываем количество временных изменений
-        temp_count = len(temp_cancellations)
-        save_button_text = f"💾 Сохранить ({temp_count})" if temp_count > 0 else "💾 Сохранить"
-        
-        keyboard.append([InlineKeyboardButton("———", callback_data="separator")])
-        keyboard.append([
-            InlineKeyboardButton("🔙 Назад", callback_data=f"apd_{week_encoded}_{day}"),
-            InlineKeyboardButton(save_button_text, callback_data=f"apss_{week_encoded}_{day}_{subgroup}")
-        ])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        status_text = "⚙️ - пара отменена (временное изменение)" if temp_count > 0 else "⚙️ - пара отменена"
-        
-        await query.edit_message_text(
-            f"📚 {day} - {week_string}:\n"
-            f"Подгруппа - {subgroup}\n\n"
-            f"Нажмите на предмет чтобы отменить/восстановить пару\n"
-            f"{status_text}",
-            reply_markup=reply_markup
+        temp_cancellations = drafts.get('cancellations', user_id, week_key) or {}
+        
+        # Готовый вид берем из кэша, пока не изменилось расписание подгруппы
+        text, reply_markup = render_cache.get_or_render(
+            'presence_subjects',
+            (week_string, day, str(subgroup), frozenset(temp_cancellations.items())),
+            (f'schedule_{subgroup}',),
+            lambda: render_presence_subjects(week_string, day, subgroup, temp_cancellations)
         )
         
+        await edit_message(query, text, reply_markup=reply_markup)
+        
     except Exception as e:
         logger.error(f"❌ Ошибка в admin_show_presence_subjects: {e}")
-        await query.edit_message_text(f"❌ Ошибка при загрузке расписания: {str(e)}")
+        await edit_message(query, f"❌ Ошибка при загрузке расписания: {str(e)}")
 
 async def admin_temp_toggle_class_cancellation(query, week_string, day, subgroup, row_num, action, context):
     """Временное изменение статуса пары (без сохранения в таблицу)"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     try:
-        # Инициализируем временное хранилище
-        if 'temp_cancellations' not in context.user_data:
-            context.user_data['temp_cancellations'] = {}
-        
         week_key = f"{week_string}_{day}_{subgroup}"
-        if week_key not in context.user_data['temp_cancellations']:
-            context.user_data['temp_cancellations'][week_key] = {}
         
         # Сохраняем временное изменение
-        context.user_data['temp_cancellations'][week_key][str(row_num)] = action
+        drafts.update('cancellations', user_id, week_key, {str(row_num): action})
         
         message = "✅ Временное изменение применено (нажмите 'Сохранить' для подтверждения)"
         await query.answer(message, show_alert=False)
@@ -1138,11 +2542,98 @@ async def admin_temp_toggle_class_cancellation(query, week_string, day, subgroup
         logger.error(f"❌ Ошибка в admin_temp_toggle_class_cancellation: {e}")
         await query.answer("❌ Ошибка при изменении статуса пары", show_alert=True)
 
+# КЭШ ПРОФИЛЕЙ TELEGRAM
+# user_id -> {'username', 'first_name', 'last_name', 'fetched_at'}. Пополняется из
+# каждого входящего обновления и из get_chat; хранится в SQLite между перезапусками.
+PROFILES_DB = 'profiles.db'
+
+profiles_db = SQLiteStore(PROFILES_DB, (
+    "CREATE TABLE IF NOT EXISTS user_profiles ("
+    "user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, fetched_at REAL NOT NULL)",
+))
+profiles_db_ready = False
+profiles_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiles_store")
+user_profiles = {}
+profile_stats = {'cache_hits': 0, 'fetched': 0, 'failed': 0}
+
+def load_user_profiles():
+    """Загружает кэш профилей из БД (при запуске, до старта event loop)"""
+    global profiles_db_ready, user_profiles
+    try:
+        rows = profiles_db.query("SELECT user_id, username, first_name, last_name, fetched_at FROM user_profiles")
+        profiles_db_ready = True
+        user_profiles = {
+            user_id: {'username': username, 'first_name': first_name, 'last_name': last_name, 'fetched_at': fetched_at}
+            for user_id, username, first_name, last_name, fetched_at in rows
+        }
+        logger.info(f"✅ Кэш профилей загружен: {len(user_profiles)} пользователей")
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки кэша профилей: {e}")
+
+def write_profile_row(user_id, profile):
+    """Upsert одного профиля (выполняется в потоке-писателе)"""
+    try:
+        profiles_db.execute(
+            "INSERT OR REPLACE INTO user_profiles (user_id, username, first_name, last_name, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, profile['username'], profile['first_name'], profile['last_name'], profile['fetched_at'])
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения профиля {user_id}: {e}")
+
+def remember_user_profile(user):
+    """Запоминает профиль из объекта User/Chat; в БД пишет только изменения
+    и профили старше половины TTL"""
+    now = time.time()
+    profile = {
+        'username': user.username,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'fetched_at': now,
+    }
+    previous = user_profiles.get(user.id)
+    if (previous is not None
+            and now - previous['fetched_at'] < PROFILE_CACHE_TTL / 2
+            and all(previous[field] == profile[field] for field in ('username', 'first_name', 'last_name'))):
+        return previous
+    
+    user_profiles[user.id] = profile
+    if profiles_db_ready:
+        profiles_writer.submit(write_profile_row, user.id, dict(profile))
+    return profile
+
+async def resolve_user_profiles(bot, user_ids):
+    """Профили для списка ID: свежие - из кэша, остальные - параллельным get_chat
+
+    Возвращает {user_id: (profile, source)}, source - 'cache', 'telegram',
+    'stale' (Telegram не ответил, показываем старые данные) или None.
+    """
+    semaphore = asyncio.Semaphore(PROFILE_FETCH_CONCURRENCY)
+    now = time.time()
+    
+    async def resolve(user_id):
+        cached = user_profiles.get(user_id)
+        if cached is not None and now - cached['fetched_at'] < PROFILE_CACHE_TTL:
+            profile_stats['cache_hits'] += 1
+            return cached, 'cache'
+        async with semaphore:
+            try:
+                chat = await bot.get_chat(user_id)
+                profile_stats['fetched'] += 1
+                return remember_user_profile(chat), 'telegram'
+            except Exception as e:
+                profile_stats['failed'] += 1
+                logger.error(f"❌ Ошибка получения данных для {user_id}: {e}")
+                return cached, 'stale' if cached is not None else None
+    
+    results = await asyncio.gather(*(resolve(user_id) for user_id in user_ids))
+    return dict(zip(user_ids, results))
+
 async def admin_blacklist_menu(query):
     """Меню управления черным списком"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     log_user_action(user_id, query.from_user.username or "Без username", "Открытие меню черного списка")
@@ -1154,73 +2645,72 @@ async def admin_blacklist_menu(query):
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("⚫ Управление черным списком:", reply_markup=reply_markup)
+    await edit_message(query, "⚫ Управление черным списком:", reply_markup=reply_markup)
 
 async def admin_show_blacklist(query, context: ContextTypes.DEFAULT_TYPE):
     """Показать черный список с username"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     log_user_action(user_id, query.from_user.username or "Без username", "Просмотр черного списка")
     
     try:
-        blacklist = cache['blacklist']
+        blacklist = current_snapshot().blacklist
         
         if not blacklist:
-            await query.edit_message_text("📝 Черный список пуст")
+            await edit_message(query, "📝 Черный список пуст")
             return
         
-        await query.edit_message_text("🔄 Получаю информацию о пользователях...")
+        # Нечисловые ID показываем как есть
+        user_ids = []
+        for user_id_str in blacklist:
+            try:
+                user_ids.append(int(user_id_str.strip()))
+            except ValueError:
+                logger.error(f"💥 Некорректный ID в черном списке: {user_id_str}")
+        
+        if any(user_id not in user_profiles for user_id in user_ids):
+            await edit_message(query, "🔄 Получаю информацию о пользователях...")
+        profiles = await resolve_user_profiles(context.bot, user_ids)
         
         message = "🚫 Заблокированные пользователи:\n\n"
-        valid_users = 0
+        fetched_users = 0
+        cached_users = 0
         failed_users = 0
         
         for i, user_id_str in enumerate(blacklist, 1):
             try:
                 user_id_int = int(user_id_str.strip())
-                
-                # Пытаемся получить информацию о пользователе через бота
-                try:
-                    logger.info(f"🔍 Пытаюсь получить данные пользователя {user_id_int} через bot.get_chat()")
-                    user = await context.bot.get_chat(user_id_int)  # ← ИСПРАВЛЕНО: context.bot вместо query.bot
-                    username = f"@{user.username}" if user.username else "нет username"
-                    first_name = f" {user.first_name}" if user.first_name else ""
-                    last_name = f" {user.last_name}" if user.last_name else ""
-                    
-                    message += f"{i}. {username}{first_name}{last_name} - ID: {user_id_str}\n"
-                    valid_users += 1
-                    logger.info(f"✅ Успешно получены данные для {user_id_int}: {username}")
-                    
-                except Exception as user_error:
-                    # Логируем конкретную ошибку
-                    logger.error(f"❌ Ошибка получения данных для {user_id_int}: {user_error}")
-                    
-                    # Проверяем, есть ли пользователь в user_data (зарегистрированные)
-                    if user_id_int in user_data:
-                        student_info = user_data[user_id_int]
-                        message += f"{i}. {student_info['fio']} (зарегистрирован) - ID: {user_id_str}\n"
-                        valid_users += 1
-                        logger.info(f"📝 Использованы данные из user_data для {user_id_int}")
-                    else:
-                        message += f"{i}. ID: {user_id_str} (информация недоступна)\n"
-                        failed_users += 1
-                
-                # Делаем небольшую задержку чтобы не превысить лимиты Telegram
-                if i % 3 == 0:
-                    await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                # Если не получается обработать ID - показываем как есть
-                logger.error(f"💥 Критическая ошибка обработки ID {user_id_str}: {e}")
+            except ValueError:
                 message += f"{i}. ID: {user_id_str} (ошибка обработки)\n"
                 failed_users += 1
+                continue
+            
+            profile, source = profiles[user_id_int]
+            if profile is not None:
+                username = f"@{profile['username']}" if profile['username'] else "нет username"
+                first_name = f" {profile['first_name']}" if profile['first_name'] else ""
+                last_name = f" {profile['last_name']}" if profile['last_name'] else ""
+                message += f"{i}. {username}{first_name}{last_name} - ID: {user_id_str}\n"
+                if source == 'telegram':
+                    fetched_users += 1
+                else:
+                    cached_users += 1
+            elif user_id_int in user_data:
+                # Зарегистрированный студент - показываем ФИО
+                student_info = user_data[user_id_int]
+                message += f"{i}. {student_info['fio']} (зарегистрирован) - ID: {user_id_str}\n"
+                cached_users += 1
+            else:
+                message += f"{i}. ID: {user_id_str} (информация недоступна)\n"
+                failed_users += 1
         
         # Добавляем статистику
         message += f"\n📊 Статистика:\n"
-        message += f"• Успешно: {valid_users} пользователей\n"
+        message += f"• Успешно: {fetched_users} пользователей\n"
+        message += f"• Из кэша: {cached_users} пользователей\n"
         message += f"• Недоступно: {failed_users} пользователей\n"
         message += f"• Всего: {len(blacklist)} записей"
         
@@ -1236,11 +2726,11 @@ async def admin_show_blacklist(query, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        await edit_message(query, message, reply_markup=reply_markup)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при показе черного списка: {e}")
-        await query.edit_message_text(f"❌ Ошибка при загрузке черного списка: {str(e)}")
+        await edit_message(query, f"❌ Ошибка при загрузке черного списка: {str(e)}")
 
 async def debug_user_info(query, target_user_id=None):
     """Функция для отладки получения информации о пользователе"""
@@ -1280,24 +2770,19 @@ async def admin_refresh_blacklist(query, context: ContextTypes.DEFAULT_TYPE):
     """Обновить черный список"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     log_user_action(user_id, query.from_user.username or "Без username", "Обновление черного списка")
     
     try:
-        await query.edit_message_text("🔄 Обновляю черный список...")
+        await edit_message(query, "🔄 Обновляю черный список...")
         
         # ПРИНУДИТЕЛЬНО обновляем черный список с флагом force_refresh
-        old_count = len(cache['blacklist'])
-        
-        # Очищаем кэш чтобы гарантировать обновление
-        preloaded_data['blacklist'] = None
-        preloaded_data['last_loaded'] = 0
+        old_count = len(current_snapshot().blacklist)
         
         # Загружаем заново
         new_blacklist = get_blacklist_data(force_refresh=True)
-        cache['blacklist'] = new_blacklist
         new_count = len(new_blacklist)
         
         logger.info(f"✅ Черный список обновлен: было {old_count}, стало {new_count}")
@@ -1314,11 +2799,11 @@ async def admin_refresh_blacklist(query, context: ContextTypes.DEFAULT_TYPE):
         else:
             message = f"✅ Черный список обновлен!\n\n📊 Количество пользователей не изменилось: {new_count}"
         
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        await edit_message(query, message, reply_markup=reply_markup)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при обновлении черного списка: {e}")
-        await query.edit_message_text(f"❌ Ошибка при обновлении черного списка: {str(e)}")
+        await edit_message(query, f"❌ Ошибка при обновлении черного списка: {str(e)}")
 
 async def admin_refresh_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для обновления кеша (только для админа)"""
@@ -1337,51 +2822,41 @@ async def admin_save_class_cancellations(query, week_string, day, subgroup, cont
     """Сохранение всех временных изменений статуса пар"""
     user_id = query.from_user.id
     if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа")
+        await edit_message(query, "❌ У вас нет доступа")
         return
     
     try:
         week_key = f"{week_string}_{day}_{subgroup}"
         
         # Проверяем есть ли временные изменения
-        if 'temp_cancellations' not in context.user_data or week_key not in context.user_data['temp_cancellations']:
-            await query.answer("Нет изменений для сохранения", show_alert=True)
-            await admin_show_presence_subjects(query, week_string, day, subgroup, context)
-            return
-        
-        temp_cancellations = context.user_data['temp_cancellations'][week_key]
+        temp_cancellations = drafts.get('cancellations', user_id, week_key)
         if not temp_cancellations:
             await query.answer("Нет изменений для сохранения", show_alert=True)
             await admin_show_presence_subjects(query, week_string, day, subgroup, context)
             return
         
         # Показываем сообщение о начале сохранения
-        await query.edit_message_text("💾 Сохранение изменений...")
+        await edit_message(query, "💾 Сохранение изменений...")
         
         sheet = db.worksheet(f"{subgroup} подгруппа")
         
         # Используем batch update для ускорения
         updates = []
+        edits = {}
         updated_count = 0
         
         for row_num_str, action in temp_cancellations.items():
             row_num = int(row_num_str)
             header = sheet.row_values(1)
             
-            if action == "cancel":
-                # Отменяем пару - ставим ⚙️ всем студентам
-                for col in range(4, len(header) + 1):
-                    updates.append({
-                        'range': f"{gspread.utils.rowcol_to_a1(row_num, col)}",
-                        'values': [['⚙️']]
-                    })
-            else:
-                # Восстанавливаем пару - убираем отметки у всех студентов
-                for col in range(4, len(header) + 1):
-                    updates.append({
-                        'range': f"{gspread.utils.rowcol_to_a1(row_num, col)}", 
-                        'values': [['']]
-                    })
+            # Отменяем пару - ставим ⚙️ всем студентам, восстанавливаем - убираем отметки
+            value = '⚙️' if action == "cancel" else ''
+            for col in range(4, len(header) + 1):
+                updates.append({
+                    'range': f"{gspread.utils.rowcol_to_a1(row_num, col)}",
+                    'values': [[value]]
+                })
+                edits[(row_num, col - 1)] = value
             
             updated_count += 1
         
@@ -1389,8 +2864,11 @@ async def admin_save_class_cancellations(query, week_string, day, subgroup, cont
         if updates:
             sheet.batch_update(updates)
         
+        # Переносим записанные ячейки в кэш - обновятся только затронутые виды
+        apply_schedule_edits(subgroup, edits)
+        
         # Очищаем временные изменения
-        del context.user_data['temp_cancellations'][week_key]
+        drafts.discard('cancellations', user_id, week_key)
         
         logger.info(f"✅ АДМИН: Сохранено {updated_count} изменений для {day} {week_string}, подгруппа {subgroup}")
         
@@ -1407,60 +2885,158 @@ async def admin_save_class_cancellations(query, week_string, day, subgroup, cont
         try:
             await admin_show_presence_subjects(query, week_string, day, subgroup, context)
         except:
-            await query.edit_message_text(f"❌ Ошибка при сохранении изменений: {str(e)}")
+            await edit_message(query, f"❌ Ошибка при сохранении изменений: {str(e)}")
 
 #Пользовательские настройки
-def save_notification_settings():
-    """Простое сохранение настроек уведомлений в файл"""
+# Настройки уведомлений хранятся в SQLite (WAL): каждое изменение - одна строка,
+# запись атомарна и выполняется в отдельном потоке, не блокируя event loop.
+NOTIFICATIONS_DB = 'notifications.db'
+# Старый формат хранения - импортируется в БД один раз, если она пуста
+NOTIFICATIONS_FILE = 'notifications.json'
+
+notifications_db = SQLiteStore(NOTIFICATIONS_DB, (
+    "CREATE TABLE IF NOT EXISTS notification_settings ("
+    "user_id TEXT PRIMARY KEY, enabled INTEGER NOT NULL, days TEXT NOT NULL, time TEXT NOT NULL)",
+))
+# PRAGMA data_version на момент последней загрузки: меняется только при записи из другого процесса
+notifications_db_version = None
+# Один поток-писатель сохраняет порядок изменений
+notifications_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notifications_store")
+pending_notification_writes = set()
+
+def normalize_notification_settings(settings):
+    """Гарантирует правильную структуру настроек пользователя"""
+    if 'enabled' not in settings:
+        settings['enabled'] = False
+    if 'days' not in settings:
+        settings['days'] = []
+    if 'time' not in settings:
+        settings['time'] = '09:00'
+    return settings
+
+def read_notification_rows(conn):
+    """Читает все настройки из БД (conn - из notifications_db.connection())"""
+    rows = conn.execute("SELECT user_id, enabled, days, time FROM notification_settings").fetchall()
+    return {
+        user_id_str: {'enabled': bool(enabled), 'days': json.loads(days), 'time': time_str}
+        for user_id_str, enabled, days, time_str in rows
+    }
+
+def write_notification_row(user_id_str, settings):
+    """Upsert/удаление одной строки настроек (выполняется в потоке-писателе)"""
     try:
-        with open('notifications.json', 'w', encoding='utf-8') as f:
-            json.dump(user_notifications, f, ensure_ascii=False, indent=2)
-        logger.info("✅ Настройки уведомлений сохранены")
+        if settings is None:
+            notifications_db.execute("DELETE FROM notification_settings WHERE user_id = ?", (user_id_str,))
+        else:
+            notifications_db.execute(
+                "INSERT INTO notification_settings (user_id, enabled, days, time) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET enabled = excluded.enabled, days = excluded.days, time = excluded.time",
+                (user_id_str, int(settings['enabled']), json.dumps(settings['days'], ensure_ascii=False), settings['time'])
+            )
+        logger.info(f"✅ Настройки уведомлений пользователя {user_id_str} сохранены")
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения настроек уведомлений: {e}")
+        logger.error(f"❌ Ошибка сохранения настроек уведомлений {user_id_str}: {e}")
+
+def save_notification_settings(user_id_str):
+    """Сохраняет настройки одного пользователя (O(1), в фоне)"""
+    settings = user_notifications.get(user_id_str)
+    # Снимок делаем на event loop, чтобы поток-писатель не видел полуизмененный dict
+    snapshot = None
+    if settings is not None:
+        snapshot = {'enabled': settings.get('enabled', False), 'days': list(settings.get('days', [])),
+                    'time': settings.get('time', '09:00')}
+    future = notifications_writer.submit(write_notification_row, user_id_str, snapshot)
+    pending_notification_writes.add(future)
+    future.add_done_callback(pending_notification_writes.discard)
+
+def import_notifications_json():
+    """Одноразовый перенос настроек из notifications.json в БД"""
+    if not os.path.exists(NOTIFICATIONS_FILE):
+        return 0
+    with open(NOTIFICATIONS_FILE, 'r', encoding='utf-8') as f:
+        legacy = json.load(f)
+    statements = []
+    for user_id_str, settings in legacy.items():
+        settings = normalize_notification_settings(settings)
+        statements.append((
+            "INSERT OR REPLACE INTO notification_settings (user_id, enabled, days, time) VALUES (?, ?, ?, ?)",
+            (user_id_str, int(bool(settings['enabled'])), json.dumps(settings['days'], ensure_ascii=False), settings['time'])
+        ))
+    notifications_db.transaction(statements)
+    logger.info(f"📦 Импортировано {len(legacy)} настроек уведомлений из {NOTIFICATIONS_FILE}")
+    return len(legacy)
 
 def load_notification_settings():
-    """Простая загрузка настроек уведомлений из файла"""
-    global user_notifications
+    """Загрузка настроек уведомлений из БД (с импортом старого JSON)"""
+    global user_notifications, notifications_db_version
     try:
-        import os
         current_dir = os.getcwd()
         logger.info(f"📁 Текущая директория бота: {current_dir}")
         
-        if os.path.exists('notifications.json'):
-            with open('notifications.json', 'r', encoding='utf-8') as f:
-                user_notifications = json.load(f)
-            
-            # СИНХРОНИЗАЦИЯ: гарантируем правильную структуру
-            for user_id_str, settings in user_notifications.items():
-                if 'enabled' not in settings:
-                    settings['enabled'] = False
-                if 'days' not in settings:
-                    settings['days'] = []
-                if 'time' not in settings:
-                    settings['time'] = '09:00'
-            
-            logger.info(f"✅ Настройки уведомлений загружены: {len(user_notifications)} пользователей")
-        else:
-            user_notifications = {}
-            logger.info("📝 Файл настроек уведомлений не найден, создан новый")
+        with notifications_db.connection() as conn:
+            user_notifications = read_notification_rows(conn)
+        
+        if not user_notifications and import_notifications_json():
+            with notifications_db.connection() as conn:
+                user_notifications = read_notification_rows(conn)
+        
+        notifications_db_version = notifications_db.query("PRAGMA data_version")[0][0]
+        
+        logger.info(f"✅ Настройки уведомлений загружены: {len(user_notifications)} пользователей")
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки настроек уведомлений: {e}")
         user_notifications = {}
+    
+    rebuild_notification_index()
+
+# ИНДЕКС УВЕДОМЛЕНИЙ
+# (день недели, "HH:MM") -> множество user_id_str, которым пора отправить напоминание.
+# Обновляется при каждом изменении настроек, поэтому тик планировщика
+# трогает только тех пользователей, у кого наступило время.
+notification_index = {}
+# user_id_str -> ключи индекса, в которых он сейчас состоит (для быстрого удаления)
+notification_index_keys = {}
+
+def reindex_user_notifications(user_id_str):
+    """Пересчитывает положение пользователя в индексе уведомлений"""
+    for key in notification_index_keys.pop(user_id_str, ()):
+        bucket = notification_index.get(key)
+        if bucket is not None:
+            bucket.discard(user_id_str)
+            if not bucket:
+                del notification_index[key]
+    
+    settings = user_notifications.get(user_id_str)
+    if not settings or not settings.get('enabled', False):
+        return
+    
+    user_time = settings.get('time', '09:00')
+    keys = {(day, user_time) for day in settings.get('days', [])}
+    for key in keys:
+        notification_index.setdefault(key, set()).add(user_id_str)
+    if keys:
+        notification_index_keys[user_id_str] = keys
+
+def rebuild_notification_index():
+    """Полное построение индекса уведомлений (после загрузки настроек из файла)"""
+    notification_index.clear()
+    notification_index_keys.clear()
+    for user_id_str in user_notifications:
+        reindex_user_notifications(user_id_str)
+    logger.info(f"🗂️ Индекс уведомлений построен: {len(notification_index)} слотов, "
+                f"{len(notification_index_keys)} подписчиков")
+
+def get_due_notification_users(day, time_str):
+    """Пользователи, которым нужно отправить напоминание в (день, время)"""
+    return list(notification_index.get((day, time_str), ()))
 
 def load_student_from_sheets(user_id):
     """Загрузка данных студента из Google Sheets по user_id"""
     try:
-        students_data = get_students_data_optimized()
-        for student in students_data:
-            existing_id = str(student.get('Telegram ID', '')).strip()
-            if existing_id and existing_id.isdigit() and int(existing_id) == user_id:
-                return {
-                    'fio': student['ФИО'],
-                    'number': student['№'],
-                    'subgroup': student['Подгруппа']
-                }
-        return None
+        student = students_by_telegram_id().get(user_id)
+        if student is None:
+            return None
+        return student_session_data(student)
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки студента {user_id} из Google Sheets: {e}")
         return None
@@ -1489,7 +3065,7 @@ async def check_my_notifications(update: Update, context: ContextTypes.DEFAULT_T
 async def show_settings(query, user_id):
     """Показывает меню настроек с обновленной информацией"""
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
     
     # Получаем текущие настройки пользователя
@@ -1521,7 +3097,7 @@ async def show_settings(query, user_id):
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await edit_message(query, message, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def show_days_selection(query, user_id):
     """Показывает выбор дней для уведомлений (включая выходные)"""
@@ -1536,20 +3112,23 @@ async def show_days_selection(query, user_id):
     # Все дни недели включая выходные
     days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
-    keyboard = []
-    for day in days:
-        emoji = "✅" if day in selected_days else "⚪"
-        keyboard.append([InlineKeyboardButton(f"{emoji} {day}", callback_data=f"notif_day_{day}")])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Назад к настройкам", callback_data="settings_menu")])
+    def render():
+        keyboard = []
+        for day in days:
+            emoji = "✅" if day in selected_days else "⚪"
+            keyboard.append([InlineKeyboardButton(f"{emoji} {day}", callback_data=f"notif_day_{day}")])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Назад к настройкам", callback_data="settings_menu")])
+        return InlineKeyboardMarkup(keyboard)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Вариантов выбора всего 128 - клавиатура зависит только от набора дней
+    reply_markup = render_cache.get_or_render('notification_days', frozenset(selected_days), (), render)
     
-    await query.edit_message_text(
+    await edit_message(query,
         "📅 Выберите дни для напоминаний (отмечайте галочкой):\n\n"
         "✅ - день выбран\n"
         "⚪ - день не выбран\n\n"
-        "*Примечание:* Напоминания приходят независимо от наличия пар в выбранный день",
+        "*Примечание:* Напоминание приходит, только если в этот день есть неотмеченные пары",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
@@ -1564,115 +3143,201 @@ async def show_time_selection(query, user_id):
     
     current_time = user_settings['time']
     
-    # Варианты времени с целыми часами с 00:00 до 23:00
-    keyboard = [
-        [
-            InlineKeyboardButton("⏰ 00:00", callback_data="notif_time_00:00"),
-            InlineKeyboardButton("⏰ 01:00", callback_data="notif_time_01:00"),
-            InlineKeyboardButton("⏰ 02:00", callback_data="notif_time_02:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 03:00", callback_data="notif_time_03:00"),
-            InlineKeyboardButton("⏰ 04:00", callback_data="notif_time_04:00"),
-            InlineKeyboardButton("⏰ 05:00", callback_data="notif_time_05:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 06:00", callback_data="notif_time_06:00"),
-            InlineKeyboardButton("⏰ 07:00", callback_data="notif_time_07:00"),
-            InlineKeyboardButton("⏰ 08:00", callback_data="notif_time_08:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 09:00", callback_data="notif_time_09:00"),
-            InlineKeyboardButton("⏰ 10:00", callback_data="notif_time_10:00"),
-            InlineKeyboardButton("⏰ 11:00", callback_data="notif_time_11:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 12:00", callback_data="notif_time_12:00"),
-            InlineKeyboardButton("⏰ 13:00", callback_data="notif_time_13:00"),
-            InlineKeyboardButton("⏰ 14:00", callback_data="notif_time_14:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 15:00", callback_data="notif_time_15:00"),
-            InlineKeyboardButton("⏰ 16:00", callback_data="notif_time_16:00"),
-            InlineKeyboardButton("⏰ 17:00", callback_data="notif_time_17:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 18:00", callback_data="notif_time_18:00"),
-            InlineKeyboardButton("⏰ 19:00", callback_data="notif_time_19:00"),
-            InlineKeyboardButton("⏰ 20:00", callback_data="notif_time_20:00")
-        ],
-        [
-            InlineKeyboardButton("⏰ 21:00", callback_data="notif_time_21:00"),
-            InlineKeyboardButton("⏰ 22:00", callback_data="notif_time_22:00"),
-            InlineKeyboardButton("⏰ 23:00", callback_data="notif_time_23:00")
-        ],
-        [InlineKeyboardButton("🔙 Назад к настройкам", callback_data="settings_menu")]
-    ]
+    # Варианты времени с целыми часами с 00:00 до 23:00 (клавиатура неизменна)
+    def render():
+        keyboard = [
+            [
+                InlineKeyboardButton(f"⏰ {hour:02d}:00", callback_data=f"notif_time_{hour:02d}:00")
+                for hour in range(row_start, row_start + 3)
+            ]
+            for row_start in range(0, 24, 3)
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Назад к настройкам", callback_data="settings_menu")])
+        return InlineKeyboardMarkup(keyboard)
+    
+    reply_markup = render_cache.get_or_render('notification_time', (), (), render)
+    
+    await edit_message(query,
+        f"⏰ Выберите время для напоминаний:\n\n"
+        f"Текущее время: *{current_time}*\n\n"
+        f"Доступно время с 00:00 до 23:00 (целые часы)",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+def read_changed_notification_rows(known_version, force=False):
+    """(версия, настройки) если БД изменилась с known_version, иначе (версия, None) - в пуле потоков"""
+    with notifications_db.connection() as conn:
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if not force and version == known_version:
+            return version, None
+        return version, read_notification_rows(conn)
+
+async def reload_notification_settings(force=False):
+    """Перезагружает настройки уведомлений, если БД изменил другой процесс
+
+    Изменения в памяти авторитетны: собственные записи бота не меняют
+    PRAGMA data_version, поэтому без внешней правки тик не читает таблицу.
+    Таблица читается в пуле потоков, а не на event loop.
+    """
+    global notifications_db_version
+    # Пока наши изменения не записаны, содержимое БД старее памяти
+    if pending_notification_writes:
+        return False
+    try:
+        loop = asyncio.get_running_loop()
+        version, new_notifications = await loop.run_in_executor(
+            None, read_changed_notification_rows, notifications_db_version, force
+        )
+        # Пока читали, пользователь мог изменить настройки - тогда память новее
+        if new_notifications is None or pending_notification_writes:
+            return False
+        notifications_db_version = version
+        
+        # Обновляем глобальную переменную
+        user_notifications.clear()
+        user_notifications.update(new_notifications)
+        rebuild_notification_index()
+        logger.info(f"🔄 Настройки уведомлений перезагружены. Пользователей: {len(user_notifications)}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка перезагрузки настроек уведомлений: {e}")
+    return False
+
+def get_unmarked_classes(student_data, week_string, day):
+    """Неотмеченные и неотмененные пары студента на день (по кэшу расписания)"""
+    index = schedule_index(student_data['subgroup'])
+    student_col = index.columns.get(str(student_data['number']).strip())
+    if student_col is None:
+        return []
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    unmarked = []
+    for row_num in index.day_rows.get((normalize_week(week_string), day), ()):
+        row = index.data[row_num - 1]
+        if any('⚙️' in str(cell) for cell in row[3:]):
+            continue
+        mark = row[student_col].strip() if len(row) > student_col else ""
+        if mark not in EMOJI_MAP.values():
+            unmarked.append(row[2])
+    return unmarked
+
+def load_reminder_inputs_sync(missing_user_ids):
+    """Расписания для волны напоминаний и студенты без сессии (в пуле потоков)
+
+    Индексы расписаний строятся здесь, поэтому get_unmarked_classes на
+    event loop берет их из кэша и не ходит в Google Sheets.
+    """
+    for subgroup in (1, 2):
+        schedule_index(subgroup)
+    if not missing_user_ids:
+        return {}
+    students = students_by_telegram_id()
+    return {user_id: student_session_data(students[user_id])
+            for user_id in missing_user_ids if user_id in students}
+
+def percentile(sorted_values, p):
+    """Перцентиль по методу ближайшего ранга для отсортированного списка"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+async def deliver_reminder_wave(bot, deliveries, wave_time):
+    """Параллельная рассылка напоминаний одной волны
+
+    Не больше REMINDER_CONCURRENCY одновременных отправок. Отправки идут с
+    фоновым приоритетом telegram_outbox: темп и повторы после RetryAfter - там.
+    Возвращает счетчики и перцентили задержки доставки от начала волны.
+    """
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    wave_start = time.monotonic()
+    counters = {'retries': 0}  # повторы только отправок этой волны
+    latencies = []
     
-    await query.edit_message_text(
-        f"⏰ Выберите время для напоминаний:\n\n"
-        f"Текущее время: *{current_time}*\n\n"
-        f"Доступно время с 00:00 до 23:00 (целые часы)",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+    async def deliver(chat_id, text):
+        async with semaphore:
+            try:
+                # Темп и повторы после RetryAfter обеспечивает telegram_outbox
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown',
+                                       rate_limit_args={'priority': 'background', 'counters': counters})
+                latencies.append(time.monotonic() - wave_start)
+                logger.info(f"✅ Напоминание отправлено пользователю {chat_id}")
+                send_log_to_server(f"🔔 Уведомление отправлено: ID {chat_id} в {wave_time}",
+                                   "notification_sent", "info")
+                return True
+            except RetryAfter:
+                send_log_to_server(f"❌ Уведомление {chat_id} не отправлено: исчерпаны попытки после RetryAfter",
+                                   "notification_error", "error")
+                return False
+            except Exception as e:
+                error_msg = f"❌ Ошибка отправки уведомления пользователю {chat_id}: {e}"
+                logger.error(error_msg)
+                send_log_to_server(error_msg, "notification_error", "error")
+                return False
+    
+    results = await asyncio.gather(*(deliver(chat_id, text) for chat_id, text in deliveries))
+    sent = sum(1 for ok in results if ok)
+    retries = counters['retries']
+    
+    latencies.sort()
+    stats = {
+        'sent': sent,
+        'failed': len(results) - sent,
+        'retries': retries,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+    
+    summary = (f"🔔 Волна {wave_time}: отправлено {stats['sent']}/{len(deliveries)}, повторов {retries}, "
+               f"задержка p50={stats['p50']:.2f}с p90={stats['p90']:.2f}с p99={stats['p99']:.2f}с max={stats['max']:.2f}с")
+    logger.info(summary)
+    send_log_to_server(
+        LogEvent("{summary}", summary=summary, wave_time=wave_time, total=len(deliveries), **stats),
+        "notification_wave", "info"
     )
+    return stats
 
-def reload_notification_settings():
-    """Перезагружает настройки уведомлений из файла"""
-    global user_notifications
-    try:
-        if os.path.exists('notifications.json'):
-            with open('notifications.json', 'r', encoding='utf-8') as f:
-                new_notifications = json.load(f)
-            
-            # Синхронизируем структуру
-            for user_id_str, settings in new_notifications.items():
-                if 'enabled' not in settings:
-                    settings['enabled'] = False
-                if 'days' not in settings:
-                    settings['days'] = []
-                if 'time' not in settings:
-                    settings['time'] = '09:00'
-            
-            # Обновляем глобальную переменную
-            user_notifications.clear()
-            user_notifications.update(new_notifications)
-            logger.info(f"🔄 Настройки уведомлений перезагружены. Пользователей: {len(user_notifications)}")
-            
-        else:
-            logger.warning("📝 Файл notifications.json не найден при перезагрузке")
-    except Exception as e:
-        logger.error(f"❌ Ошибка перезагрузки настроек уведомлений: {e}")
+async def send_notification_reminders(context: ContextTypes.DEFAULT_TYPE, tick_time=None):
+    """Отправляет напоминания пользователям (работает с выходными)
 
-async def send_notification_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет напоминания пользователям (работает с выходными)"""
+    tick_time - плановое время тика планировщика; для догоняемых тиков
+    напоминания считаются по нему, а не по текущему времени.
+    """
     try:
-        # ПЕРЕЗАГРУЖАЕМ НАСТРОЙКИ ИЗ ФАЙЛА ПЕРЕД КАЖДОЙ ПРОВЕРКОЙ
-        reload_notification_settings()
+        # ПЕРЕЧИТЫВАЕМ НАСТРОЙКИ, ТОЛЬКО ЕСЛИ ИХ ИЗМЕНИЛИ ИЗВНЕ
+        await reload_notification_settings()
         
         moscow_tz = timezone(timedelta(hours=3))
-        now = datetime.now(moscow_tz)
+        now = datetime.fromtimestamp(tick_time, moscow_tz) if tick_time else datetime.now(moscow_tz)
         current_time = now.strftime("%H:%M")
         current_day_russian = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"][now.weekday()]
         
         # Логируем в консоль, но НЕ на сайт
         logger.info(f"🔔 Проверка напоминаний: {current_day_russian} {current_time}")
-        logger.info(f"🔔 Всего пользователей с уведомлениями: {len(user_notifications)}")
+        # Берем из индекса только тех, у кого наступило время
+        due_users = get_due_notification_users(current_day_russian, current_time)
+        logger.info(f"🔔 Всего пользователей с уведомлениями: {len(user_notifications)}, к отправке: {len(due_users)}")
         
-        sent_count = 0
         error_count = 0
-        
-        for user_id_str, settings in user_notifications.items():
-            user_enabled = settings.get('enabled', False)
-            user_days = settings.get('days', [])
+        skipped_count = 0
+        deliveries = []
+        current_week = get_current_week_type()
+        
+        # Расписания и недостающих студентов загружаем заранее, не блокируя event loop
+        loaded_students = {}
+        if due_users:
+            missing_user_ids = [int(user_id_str) for user_id_str in due_users if int(user_id_str) not in user_data]
+            loop = asyncio.get_running_loop()
+            loaded_students = await loop.run_in_executor(None, load_reminder_inputs_sync, missing_user_ids)
+        
+        for user_id_str in due_users:
+            settings = user_notifications.get(user_id_str, {})
             user_time = settings.get('time', '09:00')
             
-            logger.info(f"🔔 Проверка пользователя {user_id_str}: enabled={user_enabled}, days={user_days}, time={user_time}")
-            
-            if (user_enabled and 
-                current_day_russian in user_days and 
+            if (settings.get('enabled', False) and 
+                current_day_russian in settings.get('days', []) and 
                 current_time == user_time):
                 
                 logger.info(f"🔔 ОТПРАВКА: пользователь {user_id_str} соответствует условиям!")
@@ -1680,10 +3345,10 @@ async def send_notification_reminders(context: ContextTypes.DEFAULT_TYPE):
                 try:
                     user_id_int = int(user_id_str)
                     
-                    # Если пользователя нет в user_data, загружаем из Google Sheets
+                    # Если пользователя нет в user_data, берем загруженные из Google Sheets данные
                     if user_id_int not in user_data:
-                        logger.info(f"🔔 Пользователь {user_id_int} не в user_data, загружаем из Google Sheets")
-                        student_data = load_student_from_sheets(user_id_int)
+                        logger.info(f"🔔 Пользователь {user_id_int} не в user_data, данные из Google Sheets")
+                        student_data = loaded_students.get(user_id_int)
                         if student_data:
                             user_data[user_id_int] = student_data
                             logger.info(f"✅ Данные пользователя {user_id_int} загружены: {student_data['fio']}")
@@ -1698,41 +3363,40 @@ async def send_notification_reminders(context: ContextTypes.DEFAULT_TYPE):
                             )
                             continue
                     
-                    # Отправляем уведомление
                     student_data = user_data[user_id_int]
+                    
+                    # Напоминаем только если сегодня есть неотмеченные и неотмененные пары
+                    unmarked = get_unmarked_classes(student_data, current_week, current_day_russian)
+                    if not unmarked:
+                        skipped_count += 1
+                        continue
+                    
+                    classes_text = "\n".join(f"• {escape_markdown(subject)}" for subject in unmarked)
                     message = (
                         f"🔔 *Напоминание о посещаемости*\n\n"
                         f"Привет, {student_data['fio']}!\n"
-                        f"Не забудь отметить посещаемость на сегодняшние пары.\n\n"
+                        f"Не отмечены сегодняшние пары ({len(unmarked)}):\n"
+                        f"{classes_text}\n\n"
                         f"Используй команду /start для отметки."
                     )
-                    
-                    await context.bot.send_message(
-                        chat_id=user_id_int,
-                        text=message,
-                        parse_mode='Markdown'
-                    )
-                    
-                    # ЛОГИРУЕМ УСПЕШНУЮ ОТПРАВКУ НА САЙТ
-                    send_log_to_server(
-                        f"🔔 Уведомление отправлено: {student_data['fio']} (ID: {user_id_int}) в {user_time}", 
-                        "notification_sent", 
-                        "info"
-                    )
-                    
-                    logger.info(f"✅ Напоминание отправлено пользователю {user_id_int}")
-                    sent_count += 1
+                    deliveries.append((user_id_int, message))
                     
                 except Exception as e:
-                    error_msg = f"❌ Ошибка отправки уведомления пользователю {user_id_str}: {e}"
+                    error_msg = f"❌ Ошибка подготовки уведомления пользователю {user_id_str}: {e}"
                     logger.error(error_msg)
-                    # ЛОГИРУЕМ ОШИБКУ НА САЙТ
                     send_log_to_server(error_msg, "notification_error", "error")
                     error_count += 1
         
-        # Логируем итоги только если были отправки или ошибки
-        if sent_count > 0 or error_count > 0:
-            logger.info(f"🔔 Итоги: отправлено {sent_count}, ошибок {error_count}")
+        # Рассылаем всю волну параллельно с учетом лимитов Telegram
+        sent_count = 0
+        if deliveries:
+            wave = await deliver_reminder_wave(context.bot, deliveries, current_time)
+            sent_count = wave['sent']
+            error_count += wave['failed']
+        
+        # Логируем итоги только если были отправки, пропуски или ошибки
+        if sent_count > 0 or error_count > 0 or skipped_count > 0:
+            logger.info(f"🔔 Итоги: отправлено {sent_count}, пропущено (нечего отмечать) {skipped_count}, ошибок {error_count}")
         
         logger.info(f"🔔 Проверка напоминаний завершена")
                     
@@ -1758,7 +3422,8 @@ async def toggle_notifications_handler(query, user_id):
     status_text = "включены" if new_status else "выключены"
     log_user_action(user_id, username, f"Уведомления {status_text}")
     
-    save_notification_settings()
+    reindex_user_notifications(user_id_str)
+    save_notification_settings(user_id_str)
     await show_settings(query, user_id)
 
 async def toggle_notification_day(query, user_id, day):
@@ -1780,10 +3445,11 @@ async def toggle_notification_day(query, user_id, day):
     
     # ЛОГИРОВАНИЕ
     new_days = user_notifications[user_id_str]['days']
-    log_user_action(user_id, username, f"Изменение дней уведомлений", 
-                   f"день: {day} ({action}), теперь: {', '.join(new_days) if new_days else 'нет дней'}")
+    log_user_action(user_id, username, "Изменение дней уведомлений", "день: {day} ({toggle}), теперь: {days}",
+                    day=day, toggle=action, days=', '.join(new_days) if new_days else 'нет дней')
     
-    save_notification_settings()
+    reindex_user_notifications(user_id_str)
+    save_notification_settings(user_id_str)
     await show_days_selection(query, user_id)
 
 async def set_notification_time(query, user_id, time_str):
@@ -1798,29 +3464,133 @@ async def set_notification_time(query, user_id, time_str):
         user_notifications[user_id_str]['time'] = time_str
     
     # ЛОГИРОВАНИЕ
-    log_user_action(user_id, username, "Изменение времени уведомлений", f"новое время: {time_str}")
+    log_user_action(user_id, username, "Изменение времени уведомлений", "новое время: {time}", time=time_str)
     
-    save_notification_settings()
+    reindex_user_notifications(user_id_str)
+    save_notification_settings(user_id_str)
     await show_settings(query, user_id)
 
-async def background_notifications(application: Application):
-    """Фоновая задача для отправки напоминаний с правильным контекстом"""
-    while True:
-        await asyncio.sleep(60)
+async def background_notifications(application: Application, tick_time=None):
+    """Фоновая задача для отправки напоминаний с правильным контекстом (каждую минуту)"""
+    # Создаем контекст из application
+    context = ContextTypes.DEFAULT_TYPE(application=application)
+    await send_notification_reminders(context, tick_time)
+
+def get_upcoming_peaks(now):
+    """Причины пика нагрузки через PREWARM_LEAD_MINUTES минут (пустой список - пика нет)"""
+    target = now + timedelta(minutes=PREWARM_LEAD_MINUTES)
+    day = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"][target.weekday()]
+    target_time = target.strftime("%H:%M")
+    
+    reasons = []
+    subscribers = len(notification_index.get((day, target_time), ()))
+    if subscribers >= PREWARM_MIN_SUBSCRIBERS:
+        reasons.append(f"напоминания в {target_time}: {subscribers}")
+    if target.weekday() < 5 and target_time in CLASS_END_TIMES:
+        reasons.append(f"конец пары в {target_time}")
+    return reasons, day, target_time
+
+def prewarm_caches_sync(subscriber_ids=()):
+    """Принудительное обновление расписаний и черного списка (в пуле потоков)
+
+    Заодно строит производные данные, которые понадобятся подписчикам:
+    индексы расписаний и сводки по неделям. Возвращает {user_id: данные
+    студента} для подписчиков из списка студентов.
+    """
+    base_snapshot = current_snapshot()
+    schedules = {subgroup: fetch_schedule(subgroup) for subgroup in (1, 2)}
+    new_blacklist = fetch_blacklist()
+    
+    # Публикуем только полностью загруженные данные - одним снимком
+    publish_snapshot(schedules=schedules, blacklist=new_blacklist, base_generations=base_snapshot.generations)
+    
+    for subgroup in schedules:
+        schedule_index(subgroup)
+    
+    students = students_by_telegram_id()
+    weeks = [info['string'] for info in (get_week_info(0), get_week_info(-1)) if info]
+    subscribers = {}
+    for user_id_str in subscriber_ids:
+        student = students.get(int(user_id_str))
+        if student is None:
+            continue
+        student_data = subscribers[int(user_id_str)] = student_session_data(student)
+        for week_string in weeks:
+            student_week_summary(student_data['subgroup'], student_data['number'], week_string)
+    return subscribers
+
+async def background_prewarm(tick_time=None):
+    """Прогрев кэшей за несколько минут до предсказуемого пика нагрузки"""
+    if db is None:
+        return
+    moscow_tz = timezone(timedelta(hours=3))
+    now = datetime.fromtimestamp(tick_time, moscow_tz) if tick_time else datetime.now(moscow_tz)
+    reasons, day, target_time = get_upcoming_peaks(now)
+    if not reasons:
+        return
+    
+    start_time = time.monotonic()
+    loop = asyncio.get_running_loop()
+    subscriber_ids = list(notification_index.get((day, target_time), ()))
+    subscribers = await loop.run_in_executor(None, prewarm_caches_sync, subscriber_ids)
+    
+    # Профили студентов, которым придет напоминание (данные уже загружены в потоке)
+    for user_id, student_data in subscribers.items():
+        if user_id not in user_data:
+            user_data[user_id] = student_data
+    
+    summary = f"🔥 Прогрев кэша перед пиком ({'; '.join(reasons)}): {time.monotonic() - start_time:.2f}с"
+    logger.info(summary)
+    send_log_to_server(summary, "cache_prewarm", "info")
+
+async def background_drafts_flush(tick_time=None):
+    """Запись накопленных изменений черновиков в БД"""
+    changes = drafts.take_changes()
+    if changes:
+        loop = asyncio.get_running_loop()
         try:
-            # Создаем контекст из application
-            from telegram.ext import ContextTypes
-            context = ContextTypes.DEFAULT_TYPE(application=application)
-            await send_notification_reminders(context)
-        except Exception as e:
-            logger.error(f"❌ Ошибка в background_notifications: {e}")
+            await loop.run_in_executor(None, drafts.write_rows, changes)
+        except Exception:
+            drafts.finish_changes(changes, written=False)
+            raise
+        drafts.finish_changes(changes)
+
+async def background_drafts_expire(tick_time=None):
+    """Удаление просроченных черновиков из памяти (в БД - при каждой записи)"""
+    expired = drafts.expire()
+    if expired:
+        logger.info(f"🧹 Удалено просроченных черновиков: {expired}")
+
+async def start_background_jobs(application: Application):
+    """post_init: фоновые задачи живут вместе с приложением"""
+    background_scheduler.add_job(
+        "notifications",
+        lambda tick_time: background_notifications(application, tick_time),
+        60, catch_up=True
+    )
+    background_scheduler.add_job("blacklist", background_blacklist_update, 300, jitter=30)
+    background_scheduler.add_job("prewarm", background_prewarm, 60)
+    background_scheduler.add_job("drafts", background_drafts_flush, DRAFT_FLUSH_INTERVAL)
+    background_scheduler.add_job("drafts_expire", background_drafts_expire, 300)
+    background_scheduler.start()
+
+async def stop_background_jobs(application: Application):
+    """post_shutdown: останавливаем фоновые задачи"""
+    await background_scheduler.stop()
+    # Несохраненные черновики должны пережить перезапуск
+    try:
+        changes = drafts.take_changes()
+        drafts.write_rows(changes)
+        drafts.finish_changes(changes)
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи черновиков при остановке: {e}")
 
 # ОСНОВНЫЕ ФУНКЦИИ БОТА
 @log_execution_time("show_week_selection")
 async def show_week_selection(query, user_id):
     """Показ выбора недели с статусами"""
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
         
     try:
@@ -1859,7 +3629,7 @@ async def show_week_selection(query, user_id):
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await edit_message(query,
             "Выберите неделю для отметки посещаемости:\n\n"
             "✅ - все пары недели отмечены\n"
             "🟡 - часть пар недели отмечена\n" 
@@ -1870,12 +3640,12 @@ async def show_week_selection(query, user_id):
         
     except Exception as e:
         logger.error(f"❌ Ошибка в show_week_selection: {e}")
-        await query.edit_message_text("❌ Ошибка при загрузке расписания")
+        await edit_message(query, "❌ Ошибка при загрузке расписания")
 
 @log_execution_time("show_days_with_status")
 async def show_days_with_status(query, user_id, week_string=None, context=None):
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
         
     student_data = user_data[user_id]
@@ -1889,29 +3659,8 @@ async def show_days_with_status(query, user_id, week_string=None, context=None):
         week_type = get_current_week_type()
     
     try:
-        # Используем кэшированные данные
-        schedule_data = get_schedule_data_optimized(subgroup)
-        
-        day_status = {}
-        
-        for row in schedule_data[1:]:
-            if len(row) > 2 and row[0] == week_type:
-                day = row[1]
-                if day not in day_status:
-                    day_status[day] = {'total': 0, 'marked': 0}
-                
-                day_status[day]['total'] += 1
-                
-                # Проверяем отметку студента
-                header = schedule_data[0]
-                student_col = None
-                for idx, cell in enumerate(header):
-                    if str(cell).strip() == str(student_data['number']):
-                        student_col = idx
-                        break
-                
-                if student_col and len(row) > student_col and row[student_col].strip() in EMOJI_MAP.values():
-                    day_status[day]['marked'] += 1
+        # Используем кэшированную сводку по дням (пересчитывается только при смене расписания)
+        day_status = student_week_summary(subgroup, student_data['number'], week_type) or {}
         
         days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница"]
         keyboard = []
@@ -1919,8 +3668,7 @@ async def show_days_with_status(query, user_id, week_string=None, context=None):
         for day in days:
             status_text = ""
             if day in day_status:
-                marked = day_status[day]['marked']
-                total = day_status[day]['total']
+                total, marked = day_status[day]
                 if total > 0:
                     if marked == total:
                         status_text = " ✅"
@@ -1935,28 +3683,22 @@ async def show_days_with_status(query, user_id, week_string=None, context=None):
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        try:
-            await query.edit_message_text(
-                f"📅 Выберите день недели ({week_type}):\n\n"
-                "✅ - все пары отмечены\n"
-                "🟡 - часть пар отмечена\n"
-                "❌ - пары не отмечены",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            if "Message is not modified" in str(e):
-                logger.info(f"Сообщение не изменилось (неделя: {week_type}), пропускаем")
-            else:
-                raise e
+        await edit_message(query,
+            f"📅 Выберите день недели ({week_type}):\n\n"
+            "✅ - все пары отмечены\n"
+            "🟡 - часть пар отмечена\n"
+            "❌ - пары не отмечены",
+            reply_markup=reply_markup
+        )
                 
     except Exception as e:
         logger.error(f"❌ Ошибка в show_days_with_status: {e}")
-        await query.edit_message_text("❌ Ошибка при загрузке расписания")
+        await edit_message(query, "❌ Ошибка при загрузке расписания")
 
 @log_execution_time("show_subjects")
 async def show_subjects(query, day, user_id, week_string=None, context=None):
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
         
     student_data = user_data[user_id]
@@ -1971,30 +3713,20 @@ async def show_subjects(query, day, user_id, week_string=None, context=None):
         week_type = get_current_week_type()
     
     username = query.from_user.username or "Без username"
-    log_user_action(user_id, username, f"Просмотр предметов", f"день: {day}")
+    log_user_action(user_id, username, "Просмотр предметов", "день: {day}", day=day)
     
     try:
-        schedule_data = get_schedule_data_optimized(subgroup)
+        index = schedule_index(subgroup)
         subjects_with_status = []
-        header = schedule_data[0]
+        student_col = index.columns.get(str(student_number).strip())
         
-        student_col = None
-        for idx, cell in enumerate(header):
-            if str(cell).strip() == str(student_number):
-                student_col = idx
-                break
-        
-        # Собираем все строки для этого дня
-        day_rows = []
-        for row_num, row in enumerate(schedule_data[1:], start=2):
-            if len(row) > 2 and row[0] == week_type and row[1] == day:
-                day_rows.append((row_num, row))
+        # Строки этого дня берем из индекса
+        day_rows = [(row_num, index.data[row_num - 1])
+                    for row_num in index.day_rows.get((normalize_week(week_type), day), ())]
         
         # Проверяем временные отметки
-        temp_marks = {}
         day_key = f"{week_type}_{day}"
-        if context and 'temp_marks' in context.user_data and day_key in context.user_data['temp_marks']:
-            temp_marks = context.user_data['temp_marks'][day_key]
+        temp_marks = drafts.get('marks', user_id, day_key) or {}
         
         for row_num, row in day_rows:
             subject = row[2]
@@ -2029,7 +3761,7 @@ async def show_subjects(query, day, user_id, week_string=None, context=None):
             subjects_with_status.append((subject, button_text, row_num, status, is_cancelled))
         
         if not subjects_with_status:
-            await query.edit_message_text(f"❌ На {day} ({week_type}) нет занятий")
+            await edit_message(query, f"❌ На {day} ({week_type}) нет занятий")
             return
             
         keyboard = []
@@ -2085,22 +3817,15 @@ async def show_subjects(query, day, user_id, week_string=None, context=None):
         # ДОБАВЛЯЕМ ВАЖНОЕ НАПОМИНАНИЕ
         reminder_text = "\n\n⚠️ *ВНИМАНИЕ:* После отметки на всех парах не забудьте нажать кнопку '💾 Завершить' для сохранения изменений!"
         
-        try:
-            await query.edit_message_text(
-                f"📚 {day} - {week_type}:\n\n{full_subjects_text}{reminder_text}\n\nВыберите предмет для отметки:",
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            if "Message is not modified" in str(e):
-                # Игнорируем эту ошибку - сообщение уже имеет нужное содержимое
-                logger.info(f"Сообщение не изменилось (день: {day}), пропускаем")
-            else:
-                raise e
+        await edit_message(query,
+            f"📚 {day} - {week_type}:\n\n{full_subjects_text}{reminder_text}\n\nВыберите предмет для отметки:",
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
         
     except Exception as e:
         logger.error(f"❌ Ошибка в show_subjects: {e}")
-        await query.edit_message_text("❌ Ошибка при загрузке расписания")
+        await edit_message(query, "❌ Ошибка при загрузке расписания")
 
 @log_execution_time("show_subject_actions")
 async def show_subject_actions(query, day, row_num):
@@ -2115,12 +3840,12 @@ async def show_subject_actions(query, day, row_num):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите действие для отметки:", reply_markup=reply_markup)
+    await edit_message(query, "Выберите действие для отметки:", reply_markup=reply_markup)
 
 @log_execution_time("temp_mark_attendance")
 async def temp_mark_attendance(query, day, row_num, action, user_id, context):
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
         
     student_data = user_data[user_id]
@@ -2128,32 +3853,26 @@ async def temp_mark_attendance(query, day, row_num, action, user_id, context):
     
     mark = EMOJI_MAP.get(action, '❓')
     
-    log_user_action(user_id, username, f"Временная отметка", f"день: {day}, статус: {mark}")
-    
-    # Сохраняем во временное хранилище
-    if 'temp_marks' not in context.user_data:
-        context.user_data['temp_marks'] = {}
+    log_user_action(user_id, username, "Временная отметка", "день: {day}, статус: {mark}", day=day, mark=mark)
     
+    # Сохраняем в черновик
     week_string = context.user_data.get('week_string', get_current_week_type())
     day_key = f"{week_string}_{day}"
     
-    if day_key not in context.user_data['temp_marks']:
-        context.user_data['temp_marks'][day_key] = {}
-    
     if row_num == "all":
         # Для массовой отметки используем кэшированные данные
         subgroup = student_data['subgroup']
         try:
-            schedule_data = get_schedule_data_optimized(subgroup)
+            index = schedule_index(subgroup)
             
-            found_rows = 0
-            for i, row in enumerate(schedule_data[1:], start=2):
-                if len(row) > 2 and row[0] == week_string and row[1] == day:
-                    # Проверка на отмену пары из кэша
-                    is_cancelled = any('⚙️' in str(cell) for cell in row[3:])
-                    if not is_cancelled:
-                        context.user_data['temp_marks'][day_key][str(i)] = mark
-                        found_rows += 1
+            changes = {}
+            for i in index.day_rows.get((normalize_week(week_string), day), ()):
+                # Проверка на отмену пары из кэша
+                is_cancelled = any('⚙️' in str(cell) for cell in index.data[i - 1][3:])
+                if not is_cancelled:
+                    changes[str(i)] = mark
+            drafts.update('marks', user_id, day_key, changes)
+            found_rows = len(changes)
                     
             logger.info(f"✅ Массовая отметка: {found_rows} пар отмечено как '{mark}'")
             
@@ -2176,7 +3895,7 @@ async def temp_mark_attendance(query, day, row_num, action, user_id, context):
                 await query.answer("❌ Эта пара была отменена администратором", show_alert=True)
                 return
             
-            context.user_data['temp_marks'][day_key][row_num] = mark
+            drafts.update('marks', user_id, day_key, {row_num: mark})
             logger.info(f"✅ Одиночная отметка: строка {row_num} отмечена как '{mark}'")
     
     # Возвращаем к списку предметов с обновленными статусами
@@ -2185,7 +3904,7 @@ async def temp_mark_attendance(query, day, row_num, action, user_id, context):
 @log_execution_time("save_attendance")
 async def save_attendance(query, day, user_id, context):
     if user_id not in user_data:
-        await query.edit_message_text("❌ Сначала зарегистрируйтесь через /start")
+        await edit_message(query, "❌ Сначала зарегистрируйтесь через /start")
         return
         
     student_data = user_data[user_id]
@@ -2197,12 +3916,7 @@ async def save_attendance(query, day, user_id, context):
     day_key = f"{week_string}_{day}"
     
     # Проверяем есть ли временные отметки
-    if 'temp_marks' not in context.user_data or day_key not in context.user_data['temp_marks']:
-        await query.answer("Нет изменений для сохранения", show_alert=True)
-        await show_days_with_status(query, user_id, week_string, context)
-        return
-    
-    temp_marks = context.user_data['temp_marks'][day_key]
+    temp_marks = drafts.get('marks', user_id, day_key)
     if not temp_marks:
         await query.answer("Нет изменений для сохранения", show_alert=True)
         await show_days_with_status(query, user_id, week_string, context)
@@ -2210,21 +3924,21 @@ async def save_attendance(query, day, user_id, context):
     
     try:
         # Показываем сообщение о начале сохранения
-        await query.edit_message_text("💾 Сохранение отметок...")
+        await edit_message(query, "💾 Сохранение отметок...")
         
         # Асинхронно выполняем сохранение
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, lambda: save_attendance_sync(subgroup, student_number, temp_marks))
+        student_col = await loop.run_in_executor(None, lambda: save_attendance_sync(subgroup, student_number, temp_marks))
         
-        # 🔄 ОБНОВЛЯЕМ КЭШ ПОСЛЕ СОХРАНЕНИЯ
-        cache_key = f'schedule_{subgroup}'
-        preloaded_data[cache_key] = None  # Инвалидируем кэш
+        # 🔄 ОБНОВЛЯЕМ КЭШ ПОСЛЕ СОХРАНЕНИЯ (только сохраненные ячейки)
+        apply_schedule_edits(subgroup, {(int(row_num), student_col - 1): mark for row_num, mark in temp_marks.items()})
         logger.info(f"🔄 Кэш расписания подгруппы {subgroup} обновлен после сохранения")
         
         # Очищаем временные отметки
-        del context.user_data['temp_marks'][day_key]
+        drafts.discard('marks', user_id, day_key)
         
-        log_user_action(user_id, username, "Сохранение отметок", f"день: {day}, сохранено: {len(temp_marks)} (BATCH)")
+        log_user_action(user_id, username, "Сохранение отметок", "день: {day}, сохранено: {saved} (BATCH)",
+                        day=day, saved=len(temp_marks))
         
         # Показываем уведомление об успехе
         await query.answer(f"✅ Сохранено {len(temp_marks)} отметок", show_alert=True)
@@ -2235,11 +3949,11 @@ async def save_attendance(query, day, user_id, context):
     except Exception as e:
         error_msg = f"❌ Ошибка сохранения отметок {user_id}: {str(e)}"
         logger.error(error_msg)
-        log_user_action(user_id, username, "ОШИБКА СОХРАНЕНИЯ", f"{day} - {str(e)}", "error")
-        await query.edit_message_text("❌ Ошибка при сохранении отметок")
+        log_user_action(user_id, username, "ОШИБКА СОХРАНЕНИЯ", "{day} - {error}", "error", day=day, error=e)
+        await edit_message(query, "❌ Ошибка при сохранении отметок")
 
 def save_attendance_sync(subgroup, student_number, temp_marks):
-    """Синхронная версия сохранения отметок"""
+    """Синхронная версия сохранения отметок (возвращает номер колонки студента в листе)"""
     schedule_sheet = db.worksheet(f"{subgroup} подгруппа")
     header = schedule_sheet.row_values(1)
     
@@ -2264,23 +3978,461 @@ def save_attendance_sync(subgroup, student_number, temp_marks):
     # Выполняем все обновления одним запросом
     if updates:
         schedule_sheet.batch_update(updates)
+    return student_col
 
 # УТИЛИТЫ
-def encode_week_string(week_string):
-    """Кодирование строки недели в короткий формат"""
-    # Простой хэш для создания короткого идентификатора
-    week_hash = hash(week_string) % 1000000
-    cache['week_strings'][str(week_hash)] = week_string
-    return str(week_hash)
-
-def decode_week_string(encoded_week):
-    """Декодирование строки недели из короткого формата"""
-    # Ищем в кэше
-    if encoded_week in cache['week_strings']:
-        return cache['week_strings'][encoded_week]
-    
-    # Если не найдено, возвращаем текущую неделю как fallback
-    return get_current_week_type()
+WEEK_DAYS = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+CANCELLATION_ACTIONS = ("cancel", "uncancel")
+
+# КОДЕК CALLBACK-ДАННЫХ
+# Поля упаковываются в биты одного целого и записываются в base36 (без "_",
+# который разделяет части callback_data). Кодек не хранит состояния, поэтому
+# кнопки одинаково декодируются после перезапуска и в любом процессе.
+BASE36_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class CodecField:
+    """Поле кодека: ширина в битах и преобразования значение <-> число"""
+    __slots__ = ('name', 'bits', 'to_int', 'from_int')
+
+    def __init__(self, name, bits, to_int=int, from_int=int):
+        self.name = name
+        self.bits = bits
+        self.to_int = to_int
+        self.from_int = from_int
+
+class CallbackCodec:
+    """Детерминированный компактный кодек полей callback_data"""
+    VERSION_BITS = 3
+
+    def __init__(self, version, *fields):
+        self.version = version
+        self.fields = fields
+
+    def encode(self, **values):
+        number = 0
+        for field in reversed(self.fields):
+            value = field.to_int(values[field.name])
+            if not 0 <= value < (1 << field.bits):
+                raise ValueError(f"поле {field.name}={value} не помещается в {field.bits} бит")
+            number = (number << field.bits) | value
+        number = (number << self.VERSION_BITS) | self.version
+        
+        digits = []
+        while True:
+            number, remainder = divmod(number, 36)
+            digits.append(BASE36_ALPHABET[remainder])
+            if not number:
+                break
+        return "".join(reversed(digits))
+
+    def decode(self, text):
+        try:
+            number = int(text, 36)
+        except ValueError:
+            raise ValueError(f"некорректный код '{text}'")
+        if number & ((1 << self.VERSION_BITS) - 1) != self.version:
+            raise ValueError(f"код '{text}' другого формата")
+        number >>= self.VERSION_BITS
+        
+        values = {}
+        for field in self.fields:
+            raw = number & ((1 << field.bits) - 1)
+            number >>= field.bits
+            try:
+                values[field.name] = field.from_int(raw)
+            except (IndexError, ValueError):
+                raise ValueError(f"некорректное поле {field.name}={raw}")
+        if number:
+            raise ValueError(f"лишние данные в коде '{text}'")
+        return values
+
+def decode_week_number(number):
+    if not 1 <= number <= 17:
+        raise ValueError(f"неделя {number} вне семестра")
+    return format_week_string(number)
+
+WEEK_CODEC_FIELD = CodecField('week_string', 5, parse_week_number, decode_week_number)
+DAY_CODEC_FIELD = CodecField('day', 3, WEEK_DAYS.index, WEEK_DAYS.__getitem__)
+SUBGROUP_CODEC_FIELD = CodecField('subgroup', 2, int, str)
+ROW_CODEC_FIELD = CodecField('row_num', 16, int, str)
+ACTION_CODEC_FIELD = CodecField('action', 1, CANCELLATION_ACTIONS.index, CANCELLATION_ACTIONS.__getitem__)
+
+# Версия в младших битах отличает форматы разных кнопок
+WEEK_CODEC = CallbackCodec(1, WEEK_CODEC_FIELD)
+WEEK_DAY_CODEC = CallbackCodec(2, WEEK_CODEC_FIELD, DAY_CODEC_FIELD)
+SUBGROUP_CODEC = CallbackCodec(3, WEEK_CODEC_FIELD, DAY_CODEC_FIELD, SUBGROUP_CODEC_FIELD)
+CANCELLATION_CODEC = CallbackCodec(4, WEEK_CODEC_FIELD, DAY_CODEC_FIELD, SUBGROUP_CODEC_FIELD,
+                                   ROW_CODEC_FIELD, ACTION_CODEC_FIELD)
+
+# МАРШРУТИЗАЦИЯ CALLBACK-КНОПОК
+class CallbackField:
+    """Поле callback_data: имя, преобразование типа и "жадность" (забирает лишние части)
+
+    expand=True - convert возвращает словарь аргументов (например, CallbackCodec.decode).
+    """
+    __slots__ = ('name', 'convert', 'greedy', 'expand')
+
+    def __init__(self, name, convert=str, greedy=False, expand=False):
+        self.name = name
+        self.convert = convert
+        self.greedy = greedy
+        self.expand = expand
+
+def parse_callback_fields(fields, rest):
+    """Разбирает остаток callback_data (после префикса) в словарь аргументов"""
+    if not fields:
+        return {}
+    parts = rest.split("_")
+    greedy_index = next((i for i, field in enumerate(fields) if field.greedy), None)
+    if greedy_index is None:
+        if len(parts) < len(fields):
+            raise ValueError(f"ожидалось {len(fields)} полей")
+        # Лишние части (старые форматы) игнорируются, как раньше
+        values = parts[:len(fields)]
+    else:
+        tail = len(fields) - greedy_index - 1
+        if len(parts) < len(fields):
+            raise ValueError(f"ожидалось минимум {len(fields)} полей")
+        values = (parts[:greedy_index]
+                  + ['_'.join(parts[greedy_index:len(parts) - tail])]
+                  + (parts[len(parts) - tail:] if tail else []))
+    args = {}
+    for field, value in zip(fields, values):
+        if field.expand:
+            args.update(field.convert(value))
+        else:
+            args[field.name] = field.convert(value)
+    return args
+
+class CallbackRoute:
+    """Маршрут callback-кнопки и его статистика"""
+    __slots__ = ('name', 'handler', 'fields', 'priority', 'dedup', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name, handler, fields, priority='view', dedup=False):
+        self.name = name
+        self.handler = handler
+        self.fields = fields
+        self.priority = priority  # класс допуска под нагрузкой (см. AdmissionController)
+        self.dedup = dedup  # неидемпотентное действие, повтор сразу после выполнения отбрасывается
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class CallbackRouter:
+    """Таблица маршрутов callback_data вместо цепочки if/elif
+
+    Точные значения ищутся в словаре, префиксы ("apst_", "notif_day_")
+    - в словаре по первым 1..MAX_PREFIX_PARTS частям данных через "_".
+    """
+    MAX_PREFIX_PARTS = 3
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+
+    def exact_route(self, data, priority='view', dedup=False):
+        def decorator(handler):
+            self.exact[data] = CallbackRoute(data, handler, (), priority, dedup)
+            return handler
+        return decorator
+
+    def prefix_route(self, prefix, *fields, priority='view', dedup=False):
+        assert prefix.endswith("_") and prefix.count("_") <= self.MAX_PREFIX_PARTS
+        def decorator(handler):
+            self.prefixes[prefix] = CallbackRoute(prefix, handler, fields, priority, dedup)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """Возвращает (маршрут, аргументы) или (None, None)"""
+        route = self.exact.get(data)
+        if route is not None:
+            return route, {}
+        parts = data.split("_", self.MAX_PREFIX_PARTS)
+        # Более длинный префикс важнее ("back_to_subjects_" раньше "back_")
+        for count in range(min(len(parts) - 1, self.MAX_PREFIX_PARTS), 0, -1):
+            prefix = "_".join(parts[:count]) + "_"
+            route = self.prefixes.get(prefix)
+            if route is not None:
+                return route, parse_callback_fields(route.fields, data[len(prefix):])
+        return None, None
+
+    def priority_of(self, data):
+        """Класс допуска для callback_data (неизвестные данные - 'view')"""
+        try:
+            route, _ = self.resolve(data)
+        except ValueError:
+            route = None
+        return route.priority if route is not None else 'view'
+
+    async def dispatch(self, route, args, query, context, user_id):
+        start_time = time.monotonic()
+        try:
+            await route.handler(query, context, user_id, **args)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start_time
+            route.calls += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+
+    def format_metrics(self, limit=10):
+        routes = [r for r in list(self.exact.values()) + list(self.prefixes.values()) if r.calls]
+        routes.sort(key=lambda r: r.calls, reverse=True)
+        lines = []
+        for route in routes[:limit]:
+            lines.append(f"• `{route.name}`: {route.calls} вызовов, ср. {route.total_time / route.calls:.2f}с, "
+                         f"макс {route.max_time:.2f}с, ошибок {route.errors}\n")
+        return "".join(lines)
+
+callback_router = CallbackRouter()
+
+class CallbackDeduplicator:
+    """Отбрасывание двойных нажатий по ключу (пользователь, callback_data)
+
+    Применяется только к неидемпотентным маршрутам (dedup=True): повтор в
+    течение window секунд после выполнения отбрасывается. Повтор во время
+    выполнения сюда не доходит - апдейты пользователя и так идут по очереди.
+    Отдельно запоминаются последние сохраненные отметки, чтобы одинаковое
+    сохранение не писалось в таблицу дважды.
+    """
+    
+    def __init__(self, window=1.0, save_window=30.0):
+        self.window = window
+        self.save_window = save_window
+        self.completed = OrderedDict()  # ключ -> время завершения, от старых к новым
+        self.recent_saves = {}  # user_id -> (отпечаток сохранения, время)
+        self.dropped = 0
+        self.saves_skipped = 0
+    
+    async def run(self, key, handler):
+        """Выполняет handler(), если это не повтор; возвращает True, если выполнил"""
+        now = time.monotonic()
+        # Лениво забываем старые завершения
+        while self.completed:
+            oldest_key, finished_at = next(iter(self.completed.items()))
+            if now - finished_at < self.window:
+                break
+            del self.completed[oldest_key]
+        
+        if key in self.completed:
+            self.dropped += 1
+            return False
+        
+        try:
+            await handler()
+        finally:
+            self.completed[key] = time.monotonic()
+            self.completed.move_to_end(key)
+        return True
+    
+    def is_repeated_save(self, user_id, fingerprint):
+        previous = self.recent_saves.get(user_id)
+        return (previous is not None and previous[0] == fingerprint
+                and time.monotonic() - previous[1] < self.save_window)
+    
+    def remember_save(self, user_id, fingerprint):
+        self.recent_saves[user_id] = (fingerprint, time.monotonic())
+    
+    def format_metrics(self):
+        return (f"• Двойные нажатия: отброшено {self.dropped}, "
+                f"повторных сохранений {self.saves_skipped}\n")
+
+callback_deduplicator = CallbackDeduplicator(CALLBACK_DEDUP_WINDOW, SAVE_DEDUP_WINDOW)
+
+# Типы полей callback_data
+ROW_FIELD = CallbackField('row_num', lambda value: str(int(value)))  # строка таблицы, проверяем что число
+
+def day_field(greedy=False):
+    return CallbackField('day', greedy=greedy)
+
+def codec_field(codec):
+    return CallbackField('payload', codec.decode, expand=True)
+
+# МАРШРУТЫ ПОЛЬЗОВАТЕЛЯ
+@callback_router.exact_route("back_to_main")
+async def route_back_to_main(query, context, user_id):
+    # Возвращаем главное меню
+    reply_markup = build_main_menu_markup(user_id)
+    await edit_message(query, "Главное меню:", reply_markup=reply_markup)
+
+@callback_router.exact_route("mark_attendance")
+async def route_mark_attendance(query, context, user_id):
+    await show_week_selection(query, user_id)
+
+@callback_router.exact_route("week_none")
+async def route_week_none(query, context, user_id):
+    await query.answer("Эта неделя недоступна для отметки", show_alert=True)
+
+@callback_router.prefix_route("week_", CallbackField('week_string', greedy=True))
+async def route_week(query, context, user_id, week_string):
+    context.user_data['week_string'] = week_string
+    await show_days_with_status(query, user_id, week_string, context)
+
+@callback_router.prefix_route("day_", day_field())
+async def route_day(query, context, user_id, day):
+    week_string = context.user_data.get('week_string')
+    await show_subjects(query, day, user_id, week_string, context)
+
+@callback_router.prefix_route("subject_", day_field(), ROW_FIELD)
+async def route_subject(query, context, user_id, day, row_num):
+    await show_subject_actions(query, day, row_num)
+
+@callback_router.prefix_route("back_to_subjects_", day_field())
+async def route_back_to_subjects(query, context, user_id, day):
+    week_string = context.user_data.get('week_string')
+    await show_subjects(query, day, user_id, week_string, context)
+
+@callback_router.exact_route("back_to_days")
+@callback_router.exact_route("mark_complete")
+async def route_back_to_days(query, context, user_id):
+    week_string = context.user_data.get('week_string')
+    await show_days_with_status(query, user_id, week_string, context)
+
+@callback_router.exact_route("class_cancelled")
+async def route_class_cancelled(query, context, user_id):
+    await query.answer("❌ Эта пара была отменена администратором", show_alert=True)
+
+@callback_router.prefix_route("action_", day_field(), ROW_FIELD, CallbackField('action'))
+async def route_action(query, context, user_id, day, row_num, action):
+    await temp_mark_attendance(query, day, row_num, action, user_id, context)
+
+@callback_router.prefix_route("temp_all_", day_field(), CallbackField('action'), dedup=True)
+async def route_temp_all(query, context, user_id, day, action):
+    await temp_mark_attendance(query, day, "all", action, user_id, context)
+
+@callback_router.prefix_route("save_", day_field(), priority='save', dedup=True)
+async def route_save(query, context, user_id, day):
+    week_string = context.user_data.get('week_string', get_current_week_type())
+    day_key = f"{week_string}_{day}"
+    temp_marks = drafts.get('marks', user_id, day_key)
+    fingerprint = (day_key, frozenset(temp_marks.items())) if temp_marks else None
+    
+    # Ровно эти отметки только что сохранены - в таблицу не пишем
+    if fingerprint is not None and callback_deduplicator.is_repeated_save(user_id, fingerprint):
+        callback_deduplicator.saves_skipped += 1
+        drafts.discard('marks', user_id, day_key)
+        await show_days_with_status(query, user_id, week_string, context)
+        return
+    
+    await save_attendance(query, day, user_id, context)
+    
+    # save_attendance очищает временные отметки только после успешной записи
+    if fingerprint is not None and drafts.get('marks', user_id, day_key) is None:
+        callback_deduplicator.remember_save(user_id, fingerprint)
+
+# МАРШРУТЫ НАСТРОЕК
+@callback_router.exact_route("settings_menu", priority='settings')
+async def route_settings_menu(query, context, user_id):
+    await show_settings(query, user_id)
+
+@callback_router.exact_route("toggle_notifications", priority='settings')
+async def route_toggle_notifications(query, context, user_id):
+    await toggle_notifications_handler(query, user_id)
+
+@callback_router.exact_route("select_days", priority='settings')
+async def route_select_days(query, context, user_id):
+    await show_days_selection(query, user_id)
+
+@callback_router.exact_route("select_time", priority='settings')
+async def route_select_time(query, context, user_id):
+    await show_time_selection(query, user_id)
+
+@callback_router.prefix_route("notif_day_", day_field(), priority='settings')
+async def route_notif_day(query, context, user_id, day):
+    await toggle_notification_day(query, user_id, day)
+
+@callback_router.prefix_route("notif_time_", CallbackField('time_str'), priority='settings')
+async def route_notif_time(query, context, user_id, time_str):
+    await set_notification_time(query, user_id, time_str)
+
+# МАРШРУТЫ АДМИНИСТРАТОРА
+@callback_router.exact_route("admin_panel")
+async def route_admin_panel(query, context, user_id):
+    if user_id == ADMIN_ID:
+        reply_markup = build_admin_panel_markup()
+        await edit_message(query, "🛠️ Админ-панель:", reply_markup=reply_markup)
+    else:
+        await edit_message(query, "❌ У вас нет доступа к админ-панели")
+
+@callback_router.exact_route("admin_students")
+async def route_admin_students(query, context, user_id):
+    await admin_show_students(query)
+
+@callback_router.exact_route("admin_status")
+async def route_admin_status(query, context, user_id):
+    await admin_show_status(query, context)
+
+@callback_router.exact_route("admin_class_presence")
+async def route_admin_class_presence(query, context, user_id):
+    await admin_class_presence(query)
+
+@callback_router.exact_route("admin_presence_week")
+async def route_admin_presence_week(query, context, user_id):
+    await admin_show_presence_week_selection(query)
+
+@callback_router.exact_route("admin_blacklist")
+async def route_admin_blacklist(query, context, user_id):
+    await admin_blacklist_menu(query)
+
+@callback_router.exact_route("admin_show_blacklist")
+async def route_admin_show_blacklist(query, context, user_id):
+    await admin_show_blacklist(query, context)
+
+@callback_router.exact_route("admin_refresh_blacklist")
+async def route_admin_refresh_blacklist(query, context, user_id):
+    await admin_refresh_blacklist(query, context)
+
+@callback_router.exact_route("admin_refresh_cache")
+async def route_admin_refresh_cache(query, context, user_id):
+    if user_id != ADMIN_ID:
+        await query.answer("❌ Нет доступа", show_alert=True)
+        return
+    
+    await edit_message(query, "🔄 Обновление кэша...")
+    try:
+        reply_markup = build_admin_panel_markup()
+        
+        if update_cache():
+            # Показываем уведомление об успехе и возвращаем в админ-панель
+            await query.answer("✅ Кеш обновлен", show_alert=True)
+            await edit_message(query, "🛠️ Админ-панель (кеш обновлен ✅):", reply_markup=reply_markup)
+        else:
+            # Возвращаем в админ-панель даже при ошибке
+            await query.answer("❌ Ошибка обновления кеша", show_alert=True)
+            await edit_message(query, "🛠️ Админ-панель (ошибка обновления кеша ❌):", reply_markup=reply_markup)
+    
+    except Exception as e:
+        await query.answer(f"❌ Ошибка: {str(e)[:50]}", show_alert=True)
+
+@callback_router.prefix_route("apw_", codec_field(WEEK_CODEC))
+async def route_admin_presence_week_days(query, context, user_id, week_string):
+    await admin_show_presence_days(query, week_string)
+
+@callback_router.prefix_route("apd_", codec_field(WEEK_DAY_CODEC))
+async def route_admin_presence_day(query, context, user_id, week_string, day):
+    logger.info(f"🔍 АДМИН: Переход к выбору подгруппы дня {day} недели '{week_string}'")
+    await admin_show_presence_subgroups(query, week_string, day)
+
+@callback_router.prefix_route("apsg_", codec_field(SUBGROUP_CODEC))  # Admin Presence SubGroup
+async def route_admin_presence_subgroup(query, context, user_id, week_string, day, subgroup):
+    logger.info(f"🔍 АДМИН: Переход к предметам {day} недели '{week_string}', подгруппа {subgroup}")
+    # При входе в подгруппу показываем актуальный лист, дальше работаем с ним
+    await admin_show_presence_subjects(query, week_string, day, subgroup, context, fresh=True)
+
+# Admin Presence Subject Temporary (временное изменение)
+@callback_router.prefix_route("apst_", codec_field(CANCELLATION_CODEC))
+async def route_admin_presence_toggle(query, context, user_id, week_string, day, subgroup, row_num, action):
+    logger.info(f"🔍 АДМИН: Временное изменение статуса пары {day} недели '{week_string}', подгруппа {subgroup}")
+    await admin_temp_toggle_class_cancellation(query, week_string, day, subgroup, row_num, action, context)
+
+@callback_router.prefix_route("apss_", codec_field(SUBGROUP_CODEC))  # Admin Presence Save Subjects
+async def route_admin_presence_save(query, context, user_id, week_string, day, subgroup):
+    logger.info(f"🔍 АДМИН: Сохранение изменений для {day} недели '{week_string}', подгруппа {subgroup}")
+    await admin_save_class_cancellations(query, week_string, day, subgroup, context)
 
 # ГЛАВНЫЙ ОБРАБОТЧИК КНОПОК
 @check_blacklist
@@ -2295,7 +4447,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверка доступности базы данных
     if db is None:
-        await query.edit_message_text("❌ Временная проблема с подключением. Попробуйте позже.")
+        await edit_message(query, "❌ Временная проблема с подключением. Попробуйте позже.")
         log_user_action(user_id, username, "ОШИБКА БАЗЫ ДАННЫХ", data, "error")
         return
     
@@ -2305,10 +4457,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 if not await button_limiter.is_allowed(user_id):
                     wait_time = await button_limiter.get_wait_time(user_id)
-                    log_user_action(user_id, username, "ПРЕВЫШЕНИЕ ЛИМИТА КНОПОК", 
-                                  f"ожидание: {int(wait_time)}сек", "warning")
+                    log_user_action(user_id, username, "ПРЕВЫШЕНИЕ ЛИМИТА КНОПОК",
+                                    "ожидание: {wait:.0f}сек", "warning", wait=wait_time)
                     
-                    await query.edit_message_text(
+                    await edit_message(query,
                         f"⏳ Слишком много действий за последнюю минуту.\n"
                         f"Подождите {int(wait_time)} секунд перед следующим действием."
                     )
@@ -2318,290 +4470,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Продолжаем выполнение если rate limiter сломался
                 send_log_to_server(f"❌ Ошибка rate limiter: {e}", "rate_limiter_error", "error")
 
-        if data == "back_to_main":
-            # Возвращаем главное меню
-            keyboard = [
-                [InlineKeyboardButton("📝 Отметиться", callback_data="mark_attendance")],
-                [InlineKeyboardButton("⚙️ Настройки", callback_data="settings_menu")]
-            ]
-            if user_id == ADMIN_ID:
-                keyboard.append([InlineKeyboardButton("🛠️ Админ-панель", callback_data="admin_panel")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Главное меню:", reply_markup=reply_markup)
-            return
-            
-        elif data == "mark_attendance":
-            await show_week_selection(query, user_id)
-        elif data.startswith("week_"):
-            if data == "week_none":
-                await query.answer("Эта неделя недоступна для отметки", show_alert=True)
-                return
-            week_string = data[5:]
-            context.user_data['week_string'] = week_string
-            await show_days_with_status(query, user_id, week_string, context)
-        elif data == "admin_panel":
-            if user_id == ADMIN_ID:
-                keyboard = [
-                    [InlineKeyboardButton("👥 Список студентов", callback_data="admin_students")],
-                    [InlineKeyboardButton("🖥️ Статус сервера", callback_data="admin_status")],
-                    [InlineKeyboardButton("📊 Наличие пар", callback_data="admin_class_presence")],
-                    [InlineKeyboardButton("⚫ Черный список", callback_data="admin_blacklist")],
-                    [InlineKeyboardButton("🔄 Обновить кэш", callback_data="admin_refresh_cache")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text("🛠️ Админ-панель:", reply_markup=reply_markup)
-            else:
-                await query.edit_message_text("❌ У вас нет доступа к админ-панели")
-        elif data == "week_none":
-            await query.answer("Эта неделя недоступна для управления наличием пар", show_alert=True)
+        try:
+            route, args = callback_router.resolve(data)
+        except ValueError as e:
+            logger.warning(f"⚠️ Некорректные данные кнопки '{data}': {e}")
+            route = None
+        
+        if route is None:
+            await edit_message(query, "❌ Неизвестная команда")
             return
-        elif data == "settings_menu":
-            await show_settings(query, user_id)
-        elif data == "toggle_notifications":
-            # Включение/выключение уведомлений
-            username = query.from_user.username or "Без username"
-            user_id_str = str(user_id)
-    
-            # Инициализируем настройки если их нет
-            if user_id_str not in user_notifications:
-                user_notifications[user_id_str] = {'enabled': False, 'days': [], 'time': '09:00'}
-    
-            # Получаем ТЕКУЩИЙ статус
-            current_status = user_notifications[user_id_str].get('enabled', False)
-    
-            # Инвертируем статус
-            new_status = not current_status
-            user_notifications[user_id_str]['enabled'] = new_status
-    
-            # ЛОГИРОВАНИЕ
-            status_text = "включены" if new_status else "выключены"
-            log_user_action(user_id, username, f"Уведомления {status_text}")
-    
-            # Сохраняем настройки
-            save_notification_settings()
-    
-            # Показываем обновленные настройки
-            await show_settings(query, user_id)
-        elif data == "select_days":
-            await show_days_selection(query, user_id)
-        elif data == "select_time":
-            await show_time_selection(query, user_id)
-        elif data.startswith("notif_day_"):
-            day = data[10:]  # Извлекаем название дня
-            username = query.from_user.username or "Без username"
-
-            # Логируем перед изменением
-            old_days = user_notifications.get(str(user_id), {}).get('days', [])
-
-            # Изменяем настройки
-            user_id_str = str(user_id)
-            if user_id_str not in user_notifications:
-                user_notifications[user_id_str] = {'enabled': True, 'days': [], 'time': '09:00'}
-
-            if day in user_notifications[user_id_str]['days']:
-                user_notifications[user_id_str]['days'].remove(day)
-                action = "удален"
-            else:
-                user_notifications[user_id_str]['days'].append(day)
-                action = "добавлен"
-
-            # Логируем после изменения
-            new_days = user_notifications[user_id_str]['days']
-            log_user_action(user_id, username, f"Изменение дней уведомлений", 
-                           f"день: {day} ({action}), теперь: {', '.join(new_days) if new_days else 'нет дней'}")
-    
-            save_notification_settings()
-            await show_days_selection(query, user_id)
-        elif data.startswith("notif_time_"):
-            time_str = data[11:]  # Извлекаем время
-            username = query.from_user.username or "Без username"
-    
-            # Логируем перед изменением
-            old_time = user_notifications.get(str(user_id), {}).get('time', 'не установлено')
-    
-            # Изменяем настройки
-            user_id_str = str(user_id)
-            if user_id_str not in user_notifications:
-                user_notifications[user_id_str] = {'enabled': True, 'days': [], 'time': time_str}
-            else:
-                user_notifications[user_id_str]['time'] = time_str
-    
-            # Логируем после изменения
-            log_user_action(user_id, username, "Изменение времени уведомлений", f"новое время: {time_str}")
-    
-            save_notification_settings()
-            await show_settings(query, user_id) 
-        elif data == "admin_students":
-            await admin_show_students(query)
-        elif data == "admin_status":
-            await admin_show_status(query)
-        elif data == "admin_class_presence":
-            await admin_class_presence(query)
-        elif data == "admin_presence_week":
-            await admin_show_presence_week_selection(query)
-        elif data == "admin_blacklist":
-            await admin_blacklist_menu(query)
-        elif data == "admin_show_blacklist":
-            await admin_show_blacklist(query, context)
-        elif data == "admin_refresh_blacklist":
-            await admin_refresh_blacklist(query, context)
-        elif data == "admin_refresh_cache":
-            if user_id == ADMIN_ID:
-                await query.edit_message_text("🔄 Обновление кэша...")
-                try:
-                    # Сохраняем текущее сообщение
-                    original_message = query.message.text
-
-                    if update_cache():
-                        # Показываем уведомление об успехе
-                        await query.answer("✅ Кеш обновлен", show_alert=True)
-
-                        # Возвращаем в админ-панель с обновленным сообщением
-                        keyboard = [
-                            [InlineKeyboardButton("👥 Список студентов", callback_data="admin_students")],
-                            [InlineKeyboardButton("🖥️ Статус сервера", callback_data="admin_status")],
-                            [InlineKeyboardButton("📊 Наличие пар", callback_data="admin_class_presence")],
-                            [InlineKeyboardButton("⚫ Черный список", callback_data="admin_blacklist")],
-                            [InlineKeyboardButton("🔄 Обновить кэш", callback_data="admin_refresh_cache")],
-                            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await query.edit_message_text("🛠️ Админ-панель (кеш обновлен ✅):", reply_markup=reply_markup)
-                    else:
-                        await query.answer("❌ Ошибка обновления кеша", show_alert=True)
-                        # Возвращаем в админ-панель даже при ошибке
-                        keyboard = [
-                            [InlineKeyboardButton("👥 Список студентов", callback_data="admin_students")],
-                            [InlineKeyboardButton("🖥️ Статус сервера", callback_data="admin_status")],
-                            [InlineKeyboardButton("📊 Наличие пар", callback_data="admin_class_presence")],
-                            [InlineKeyboardButton("⚫ Черный список", callback_data="admin_blacklist")],
-                            [InlineKeyboardButton("🔄 Обновить кэш", callback_data="admin_refresh_cache")],
-                            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await query.edit_message_text("🛠️ Админ-панель (ошибка обновления кеша ❌):", reply_markup=reply_markup)
-                
-                except Exception as e:
-                    await query.answer(f"❌ Ошибка: {str(e)[:50]}", show_alert=True)
-            else:
-                await query.answer("❌ Нет доступа", show_alert=True)
-        elif data.startswith("apw_"):
-            week_encoded = data[4:]
-            try:
-                # Ищем неделю в кэше
-                week_string = decode_week_string(week_encoded)
-                if week_string:
-                    await admin_show_presence_days(query, week_string)
-                else:
-                    await query.edit_message_text("❌ Неделя не найдена")
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки недели: {e}")
-                await query.edit_message_text("❌ Ошибка при выборе недели")
-        elif data.startswith("apd_"):
-            parts = data.split("_")
-            if len(parts) >= 3:
-                week_encoded = parts[1]
-                day = '_'.join(parts[2:])
-        
-                # Ищем неделю в кэше
-                week_string = decode_week_string(week_encoded)
-        
-                if week_string:
-                    logger.info(f"🔍 АДМИН: Переход к выбору подгруппы дня {day} недели '{week_string}'")
-                    await admin_show_presence_subgroups(query, week_string, day)
-                else:
-                    await query.edit_message_text("❌ Неделя не найдена")
-        elif data.startswith("apsg_"):  # Admin Presence SubGroup
-            parts = data.split("_")
-            if len(parts) >= 4:
-                week_encoded = parts[1]
-                # Объединяем части дня (кроме последней - подгруппы)
-                day = '_'.join(parts[2:-1])
-                subgroup = parts[-1]
-        
-                # Ищем неделю в кэше
-                week_string = decode_week_string(week_encoded)
-        
-                if week_string:
-                    logger.info(f"🔍 АДМИН: Переход к предметам {day} недели '{week_string}', подгруппа {subgroup}")
-                    await admin_show_presence_subjects(query, week_string, day, subgroup, context)
-                else:
-                    await query.edit_message_text("❌ Неделя не найдена")
-        elif data.startswith("apst_"):  # Admin Presence Subject Temporary (временное изменение)
-            parts = data.split("_")
-            if len(parts) >= 6:
-                week_encoded = parts[1]
-                # Объединяем части дня
-                day_parts = parts[2:-3]  # Все части между week_encoded и subgroup
-                day = '_'.join(day_parts)
-                subgroup = parts[-3]
-                row_num = parts[-2]
-                action = parts[-1]
-        
-                # Ищем неделю в кэше
-                week_string = decode_week_string(week_encoded)
-        
-                if week_string:
-                    logger.info(f"🔍 АДМИН: Временное изменение статуса пары {day} недели '{week_string}', подгруппа {subgroup}")
-                    await admin_temp_toggle_class_cancellation(query, week_string, day, subgroup, row_num, action, context)
-                else:
-                    await query.edit_message_text("❌ Неделя не найдена")
-        elif data.startswith("apss_"):  # Admin Presence Save Subjects
-            parts = data.split("_")
-            if len(parts) >= 4:
-                week_encoded = parts[1]
-                # Объединяем части дня
-                day_parts = parts[2:-1]  # Все части между week_encoded и subgroup
-                day = '_'.join(day_parts)
-                subgroup = parts[-1]
-        
-                # Ищем неделю в кэше
-                week_string = decode_week_string(week_encoded)
-        
-                if week_string:
-                    logger.info(f"🔍 АДМИН: Сохранение изменений для {day} недели '{week_string}', подгруппа {subgroup}")
-                    await admin_save_class_cancellations(query, week_string, day, subgroup, context)
-                else:
-                    await query.edit_message_text("❌ Неделя не найдена")
-        elif data.startswith("day_"):
-            day = data.split("_")[1]
-            week_string = context.user_data.get('week_string')
-            await show_subjects(query, day, user_id, week_string, context)
-        elif data.startswith("subject_"):
-            parts = data.split("_")
-            day = parts[1]
-            row_num = parts[2]
-            await show_subject_actions(query, day, row_num)
-        elif data.startswith("back_to_subjects_"):
-            day = data.split("_")[3]
-            week_string = context.user_data.get('week_string')
-            await show_subjects(query, day, user_id, week_string, context)
-        elif data == "back_to_days":
-            week_string = context.user_data.get('week_string')
-            await show_days_with_status(query, user_id, week_string, context)
-        elif data == "class_cancelled":
-            await query.answer("❌ Эта пара была отменена администратором", show_alert=True)
-        elif data.startswith("action_"):
-            parts = data.split("_")
-            day = parts[1]
-            row_num = parts[2]
-            action = parts[3]
-            await temp_mark_attendance(query, day, row_num, action, user_id, context)
-        elif data.startswith("temp_all_"):
-            parts = data.split("_")
-            day = parts[2]
-            action = parts[3]
-            await temp_mark_attendance(query, day, "all", action, user_id, context)
-        elif data == "mark_complete":
-            week_string = context.user_data.get('week_string')
-            await show_days_with_status(query, user_id, week_string, context)
-        elif data.startswith("save_"):
-            day = data.split("_")[1]
-            await save_attendance(query, day, user_id, context)
+        
+        if route.dedup:
+            # Двойное нажатие на неидемпотентную кнопку выполняется один раз
+            await callback_deduplicator.run(
+                (user_id, data),
+                lambda: callback_router.dispatch(route, args, query, context, user_id)
+            )
         else:
-            await query.edit_message_text("❌ Неизвестная команда")
+            await callback_router.dispatch(route, args, query, context, user_id)
     except Exception as e:
         error_msg = f"❌ Ошибка в button_handler {user_id}: {str(e)} | callback: {data}"
         logger.error(error_msg)
@@ -2609,13 +4495,139 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Пытаемся отправить понятное сообщение пользователю
         try:
-            await query.edit_message_text("❌ Произошла внутренняя ошибка. Попробуйте позже или перезапустите бота через /start")
+            await edit_message(query, "❌ Произошла внутренняя ошибка. Попробуйте позже или перезапустите бота через /start")
         except:
             try:
                 await context.bot.send_message(user_id, "❌ Произошла ошибка. Используйте /start для перезапуска")
             except:
                 pass
 
+# WEBHOOK-РЕЖИМ
+class WebhookServer:
+    """Минимальный asyncio HTTP-сервер для приема обновлений от Telegram
+
+    Принимает POST на WEBHOOK_PATH, проверяет X-Telegram-Bot-Api-Secret-Token
+    и кладет Update в очередь приложения - дальше работают обычные обработчики.
+    Локально можно отправить записанное обновление:
+        curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+             -d @update.json http://127.0.0.1:8443/telegram
+    """
+    
+    MAX_BODY_SIZE = 1024 * 1024
+    READ_TIMEOUT = 10
+    
+    def __init__(self, application, path, secret_token):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.server = None
+        self.received = 0
+        self.rejected = 0
+    
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"🌐 Webhook-сервер слушает {host}:{port}{self.path}")
+    
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        method, target, _ = request_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', '0'))
+        if length > self.MAX_BODY_SIZE:
+            raise ValueError("слишком большое тело запроса")
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?', 1)[0], headers, body
+    
+    async def handle_connection(self, reader, writer):
+        status = "400 Bad Request"
+        try:
+            method, path, headers, body = await asyncio.wait_for(self.read_request(reader), self.READ_TIMEOUT)
+            
+            if path != self.path:
+                status = "404 Not Found"
+            elif method != "POST":
+                status = "405 Method Not Allowed"
+            elif not self.secret_token or not hmac.compare_digest(
+                    headers.get('x-telegram-bot-api-secret-token', ''), self.secret_token):
+                # Без секрета любой, кто достучится до порта, мог бы подделать обновление от админа
+                status = "403 Forbidden"
+            else:
+                update = Update.de_json(json.loads(body), self.application.bot)
+                await self.application.update_queue.put(update)
+                self.received += 1
+                status = "200 OK"
+        except Exception as e:
+            logger.warning(f"⚠️ Некорректный webhook-запрос: {e}")
+        
+        if not status.startswith("200"):
+            self.rejected += 1
+        try:
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode('latin-1'))
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+async def run_webhook(application: Application):
+    """Запуск бота в webhook-режиме (вместо run_polling)
+
+    Процессов за балансировщиком может быть несколько: секрет у всех общий
+    (WEBHOOK_SECRET), регистрирует webhook только процесс с WEBHOOK_REGISTER.
+    При остановке webhook не снимается - иначе перезапуск одной реплики
+    оставил бы без обновлений все остальные.
+    """
+    if not WEBHOOK_SECRET:
+        # Случайный секрет у каждого процесса свой - остальные отвечали бы 403 на все обновления
+        raise RuntimeError("Webhook-режим без WEBHOOK_SECRET запрещен: задайте общий для всех процессов WEBHOOK_SECRET")
+    if WEBHOOK_REGISTER and not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_REGISTER включен, но WEBHOOK_URL не задан")
+    
+    webhook_server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    await application.initialize()
+    try:
+        # run_polling вызывает post_init/post_shutdown сам, здесь - вручную
+        await start_background_jobs(application)
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"🌐 Webhook зарегистрирован: {WEBHOOK_URL}")
+        await application.start()
+        await webhook_server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        send_log_to_server(f"🌐 Webhook-режим: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}", "system", "info")
+        
+        await stop_event.wait()
+    finally:
+        await webhook_server.stop()
+        if application.running:
+            await application.stop()
+        await stop_background_jobs(application)
+        await application.shutdown()
+        logger.info(f"🌐 Webhook-сервер остановлен: принято {webhook_server.received}, отклонено {webhook_server.rejected}")
+
 def main():
     global db
     logger.info(f"🚀 ЗАПУСК БОТА...")
@@ -2624,6 +4636,7 @@ def main():
     try:
         # Загружаем настройки уведомлений
         load_notification_settings()
+        load_user_profiles()
         
         send_log_to_server(
             f"🔔 Система уведомлений запущена. Пользователей с уведомлениями: {len(user_notifications)}", 
@@ -2667,7 +4680,15 @@ def main():
         # Предзагрузка данных
         preload_frequent_data()
         
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(update_processor)
+            .rate_limiter(telegram_outbox)
+            .post_init(start_background_jobs)
+            .post_shutdown(stop_background_jobs)
+            .build()
+        )
 
         application.add_handler(CommandHandler("start", start))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_all_messages))
@@ -2677,13 +4698,11 @@ def main():
 
         logger.info("🤖 Бот запускается...")
         
-        # Запускаем фоновые задачи (только необходимые)
-        loop = asyncio.get_event_loop()
-        loop.create_task(background_cleanup())
-        loop.create_task(background_blacklist_update())
-        loop.create_task(background_notifications(application))
-        
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Фоновые задачи запускаются планировщиком в post_init
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
         
     except Exception as e:
         error_msg = f"💥 КРИТИЧЕСКАЯ ОШИБКА ПРИ ЗАПУСКЕ: {str(e)}"